@@ -1,23 +1,60 @@
 import json
-from typing import Callable, Any
+from typing import Callable, Any, Optional
 from fastapi import Request
 from fastapi_jwt_auth import AuthJWT
 from starlette.middleware.base import BaseHTTPMiddleware
 
+from ..bodies import IDENTITY, MSGPACK_MEDIA_TYPES
 from ..common.db_session import db_context
 from ..security.schemas import SecurityToken
 from .schemas import ActivityBase
 from .models import Activity
 
+def recorded_body(
+    body: bytes, content_type: Optional[str], encoding: Optional[str]
+) -> str:
+    """text of a request body as recorded, binary bodies (compressed,
+    msgpack or not utf-8) are recorded as a placeholder giving their size"""
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    encoding = (encoding or IDENTITY).strip().lower()
+    if encoding == IDENTITY and media_type not in MSGPACK_MEDIA_TYPES:
+        try:
+            return body.decode("utf-8")
+        except UnicodeDecodeError:
+            pass
+    return f"<{len(body)} bytes, {media_type or 'no type'}, {encoding}>"
+
+
 class ActivityLogger(BaseHTTPMiddleware):
     def __init__(self, app):
         super().__init__(app)
 
     async def set_body(self, request: Request):
-        receive_ = await request._receive()
+        # the body may arrive in several messages, its size is limited by
+        # BodySizeLimit as they are received
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await request._receive()
+            if message["type"] != "http.request":
+                break
+            chunks.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        receive_ = {
+            "type": "http.request",
+            "body": b"".join(chunks),
+            "more_body": False,
+        }
+        original_receive = request._receive
+        # body is read twice, here and by the endpoint, from the same buffer,
+        # afterwards the original channel is used so that streaming responses
+        # can listen for disconnect
+        replays = [receive_, receive_]
 
         async def receive():
-            return receive_
+            if replays:
+                return replays.pop()
+            return await original_receive()
 
         request._receive = receive
 
@@ -33,11 +70,21 @@ class ActivityLogger(BaseHTTPMiddleware):
 
         is_recording = request.url.path.startswith("/async")
 
+        # uploaded files are streamed by the endpoint, not recorded
+        is_multipart = request.headers.get("Content-Type", "").startswith(
+            "multipart/form-data"
+        )
+
         if is_recording:
-            await self.set_body(request)
-            body = await request.body()
-            if body:
-                data["request_body"] = body
+            if not is_multipart:
+                await self.set_body(request)
+                body = await request.body()
+                if body:
+                    data["request_body"] = recorded_body(
+                        body,
+                        request.headers.get("Content-Type"),
+                        request.headers.get("Content-Encoding"),
+                    )
             
             # get authorization from request
             authorization = request.headers.get('Authorization')
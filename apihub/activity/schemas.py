@@ -20,4 +20,6 @@ class ActivityDetails(ActivityBase):
 
 class ActivityStatus(str, Enum):
     ACCEPTED = "ACCEPTED"
-    PROCESSED = "PROCESSED"
\ No newline at end of file
+    PROCESSED = "PROCESSED"
+    EXPIRED = "EXPIRED"
+    CANCELLED = "CANCELLED"
\ No newline at end of file
@@ -0,0 +1,156 @@
+import time
+from typing import Dict, Optional, Tuple
+
+from fastapi import HTTPException
+from pydantic import BaseSettings, Field
+from prometheus_client import Counter, Gauge
+
+from .fairness import FairQueue
+from .scheduling import TierRouter
+
+
+HTTP_429_TOO_MANY_REQUESTS = 429
+HTTP_503_SERVICE_UNAVAILABLE = 503
+
+# count a job as in flight for a subscription unless it reached its limit,
+# jobs older than the timeout are considered lost
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local timeout = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - timeout)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now, ARGV[4])
+redis.call('EXPIRE', KEYS[1], timeout)
+return 1
+"""
+
+
+class AdmissionSettings(BaseSettings):
+    queue_high_water_marks: Dict[str, int] = Field(
+        {},
+        title="maximum number of queued jobs per application before new "
+        "submissions are rejected, applications not listed are not limited",
+    )
+    queue_sample_interval: float = Field(
+        1.0, title="seconds between two samples of the queue length"
+    )
+    queue_retry_after: int = Field(
+        10, title="seconds clients are asked to wait when a queue is full"
+    )
+    concurrency_limits: Dict[str, int] = Field(
+        {},
+        title="maximum number of jobs in flight per subscription of a tier, "
+        "tiers not listed are not limited",
+    )
+    concurrency_timeout: int = Field(
+        3600, title="seconds after which a job without result stops counting"
+    )
+    concurrency_retry_after: int = Field(
+        5, title="seconds clients are asked to wait when too many jobs are in flight"
+    )
+
+
+class QueueAdmission(object):
+    """QueueAdmission rejects new jobs for an application whose topic has
+    more queued messages than its high-water mark. Queue lengths are sampled
+    at most once per interval to keep the submission path cheap.
+    """
+
+    queue_depth = Gauge(
+        "api_queue_depth",
+        "Number of jobs waiting in the topic of an application",
+        ["api"],
+        # one per live server process, those of exited ones are removed
+        multiprocess_mode="liveall",
+    )
+    rejected_counter = Counter(
+        "api_admission_rejected_total",
+        "Submissions rejected by admission control",
+        ["api"],
+    )
+
+    def __init__(
+        self,
+        state,
+        router: Optional[TierRouter] = None,
+        fair_queue: Optional[FairQueue] = None,
+        settings: Optional[AdmissionSettings] = None,
+    ):
+        self.state = state
+        self.router = router or TierRouter()
+        self.fair_queue = fair_queue
+        self.settings = settings or AdmissionSettings()
+        self.samples: Dict[str, Tuple[float, int]] = {}
+
+    def depth(self, application: str) -> int:
+        now = time.monotonic()
+        sampled_at, depth = self.samples.get(application, (0.0, 0))
+        if now - sampled_at >= self.settings.queue_sample_interval:
+            topics = self.router.topics(application)
+            depth = sum(self.state.length(topic) for topic in topics)
+            if self.fair_queue is not None and self.fair_queue.enabled(application):
+                depth += sum(self.fair_queue.length(topic) for topic in topics)
+            self.samples[application] = (now, depth)
+            self.queue_depth.labels(api=application).set(depth)
+        return depth
+
+    def __call__(self, application: str) -> None:
+        depth = self.depth(application)
+
+        high_water_mark = self.settings.queue_high_water_marks.get(application)
+        if high_water_mark is not None and depth >= high_water_mark:
+            self.rejected_counter.labels(api=application).inc()
+            raise HTTPException(
+                HTTP_503_SERVICE_UNAVAILABLE,
+                "Service is overloaded, please retry later",
+                headers={"Retry-After": str(self.settings.queue_retry_after)},
+            )
+
+
+class ConcurrencyLimiter(object):
+    """ConcurrencyLimiter caps the number of jobs a subscription has
+    accepted but not yet processed, so that one customer cannot take all
+    worker capacity of an application.
+    """
+
+    rejected_counter = Counter(
+        "api_concurrency_rejected_total",
+        "Submissions rejected because too many jobs were in flight",
+        ["api", "tier"],
+    )
+
+    def __init__(self, redis, settings: Optional[AdmissionSettings] = None):
+        self.redis = redis
+        self.settings = settings or AdmissionSettings()
+        self.acquire_script = self.redis.register_script(ACQUIRE_SCRIPT)
+
+    @staticmethod
+    def make_key(subscription_id: int) -> str:
+        return f"inflight:{subscription_id}"
+
+    def acquire(
+        self, application: str, subscription_id: int, tier: str, key: str
+    ) -> None:
+        limit = self.settings.concurrency_limits.get(tier)
+        if limit is None:
+            return
+
+        acquired = self.acquire_script(
+            keys=[self.make_key(subscription_id)],
+            args=[time.time(), self.settings.concurrency_timeout, limit, key],
+        )
+        if not acquired:
+            self.rejected_counter.labels(api=application, tier=tier).inc()
+            raise HTTPException(
+                HTTP_429_TOO_MANY_REQUESTS,
+                "Too many requests in progress, please retry later",
+                headers={"Retry-After": str(self.settings.concurrency_retry_after)},
+            )
+
+    def release(self, subscription_id: int, key: str, pipeline=None) -> None:
+        (pipeline or self.redis).zrem(self.make_key(subscription_id), key)
+
+    def in_flight(self, subscription_id: int) -> int:
+        return self.redis.zcard(self.make_key(subscription_id))
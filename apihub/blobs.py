@@ -0,0 +1,158 @@
+import os
+import abc
+import time
+import shutil
+import tempfile
+from typing import BinaryIO, Iterator, Optional
+from urllib.parse import quote
+
+from pydantic import BaseSettings, Field
+
+try:
+    import boto3
+except ImportError:  # pragma: no cover
+    boto3 = None
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class BlobSettings(BaseSettings):
+    result_blob_store: Optional[str] = Field(
+        None, title="where oversized results are stored: file or s3, none if unset"
+    )
+    result_blob_threshold: int = Field(
+        1024 * 1024, title="results larger than this many bytes are stored as blobs"
+    )
+    result_blob_path: str = Field(
+        "/var/lib/apihub/blobs", title="directory of the file blob store"
+    )
+    result_blob_bucket: Optional[str] = Field(None, title="bucket of the s3 blob store")
+    result_blob_endpoint: Optional[str] = Field(
+        None, title="endpoint of an s3 compatible blob store, AWS if unset"
+    )
+    result_blob_purge_interval: float = Field(
+        3600.0, title="seconds between two deletions of blobs of expired results"
+    )
+
+
+class BlobStore(abc.ABC):
+    """BlobStore keeps payloads too large for Redis, by name"""
+
+    @abc.abstractmethod
+    def put(self, name: str, data: bytes) -> None:
+        pass
+
+    def put_file(self, name: str, f: BinaryIO) -> None:
+        """store the rest of a file, stores should copy it in chunks"""
+        self.put(name, f.read())
+
+    @abc.abstractmethod
+    def open(self, name: str) -> Iterator[bytes]:
+        """chunks of a blob, raise KeyError if it does not exist"""
+
+    @abc.abstractmethod
+    def delete(self, name: str) -> None:
+        pass
+
+    def purge(self, max_age: int) -> int:
+        """delete blobs older than `max_age` seconds, return number deleted"""
+        return 0
+
+
+class FileBlobStore(BlobStore):
+    """FileBlobStore keeps blobs as files of a directory, e.g. a shared volume"""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def filename(self, name: str) -> str:
+        return os.path.join(self.path, quote(name, safe=""))
+
+    def put(self, name: str, data: bytes) -> None:
+        # readers never see a partially written blob
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self.filename(name))
+
+    def put_file(self, name: str, f: BinaryIO) -> None:
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".")
+        with os.fdopen(fd, "wb") as out:
+            shutil.copyfileobj(f, out, CHUNK_SIZE)
+        os.replace(tmp, self.filename(name))
+
+    def open(self, name: str) -> Iterator[bytes]:
+        try:
+            f = open(self.filename(name), "rb")
+        except FileNotFoundError:
+            raise KeyError(name) from None
+
+        def chunks():
+            with f:
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+
+        return chunks()
+
+    def delete(self, name: str) -> None:
+        try:
+            os.remove(self.filename(name))
+        except FileNotFoundError:
+            pass
+
+    def purge(self, max_age: int) -> int:
+        deleted = 0
+        oldest = time.time() - max_age
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.stat().st_mtime < oldest:
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        # purged by another writer
+                        continue
+                    deleted += 1
+        return deleted
+
+
+class S3BlobStore(BlobStore):
+    """S3BlobStore keeps blobs as objects of a bucket. Old blobs are expected
+    to be removed by a lifecycle rule of the bucket."""
+
+    def __init__(self, bucket: str, endpoint: Optional[str] = None):
+        if boto3 is None:
+            raise ValueError("boto3 is required by the s3 blob store")
+        self.bucket = bucket
+        self.client = boto3.client("s3", endpoint_url=endpoint)
+
+    def put(self, name: str, data: bytes) -> None:
+        self.client.put_object(Bucket=self.bucket, Key=name, Body=data)
+
+    def put_file(self, name: str, f: BinaryIO) -> None:
+        # uploaded in parts for large files
+        self.client.upload_fileobj(f, self.bucket, name)
+
+    def open(self, name: str) -> Iterator[bytes]:
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=name)
+        except self.client.exceptions.NoSuchKey:
+            raise KeyError(name) from None
+        return response["Body"].iter_chunks(CHUNK_SIZE)
+
+    def delete(self, name: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=name)
+
+
+def make_blob_store(settings: BlobSettings) -> Optional[BlobStore]:
+    if settings.result_blob_store is None:
+        return None
+    elif settings.result_blob_store == "file":
+        return FileBlobStore(settings.result_blob_path)
+    elif settings.result_blob_store == "s3":
+        return S3BlobStore(settings.result_blob_bucket, settings.result_blob_endpoint)
+    raise ValueError(f"unknown blob store {settings.result_blob_store}")
@@ -0,0 +1,290 @@
+import json
+import re
+import time
+import zlib
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+import orjson
+import zstandard
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseSettings, Field
+from prometheus_client import Counter, Histogram
+from starlette.concurrency import run_in_threadpool
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+IDENTITY = "identity"
+CHUNK_SIZE = 64 * 1024
+# key of an input schema giving the maximum body size of its application
+MAX_BODY_SIZE_KEY = "x-max-body-size"
+
+
+class RequestBodySettings(BaseSettings):
+    request_body_max_size: int = Field(
+        16 * 1024 * 1024,
+        title="maximum bytes of a request body once decompressed, larger "
+        "bodies are rejected with 413",
+    )
+    request_body_max_bytes: int = Field(
+        128 * 1024 * 1024,
+        title="maximum bytes of a request body as sent, compressed or not, "
+        "for applications without a limit of their own",
+    )
+    request_body_max_bytes_per_app: Dict[str, int] = Field(
+        {},
+        title="maximum bytes of a request body as sent, per application, "
+        "overriding the limit of its definition",
+    )
+    request_body_limit_cache_ttl: float = Field(
+        60.0, title="seconds the limit of an application is cached"
+    )
+
+
+def _decompress_gzip(data: bytes, limit: int) -> bytes:
+    # gzip and zlib headers are both accepted, as browsers send either for
+    # "deflate"
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 32)
+    decompressed = decompressor.decompress(data, limit + 1)
+    if len(decompressed) > limit:
+        raise HTTPException(413, "Request body is too large once decompressed")
+    if not decompressor.eof:
+        raise HTTPException(400, "Request body is truncated")
+    return decompressed
+
+
+def _decompress_zstd(data: bytes, limit: int) -> bytes:
+    chunks = []
+    size = 0
+    with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+        while True:
+            chunk = reader.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > limit:
+                raise HTTPException(413, "Request body is too large once decompressed")
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def decompress_body(
+    data: bytes, encoding: Optional[str], settings: RequestBodySettings
+) -> bytes:
+    """decode a body sent with Content-Encoding, never decompressing more
+    than `request_body_max_size` bytes so that small bombs stay harmless"""
+    limit = settings.request_body_max_size
+    encoding = (encoding or IDENTITY).strip().lower()
+    try:
+        if encoding == IDENTITY:
+            decompressed = data
+        elif encoding in ("gzip", "x-gzip", "deflate"):
+            decompressed = _decompress_gzip(data, limit)
+        elif encoding == "zstd":
+            decompressed = _decompress_zstd(data, limit)
+        else:
+            raise HTTPException(415, f"Content-Encoding {encoding} is not supported")
+    except (zlib.error, zstandard.ZstdError):
+        raise HTTPException(400, f"Request body is not valid {encoding}")
+
+    if len(decompressed) > limit:
+        raise HTTPException(413, "Request body is too large")
+    return decompressed
+
+
+def is_json(value: Any) -> bool:
+    """whether a value holds only what JSON can hold"""
+    if value is None or isinstance(value, (str, int, float)):
+        return True
+    if isinstance(value, dict):
+        return all(isinstance(k, str) and is_json(v) for k, v in value.items())
+    if isinstance(value, list):
+        return all(is_json(item) for item in value)
+    return False
+
+
+def parse_body(data: bytes, content_type: Optional[str]) -> Dict[str, Any]:
+    """parse a JSON or msgpack body into a dict"""
+    media_type = (content_type or JSON_MEDIA_TYPE).split(";")[0].strip().lower()
+    if media_type in MSGPACK_MEDIA_TYPES:
+        if msgpack is None:
+            raise HTTPException(415, f"{media_type} is not supported")
+        try:
+            dct = msgpack.unpackb(data)
+        except (ValueError, TypeError, msgpack.UnpackException):
+            raise HTTPException(400, "Request body is not valid msgpack")
+        # inputs are passed on as JSON, binary and extension values are not
+        if not is_json(dct):
+            raise HTTPException(400, "Request body holds values JSON cannot hold")
+    else:
+        # bodies were always parsed as JSON, whatever their media type
+        try:
+            dct = orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson rejects what json accepts: integers beyond 64 bits, NaN
+            try:
+                dct = json.loads(data)
+            except ValueError:
+                raise HTTPException(400, "Request body is not valid JSON")
+
+    if not isinstance(dct, dict):
+        raise HTTPException(422, "Request body must be an object")
+    return dct
+
+
+def decode_body(
+    data: bytes,
+    content_type: Optional[str],
+    encoding: Optional[str],
+    settings: RequestBodySettings,
+) -> Dict[str, Any]:
+    """input of a request from its body, empty if there is none"""
+    if not data:
+        return {}
+    return parse_body(decompress_body(data, encoding, settings), content_type)
+
+
+class BodyTooLarge(HTTPException):
+    def __init__(self, limit: int):
+        super().__init__(413, f"Request body is larger than {limit} bytes")
+
+
+class RequestBodyLimits(object):
+    """RequestBodyLimits gives the maximum body size of requests to an
+    application: from settings, else from the `x-max-body-size` key of the
+    input schema of its definition, else the default of settings. Bodies
+    other than multipart are decoded whole, so they are also held to
+    `request_body_max_size`.
+
+    Definitions are read from Redis in a thread, not to block the event
+    loop, and limits are cached for `request_body_limit_cache_ttl` seconds.
+    """
+
+    def __init__(self, definitions, settings: Optional[RequestBodySettings] = None):
+        self.definitions = definitions
+        self.settings = settings or RequestBodySettings()
+        # limit and time it was looked up, by application
+        self.cache: Dict[str, Tuple[int, float]] = {}
+
+    def lookup(self, application: str) -> int:
+        if application in self.settings.request_body_max_bytes_per_app:
+            return self.settings.request_body_max_bytes_per_app[application]
+        try:
+            schema = self.definitions.get(application).input_schema
+        except Exception:
+            # unknown application, rejected later by the endpoint
+            schema = {}
+        return schema.get(MAX_BODY_SIZE_KEY, self.settings.request_body_max_bytes)
+
+    async def __call__(self, application: str, multipart: bool = False) -> int:
+        cached = self.cache.get(application)
+        if (
+            cached is not None
+            and time.time() - cached[1] < self.settings.request_body_limit_cache_ttl
+        ):
+            limit = cached[0]
+        else:
+            limit = await run_in_threadpool(self.lookup, application)
+            self.cache[application] = (limit, time.time())
+        if multipart:
+            return limit
+        return min(limit, self.settings.request_body_max_size)
+
+
+class BodySizeLimit(object):
+    """ASGI middleware rejecting requests to POST /async/{application} whose
+    body is larger than the limit of the application with 413. Requests
+    declaring a larger Content-Length are rejected before their body is
+    read, others once the limit is crossed while their body arrives, before
+    anything buffers it entirely. It should wrap all middlewares reading
+    the body.
+    """
+
+    path = re.compile(r"^/async/([^/]+)$")
+
+    rejected_counter = Counter(
+        "api_request_body_rejected_total",
+        "Requests rejected for the size of their body",
+        ["api"],
+    )
+    rejected_size = Histogram(
+        "api_request_body_rejected_bytes",
+        "Size of bodies rejected, declared or received until rejection",
+        ["api"],
+        buckets=[2 ** i for i in range(16, 34, 2)],
+    )
+
+    def __init__(self, app, limits: Callable[[str, bool], Awaitable[int]]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        match = self.path.match(scope["path"]) if scope["type"] == "http" else None
+        if match is None or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+
+        application = match.group(1)
+        headers = dict(scope["headers"])
+        content_type = headers.get(b"content-type", b"").lower()
+        multipart = content_type.startswith(b"multipart/")
+        limit = await self.limits(application, multipart)
+
+        if b"content-length" in headers:
+            try:
+                declared = int(headers[b"content-length"])
+            except ValueError:
+                declared = 0
+            if declared > limit:
+                self.reject(application, declared)
+                await self.send_error(BodyTooLarge(limit), scope, receive, send)
+                return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    self.reject(application, received)
+                    raise BodyTooLarge(limit)
+            return message
+
+        started = False
+
+        async def tracked_send(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, tracked_send)
+        except BodyTooLarge as e:
+            # raised outside of the endpoint, e.g. by a middleware buffering
+            # the body
+            if started:
+                raise
+            await self.send_error(e, scope, receive, send)
+
+    def reject(self, application: str, size: int) -> None:
+        self.rejected_counter.labels(api=application).inc()
+        self.rejected_size.labels(api=application).observe(size)
+
+    @staticmethod
+    async def send_error(error: HTTPException, scope, receive, send) -> None:
+        response = JSONResponse(
+            {"detail": error.detail},
+            status_code=error.status_code,
+            # the rest of the body is not read
+            headers={"Connection": "close"},
+        )
+        await response(scope, receive, send)
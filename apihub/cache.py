@@ -0,0 +1,115 @@
+import time
+from typing import Dict, Optional, Tuple
+
+from pydantic import BaseSettings, Field
+from prometheus_client import Counter
+
+from .activity.schemas import ActivityStatus
+from .codec import ResultCodec
+from .utils import Result
+
+
+class ResultCacheSettings(BaseSettings):
+    result_cache_ttl: Dict[str, int] = Field(
+        {},
+        title="seconds to keep cached results per application, "
+        "applications not listed are not cached",
+    )
+    result_cache_max_entries: int = Field(
+        10000, title="maximum number of cached results per application"
+    )
+
+
+class ResultCache(object):
+    """ResultCache maps the input hash of a request to the key of the
+    request which computed it, so that identical inputs are not sent to
+    workers again.
+    """
+
+    cache_counter = Counter(
+        "api_result_cache_total",
+        "Result cache lookups",
+        ["api", "outcome"],
+    )
+
+    def __init__(
+        self,
+        redis,
+        settings: Optional[ResultCacheSettings] = None,
+        codec: Optional[ResultCodec] = None,
+    ):
+        self.redis = redis
+        self.settings = settings or ResultCacheSettings()
+        self.codec = codec or ResultCodec()
+
+    @staticmethod
+    def make_entry(application: str, input_hash: str) -> str:
+        return f"cache:{application}:{input_hash}"
+
+    @staticmethod
+    def make_index(application: str) -> str:
+        return f"cache:{application}"
+
+    def enabled(self, application: str) -> bool:
+        return application in self.settings.result_cache_ttl
+
+    def get(self, application: str, input_hash: str) -> Optional[Tuple[str, Result]]:
+        """return key and result of a previous request with the same input,
+        the result is either processed or still in flight"""
+        entry = self.make_entry(application, input_hash)
+        key = self.redis.get(entry)
+        result = self.redis.get(key) if key is not None else None
+
+        if result is not None and ResultCodec.status(result) in (
+            ActivityStatus.ACCEPTED,
+            ActivityStatus.PROCESSED,
+        ):
+            try:
+                result = self.codec.decode(result)
+            except KeyError:
+                # its blob was purged
+                result = None
+            if result is not None:
+                self.cache_counter.labels(api=application, outcome="hit").inc()
+                return key.decode("utf-8"), result
+
+        if key is not None:
+            # result expired or failed, do not serve it again
+            self.redis.delete(entry)
+            self.redis.zrem(self.make_index(application), input_hash)
+
+        self.cache_counter.labels(api=application, outcome="miss").inc()
+        return None
+
+    def add(
+        self,
+        application: str,
+        input_hash: str,
+        key: str,
+        accepted: Result,
+        result_ttl: int,
+    ) -> None:
+        """cache key for an input, along with the acceptance of its request.
+        The result writer stores the acceptance later, an identical request
+        must not find the entry before it and take the result as expired."""
+        ttl = self.settings.result_cache_ttl[application]
+        index = self.make_index(application)
+        now = time.time()
+
+        p = self.redis.pipeline()
+        p.set(key, self.codec.encode(accepted, key), ex=result_ttl, nx=True)
+        p.set(self.make_entry(application, input_hash), key, ex=ttl)
+        p.zadd(index, {input_hash: now})
+        # entries expired by ttl are dropped from the index
+        p.zremrangebyscore(index, "-inf", now - ttl)
+        p.zcard(index)
+        size = p.execute()[-1]
+
+        excess = size - self.settings.result_cache_max_entries
+        if excess > 0:
+            evicted = [
+                self.make_entry(application, input_hash.decode("utf-8"))
+                for input_hash, _ in self.redis.zpopmin(index, excess)
+            ]
+            self.redis.delete(*evicted)
+            self.cache_counter.labels(api=application, outcome="evicted").inc(excess)
@@ -0,0 +1,75 @@
+import time
+from typing import Optional
+
+from pydantic import BaseSettings, Field
+
+from .activity.schemas import ActivityStatus
+from .codec import ResultCodec
+from .utils import Result
+
+
+# replace a result only if it did not change since it was read, and record
+# its key in the cancelled set of the application unless its job is still to
+# be processed (ARGV[5] == '1'), forgetting old entries
+CANCEL_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'KEEPTTL')
+if ARGV[5] ~= '1' then
+    redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[3] - ARGV[4])
+return 1
+"""
+
+
+class CancellationSettings(BaseSettings):
+    cancellation_window: int = Field(
+        86400, title="seconds a cancelled key is remembered for workers"
+    )
+
+
+class Cancellations(object):
+    """Cancellations marks accepted jobs as CANCELLED and keeps the keys of
+    cancelled jobs in a set per application, which workers check before
+    processing a job.
+    """
+
+    def __init__(self, redis, settings: Optional[CancellationSettings] = None):
+        self.redis = redis
+        self.settings = settings or CancellationSettings()
+        self.cancel_script = self.redis.register_script(CANCEL_SCRIPT)
+
+    @staticmethod
+    def make_key(application: str) -> str:
+        return f"cancelled:{application}"
+
+    def cancel(
+        self, application: str, key: str, raw: bytes, keep_job: bool = False
+    ) -> bool:
+        """cancel a job given its stored result, return False if the result
+        is not ACCEPTED or changed in the meantime. With `keep_job`, only the
+        result is cancelled and workers still process the job, for requests
+        coalesced with it."""
+        if ResultCodec.status(raw) != ActivityStatus.ACCEPTED:
+            return False
+
+        result = Result.parse_raw(raw)
+
+        result.status = ActivityStatus.CANCELLED
+        return bool(
+            self.cancel_script(
+                keys=[key, self.make_key(application)],
+                args=[
+                    raw,
+                    result.json(),
+                    time.time(),
+                    self.settings.cancellation_window,
+                    int(keep_job),
+                ],
+            )
+        )
+
+    def cancelled(self, application: str, key: str) -> bool:
+        return self.redis.zscore(self.make_key(application), key) is not None
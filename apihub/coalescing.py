@@ -0,0 +1,163 @@
+from typing import Dict, List, Optional
+
+from pydantic import BaseSettings, Field
+from prometheus_client import Counter
+
+
+# register key as the pending job for an input, or attach it to the pending job
+# ARGV[4], expected to be the pending job. Returns 0 if another job is pending.
+# Attached requests are kept for ARGV[5] seconds, as long as the job may run.
+ATTACH_SCRIPT = """
+local leader = redis.call('GET', KEYS[1]) or ''
+if leader ~= ARGV[4] then
+    return 0
+end
+if leader ~= '' then
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[5])
+    return leader
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+return false
+"""
+
+# release the pending job and return the keys attached to it
+COMPLETE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+local aliases = redis.call('HGETALL', KEYS[2])
+redis.call('DEL', KEYS[2])
+return aliases
+"""
+
+# release the pending job of a cancelled request, unless requests are attached
+# to it. Returns 1 if there are, the job is then still to be processed.
+CANCEL_SCRIPT = """
+if redis.call('HLEN', KEYS[2]) > 0 then
+    return 1
+end
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class RequestCoalescingSettings(BaseSettings):
+    request_coalescing_applications: List[str] = Field(
+        [], title="applications whose identical in-flight requests are coalesced"
+    )
+    request_coalescing_timeout: int = Field(
+        600, title="seconds a pending job accepts identical requests"
+    )
+
+
+class RequestCoalescer(object):
+    """RequestCoalescer makes identical requests submitted while a job for the
+    same input is pending share that job. Each request keeps its own key,
+    which is registered as an alias of the pending job's key.
+
+    Keys of the requests for an input share a hash tag, for scripts to run
+    on Redis Cluster. The pending job maps its key to that input, as results
+    only carry their key.
+
+    A cancelled job whose requests are attached to it is still processed for
+    them, only the request that was cancelled gets a CANCELLED result.
+    """
+
+    coalesced_counter = Counter(
+        "api_coalesced_requests_total",
+        "Requests attached to an identical pending job",
+        ["api"],
+    )
+
+    def __init__(self, redis, settings: Optional[RequestCoalescingSettings] = None):
+        self.redis = redis
+        self.settings = settings or RequestCoalescingSettings()
+        self.attach_script = self.redis.register_script(ATTACH_SCRIPT)
+        self.complete_script = self.redis.register_script(COMPLETE_SCRIPT)
+        self.cancel_script = self.redis.register_script(CANCEL_SCRIPT)
+
+    @staticmethod
+    def make_group(application: str, input_hash: str) -> str:
+        return f"coalescing:{{{application}:{input_hash}}}"
+
+    @classmethod
+    def make_pending(cls, application: str, input_hash: str) -> str:
+        return cls.make_group(application, input_hash) + ":pending"
+
+    @staticmethod
+    def make_aliases(group: str, key: str) -> str:
+        return f"{group}:aliases:{key}"
+
+    @staticmethod
+    def make_leader(key: str) -> str:
+        return f"coalescing:leader:{key}"
+
+    def enabled(self, application: str) -> bool:
+        return application in self.settings.request_coalescing_applications
+
+    def attach(
+        self,
+        application: str,
+        input_hash: str,
+        key: str,
+        email: str,
+        ttl: Optional[int] = None,
+    ) -> Optional[str]:
+        """return the key of the pending job the request is attached to, or
+        None if the request becomes the pending job itself. The job keeps
+        its attached requests for `ttl` seconds, the result ttl of the
+        application, however long it runs."""
+        group = self.make_group(application, input_hash)
+        pending = self.make_pending(application, input_hash)
+        timeout = self.settings.request_coalescing_timeout
+        ttl = max(ttl or 0, timeout)
+        while True:
+            expected = self.redis.get(pending)
+            expected = "" if expected is None else expected.decode("utf-8")
+            leader = self.attach_script(
+                keys=[pending, self.make_aliases(group, expected or key)],
+                args=[key, email, timeout, expected, ttl],
+            )
+            if leader != 0:
+                break
+
+        if leader is None:
+            self.redis.set(self.make_leader(key), group, ex=ttl)
+            return None
+
+        self.coalesced_counter.labels(api=application).inc()
+        return leader.decode("utf-8")
+
+    def complete(self, key: str) -> Dict[str, str]:
+        """release the pending job of key, return its aliases with the email
+        of their users"""
+        group = self.redis.get(self.make_leader(key))
+        if group is None:
+            return {}
+        group = group.decode("utf-8")
+        flat = self.complete_script(
+            keys=[group + ":pending", self.make_aliases(group, key)], args=[key]
+        )
+        self.redis.delete(self.make_leader(key))
+        return {
+            flat[i].decode("utf-8"): flat[i + 1].decode("utf-8")
+            for i in range(0, len(flat), 2)
+        }
+
+    def cancel(self, key: str) -> bool:
+        """stop a cancelled pending job from accepting identical requests,
+        unless requests are attached to it: returns True, the job is then
+        still processed for them and completed once its result arrives"""
+        group = self.redis.get(self.make_leader(key))
+        if group is None:
+            return False
+        group = group.decode("utf-8")
+        if self.cancel_script(
+            keys=[group + ":pending", self.make_aliases(group, key)], args=[key]
+        ):
+            return True
+        self.redis.delete(self.make_leader(key))
+        return False
@@ -0,0 +1,229 @@
+import gzip
+import json
+import uuid
+import zlib
+from typing import Iterator, Optional, Tuple
+
+import zstandard
+from pydantic import BaseSettings, Field
+
+from .activity.schemas import ActivityStatus
+from .blobs import BlobSettings, make_blob_store
+from .utils import Result
+
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+
+# results stored as plain JSON start with "{", compressed results start with
+# a header byte naming their codec, results kept in the blob store are a
+# pointer starting with "B"
+JSON_HEADER = b"{"
+BLOB_HEADER = b"B"
+CODEC_HEADERS = {
+    "zlib": b"z",
+    "gzip": b"g",
+    "zstd": b"Z",
+    "lz4": b"L",
+}
+NONE = "none"
+
+
+class CodecSettings(BaseSettings):
+    result_compression: str = Field(
+        NONE, title="codec of stored results: none, zlib, gzip, zstd or lz4"
+    )
+    result_compression_threshold: int = Field(
+        1024, title="results smaller than this many bytes are stored uncompressed"
+    )
+
+
+def compress(codec: str, data: bytes) -> bytes:
+    if codec == "zlib":
+        return zlib.compress(data)
+    elif codec == "gzip":
+        return gzip.compress(data, mtime=0)
+    elif codec == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    elif codec == "lz4":
+        return lz4.frame.compress(data)
+    raise ValueError(f"unknown codec {codec}")
+
+
+def decompress(header: bytes, data: bytes) -> bytes:
+    if header == CODEC_HEADERS["zlib"]:
+        return zlib.decompress(data)
+    elif header == CODEC_HEADERS["gzip"]:
+        return gzip.decompress(data)
+    elif header == CODEC_HEADERS["zstd"]:
+        return zstandard.ZstdDecompressor().decompress(data)
+    elif header == CODEC_HEADERS["lz4"]:
+        if lz4 is None:
+            raise ValueError("result is compressed with lz4, which is not installed")
+        return lz4.frame.decompress(data)
+    raise ValueError(f"unknown codec header {header!r}")
+
+
+def decompress_chunks(header: bytes, chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """decompress data arriving in chunks, without holding all of it"""
+    if header == JSON_HEADER:
+        yield header
+        yield from chunks
+        return
+
+    if header == CODEC_HEADERS["zlib"]:
+        decompressor = zlib.decompressobj()
+    elif header == CODEC_HEADERS["gzip"]:
+        decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    elif header == CODEC_HEADERS["zstd"]:
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    elif header == CODEC_HEADERS["lz4"]:
+        if lz4 is None:
+            raise ValueError("result is compressed with lz4, which is not installed")
+        decompressor = lz4.frame.LZ4FrameDecompressor()
+    else:
+        raise ValueError(f"unknown codec header {header!r}")
+
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    if hasattr(decompressor, "flush"):
+        data = decompressor.flush()
+        if data:
+            yield data
+
+
+class ResultCodec(object):
+    """ResultCodec converts results to the bytes stored in Redis and back.
+    Processed results larger than a threshold are compressed and prefixed
+    with a header byte naming the codec. Other results are kept as JSON, so
+    that scripts can read their status and entries written before compression
+    was introduced still read.
+
+    With a blob store configured, processed results still larger than
+    RESULT_BLOB_THRESHOLD once compressed are written to the blob store, and
+    only a pointer to the blob is kept in Redis.
+
+    Compression is off by default, as servers predating it cannot read
+    compressed results. It is turned on in two phases: deploy this version
+    everywhere, then set RESULT_COMPRESSION.
+
+    >>> settings = CodecSettings(
+    ...     result_compression="gzip", result_compression_threshold=0
+    ... )
+    >>> codec = ResultCodec(settings)
+    >>> result = Result(user="user", api="test", status=ActivityStatus.PROCESSED)
+    >>> stored = codec.encode(result)
+    >>> stored[:1]
+    b'g'
+    >>> codec.decode(stored) == result
+    True
+    """
+
+    def __init__(
+        self,
+        settings: Optional[CodecSettings] = None,
+        blob_settings: Optional[BlobSettings] = None,
+    ):
+        self.settings = settings or CodecSettings()
+        self.blob_settings = blob_settings or BlobSettings()
+        self.blobs = make_blob_store(self.blob_settings)
+        codec = self.settings.result_compression
+        if codec != NONE and codec not in CODEC_HEADERS:
+            raise ValueError(f"unknown codec {codec}")
+        if codec == "lz4" and lz4 is None:
+            raise ValueError("lz4 is not installed")
+
+    def encode(self, result: Result, key: Optional[str] = None) -> bytes:
+        """bytes to store for a result, those of large results of `key` are
+        moved to the blob store"""
+        data = result.json().encode("utf-8")
+        codec = self.settings.result_compression
+        if (
+            codec == NONE
+            or result.status != ActivityStatus.PROCESSED
+            or len(data) < self.settings.result_compression_threshold
+        ):
+            stored = data
+        else:
+            stored = CODEC_HEADERS[codec] + compress(codec, data)
+
+        if (
+            self.blobs is None
+            or key is None
+            or result.status != ActivityStatus.PROCESSED
+            or len(stored) <= self.blob_settings.result_blob_threshold
+        ):
+            return stored
+
+        # a blob is never overwritten, a result written twice may be read
+        # while being replaced
+        name = f"{key}.{uuid.uuid4().hex}"
+        self.blobs.put(name, stored)
+        pointer = {"name": name, "size": len(stored)}
+        return BLOB_HEADER + json.dumps(pointer).encode("utf-8")
+
+    @staticmethod
+    def blob(stored: bytes) -> Optional[str]:
+        """name of the blob holding a stored result, if it is in the blob
+        store"""
+        if stored[:1] == BLOB_HEADER:
+            return json.loads(stored[1:])["name"]
+        return None
+
+    def open(self, stored: bytes) -> Tuple[bytes, Iterator[bytes]]:
+        """header byte and chunks of the rest of a stored result, read from
+        the blob store if needed. Raise KeyError if its blob is gone."""
+        name = self.blob(stored)
+        if name is None:
+            chunks = iter([stored])
+        elif self.blobs is None:
+            raise ValueError("result is in the blob store, which is not configured")
+        else:
+            chunks = self.blobs.open(name)
+
+        first = next(chunks, b"")
+        header = first[:1]
+        return header, _prepend(first[1:], chunks)
+
+    def stream(self, stored: bytes) -> Iterator[bytes]:
+        """JSON of a stored result in chunks, without reading all of a blob
+        at once"""
+        return decompress_chunks(*self.open(stored))
+
+    def decompress(self, stored: bytes) -> bytes:
+        """JSON of a stored result"""
+        if stored[:1] == BLOB_HEADER:
+            header, chunks = self.open(stored)
+            stored = header + b"".join(chunks)
+        if stored[:1] == JSON_HEADER:
+            return stored
+        return decompress(stored[:1], stored[1:])
+
+    def decode(self, stored: bytes) -> Result:
+        return Result.parse_raw(self.decompress(stored))
+
+    @staticmethod
+    def status(stored: bytes) -> ActivityStatus:
+        """status of a stored result, without decompressing it"""
+        if stored[:1] != JSON_HEADER:
+            # only processed results are compressed
+            return ActivityStatus.PROCESSED
+        return Result.parse_raw(stored).status
+
+    @staticmethod
+    def gzipped(stored: bytes) -> Optional[bytes]:
+        """gzip member holding the JSON of a stored result, if it is stored
+        with gzip"""
+        if stored[:1] == CODEC_HEADERS["gzip"]:
+            return stored[1:]
+        return None
+
+
+def _prepend(chunk: bytes, chunks: Iterator[bytes]) -> Iterator[bytes]:
+    if chunk:
+        yield chunk
+    yield from chunks
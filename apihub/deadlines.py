@@ -0,0 +1,40 @@
+import time
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+from pydantic import BaseSettings, Field
+
+
+DEADLINE_HEADER = "X-Request-Timeout"
+
+
+class DeadlineSettings(BaseSettings):
+    job_timeouts: Dict[str, int] = Field(
+        {},
+        title="default seconds a job of an application may wait before it is "
+        "skipped, applications not listed have no deadline",
+    )
+
+
+def make_deadline(
+    application: str, timeout: Optional[str], settings: DeadlineSettings
+) -> Optional[float]:
+    """deadline in seconds since epoch, from the timeout requested by the
+    client or the default of the application"""
+    if timeout is not None:
+        try:
+            seconds = float(timeout)
+        except ValueError:
+            raise HTTPException(422, f"{DEADLINE_HEADER} must be a number of seconds")
+        if seconds <= 0:
+            raise HTTPException(422, f"{DEADLINE_HEADER} must be positive")
+    elif application in settings.job_timeouts:
+        seconds = settings.job_timeouts[application]
+    else:
+        return None
+
+    return time.time() + seconds
+
+
+def expired(deadline: Optional[float]) -> bool:
+    return deadline is not None and deadline < time.time()
@@ -0,0 +1,226 @@
+import time
+import logging
+from typing import Dict, List, Optional, Set, Tuple
+
+from pydantic import BaseSettings, Field
+from prometheus_client import Counter, Gauge, start_http_server
+from pipeline import Message, deserialize_message
+
+from .scheduling import TierRouter
+from .utils import State
+
+
+# queue a job of a user, adding the user to the ring if it was idle
+PUSH_SCRIPT = """
+redis.call('RPUSH', KEYS[1] .. ':' .. ARGV[1], ARGV[2])
+redis.call('INCR', KEYS[1] .. ':length')
+if redis.call('SADD', KEYS[1] .. ':active', ARGV[1]) == 1 then
+    redis.call('RPUSH', KEYS[1] .. ':ring', ARGV[1])
+end
+"""
+
+# take one job of the next user in the ring, users with jobs left go to the back.
+# Dispatched jobs per user are counted over windows of ARGV[1] seconds.
+POP_SCRIPT = """
+local user = redis.call('LPOP', KEYS[1] .. ':ring')
+while user do
+    local queue = KEYS[1] .. ':' .. user
+    local job = redis.call('LPOP', queue)
+    if redis.call('LLEN', queue) > 0 then
+        redis.call('RPUSH', KEYS[1] .. ':ring', user)
+    else
+        redis.call('SREM', KEYS[1] .. ':active', user)
+    end
+    if job then
+        redis.call('DECR', KEYS[1] .. ':length')
+        redis.call('HINCRBY', KEYS[1] .. ':dispatched', user, 1)
+        if redis.call('TTL', KEYS[1] .. ':dispatched') < 0 then
+            redis.call('EXPIRE', KEYS[1] .. ':dispatched', ARGV[1])
+        end
+        return {user, job}
+    end
+    user = redis.call('LPOP', KEYS[1] .. ':ring')
+end
+return false
+"""
+
+
+class FairQueueSettings(BaseSettings):
+    fair_queueing_applications: List[str] = Field(
+        [], title="applications whose jobs are queued per user before dispatching"
+    )
+    fair_queueing_dispatch_depth: int = Field(
+        10, title="number of jobs kept in a worker topic by the dispatcher"
+    )
+    fair_queueing_idle_interval: float = Field(
+        0.05, title="seconds the dispatcher sleeps when there is nothing to do"
+    )
+    fair_queueing_shares_window: int = Field(
+        3600, title="seconds over which the jobs dispatched per user are counted"
+    )
+    fair_queueing_metrics_port: int = Field(
+        8001, title="port on which the dispatcher exposes its metrics"
+    )
+
+
+class FairQueue(object):
+    """FairQueue keeps one virtual queue per user in front of a worker topic.
+    Jobs are taken from the users in round robin, so a user submitting many
+    jobs only delays its own jobs.
+    """
+
+    def __init__(self, redis, settings: Optional[FairQueueSettings] = None):
+        self.redis = redis
+        self.settings = settings or FairQueueSettings()
+        self.push_script = self.redis.register_script(PUSH_SCRIPT)
+        self.pop_script = self.redis.register_script(POP_SCRIPT)
+
+    @staticmethod
+    def make_prefix(topic: str) -> str:
+        return f"fairq:{topic}"
+
+    def enabled(self, application: str) -> bool:
+        return application in self.settings.fair_queueing_applications
+
+    def push(self, topic: str, user: str, message: Message) -> None:
+        self.push_script(
+            keys=[self.make_prefix(topic)], args=[user, message.serialize()]
+        )
+
+    def pop(self, topic: str) -> Optional[Tuple[str, Message]]:
+        popped = self.pop_script(
+            keys=[self.make_prefix(topic)],
+            args=[self.settings.fair_queueing_shares_window],
+        )
+        if not popped:
+            return None
+        user, job = popped
+        return user.decode("utf-8"), deserialize_message(job)
+
+    def length(self, topic: str) -> int:
+        length = self.redis.get(f"{self.make_prefix(topic)}:length")
+        return int(length) if length is not None else 0
+
+    def users(self, topic: str) -> int:
+        return self.redis.scard(f"{self.make_prefix(topic)}:active")
+
+    def shares(self, topic: str) -> Dict[str, int]:
+        """number of jobs dispatched per user in the current window"""
+        return {
+            user.decode("utf-8"): int(count)
+            for user, count in self.redis.hgetall(
+                f"{self.make_prefix(topic)}:dispatched"
+            ).items()
+        }
+
+
+class FairQueueDispatcher(object):
+    """FairQueueDispatcher moves jobs from the fair queues to the worker
+    topics, keeping only a few jobs in each worker topic so that the order
+    of service is decided by the fair queue.
+    """
+
+    dispatched_counter = Counter(
+        "api_fair_queue_dispatched_total",
+        "Jobs moved from fair queues to worker topics",
+        ["api"],
+    )
+    pending_gauge = Gauge(
+        "api_fair_queue_pending",
+        "Jobs waiting in fair queues",
+        ["api"],
+    )
+    users_gauge = Gauge(
+        "api_fair_queue_users",
+        "Users with jobs waiting in fair queues",
+        ["api"],
+    )
+    shares_gauge = Gauge(
+        "api_fair_queue_dispatched_window",
+        "Jobs dispatched per user over the shares window",
+        ["api", "user"],
+    )
+
+    def __init__(
+        self,
+        state: State,
+        fair_queue: FairQueue,
+        router: Optional[TierRouter] = None,
+        logger=logging,
+    ):
+        self.state = state
+        self.fair_queue = fair_queue
+        self.router = router or TierRouter()
+        self.settings = fair_queue.settings
+        self.logger = logger
+        # users with a share exported per application, and topics whose
+        # depth is unknown, which are warned about once
+        self.share_users: Dict[str, Set[str]] = {}
+        self.unknown_depth: Set[str] = set()
+
+    def dispatch(self, application: str) -> int:
+        """fill the worker topics of an application, return number of jobs
+        dispatched"""
+        dispatched = 0
+        pending = 0
+        users = 0
+        shares: Dict[str, int] = {}
+        for topic in self.router.topics(application):
+            depth = self.state.length(topic)
+            if depth < 0:
+                # without the depth, all jobs would be dispatched at once
+                if topic not in self.unknown_depth:
+                    self.unknown_depth.add(topic)
+                    self.logger.warning(
+                        "depth of topic %s is unknown, its jobs are not dispatched",
+                        topic,
+                    )
+                depth = self.settings.fair_queueing_dispatch_depth
+            room = self.settings.fair_queueing_dispatch_depth - depth
+            for _ in range(room):
+                popped = self.fair_queue.pop(topic)
+                if popped is None:
+                    break
+                _, message = popped
+                self.state.write(topic, message)
+                dispatched += 1
+            pending += self.fair_queue.length(topic)
+            users += self.fair_queue.users(topic)
+            for user, count in self.fair_queue.shares(topic).items():
+                shares[user] = shares.get(user, 0) + count
+
+        self.dispatched_counter.labels(api=application).inc(dispatched)
+        self.pending_gauge.labels(api=application).set(pending)
+        self.users_gauge.labels(api=application).set(users)
+        self.export_shares(application, shares)
+        return dispatched
+
+    def export_shares(self, application: str, shares: Dict[str, int]) -> None:
+        # users whose window expired are dropped rather than kept at their
+        # last count
+        for user in self.share_users.get(application, set()) - shares.keys():
+            self.shares_gauge.remove(application, user)
+        for user, count in shares.items():
+            self.shares_gauge.labels(api=application, user=user).set(count)
+        self.share_users[application] = set(shares)
+
+    def run(self) -> None:
+        while True:
+            dispatched = sum(
+                self.dispatch(application)
+                for application in self.settings.fair_queueing_applications
+            )
+            if not dispatched:
+                time.sleep(self.settings.fair_queueing_idle_interval)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    state = State(logger=logging)
+    dispatcher = FairQueueDispatcher(state=state, fair_queue=FairQueue(state.redis))
+    start_http_server(dispatcher.settings.fair_queueing_metrics_port)
+    dispatcher.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+import math
+import time
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from pydantic import BaseSettings, Field
+from prometheus_client import Counter, Gauge, start_http_server
+from pipeline import Message, deserialize_message
+
+from .fairness import FairQueue
+from .utils import State
+
+
+# a job starts straggling once dequeued by a worker, unless it was already
+# dispatched a second time or its result arrived
+START_SCRIPT = """
+if redis.call('SISMEMBER', KEYS[2], ARGV[1]) == 1 then
+    return 0
+end
+if redis.call('HEXISTS', KEYS[3], ARGV[1]) == 0 then
+    return 0
+end
+return redis.call('ZADD', KEYS[1], 'NX', ARGV[2], ARGV[1])
+"""
+
+
+class HedgingSettings(BaseSettings):
+    hedging_percentiles: Dict[str, float] = Field(
+        {},
+        title="applications whose straggling jobs are dispatched a second time, "
+        "with the percentile of processing time after which a job straggles",
+    )
+    hedging_samples: int = Field(
+        1000, title="number of recent processing times kept per application"
+    )
+    hedging_min_samples: int = Field(
+        100, title="number of processing times needed before hedging starts"
+    )
+    hedging_interval: float = Field(
+        1.0, title="seconds between two scans for straggling jobs"
+    )
+    hedging_job_ttl: int = Field(
+        86400, title="seconds a job is kept for hedging if its result never arrives"
+    )
+    hedging_metrics_port: int = Field(
+        8002, title="port on which the straggler detector exposes its metrics"
+    )
+
+
+def percentile(values: List[float], q: float) -> float:
+    """nearest-rank percentile of values, q in [0, 1]
+
+    >>> percentile([4.0, 1.0, 3.0, 2.0], 0.5)
+    2.0
+    >>> percentile([4.0, 1.0, 3.0, 2.0], 0.99)
+    4.0
+    """
+    values = sorted(values)
+    rank = max(math.ceil(q * len(values)), 1)
+    return values[rank - 1]
+
+
+class Hedger(object):
+    """Hedger keeps the jobs of an application until their result arrives,
+    along with the processing times of recent jobs. Jobs processed by a
+    worker for longer than a percentile of these times are dispatched once
+    more by StragglerDetector, and ResultWriter keeps whichever result
+    arrives first. Time spent waiting in a queue does not count, workers
+    mark the jobs they dequeue as started, which HEDGING_PERCENTILES must be
+    set for.
+    """
+
+    def __init__(self, redis, settings: Optional[HedgingSettings] = None):
+        self.redis = redis
+        self.settings = settings or HedgingSettings()
+        self.start_script = self.redis.register_script(START_SCRIPT)
+
+    @staticmethod
+    def make_prefix(application: str) -> str:
+        return f"hedge:{application}"
+
+    def enabled(self, application: str) -> bool:
+        return application in self.settings.hedging_percentiles
+
+    def track(self, application: str, topic: str, message: Message) -> None:
+        """remember a job before it is sent to its topic"""
+        prefix = self.make_prefix(application)
+        ttl = self.settings.hedging_job_ttl
+        p = self.redis.pipeline()
+        p.zadd(f"{prefix}:tracked", {message.id: time.time()})
+        p.hset(f"{prefix}:topics", message.id, topic)
+        p.hset(f"{prefix}:jobs", message.id, message.serialize())
+        # jobs whose result never arrives are pruned by StragglerDetector,
+        # the keys expire if it stops running for the application
+        for name in ["tracked", "topics", "jobs"]:
+            p.expire(f"{prefix}:{name}", ttl)
+        p.execute()
+
+    def start(self, application: str, key: str) -> bool:
+        """a worker dequeued a job, return whether it may straggle from now"""
+        prefix = self.make_prefix(application)
+        return bool(
+            self.start_script(
+                keys=[f"{prefix}:pending", f"{prefix}:hedged", f"{prefix}:jobs"],
+                args=[key, time.time()],
+            )
+        )
+
+    def complete(
+        self,
+        application: str,
+        key: str,
+        duration: Optional[float] = None,
+        pipeline=None,
+    ) -> None:
+        """forget a job whose result arrived or which was cancelled, and
+        record its processing time if it was processed. With `pipeline`, the
+        commands are added to it and it is not executed."""
+        prefix = self.make_prefix(application)
+        p = pipeline or self.redis.pipeline()
+        self.forget(p, prefix, key)
+        if duration is not None:
+            p.lpush(f"{prefix}:durations", duration)
+            p.ltrim(f"{prefix}:durations", 0, self.settings.hedging_samples - 1)
+        if pipeline is None:
+            p.execute()
+
+    @staticmethod
+    def forget(pipeline, prefix: str, *keys: str) -> None:
+        pipeline.zrem(f"{prefix}:tracked", *keys)
+        pipeline.zrem(f"{prefix}:pending", *keys)
+        pipeline.srem(f"{prefix}:hedged", *keys)
+        pipeline.hdel(f"{prefix}:topics", *keys)
+        pipeline.hdel(f"{prefix}:jobs", *keys)
+
+    def prune(self, application: str) -> int:
+        """forget jobs tracked for longer than HEDGING_JOB_TTL, whose result
+        never arrived, return number of jobs forgotten"""
+        prefix = self.make_prefix(application)
+        keys = self.redis.zrangebyscore(
+            f"{prefix}:tracked", "-inf", time.time() - self.settings.hedging_job_ttl
+        )
+        if not keys:
+            return 0
+        p = self.redis.pipeline()
+        self.forget(p, prefix, *keys)
+        p.execute()
+        return len(keys)
+
+    def threshold(self, application: str) -> Optional[float]:
+        """seconds after which a job of the application straggles, None if
+        too few jobs have been processed to tell"""
+        durations = self.redis.lrange(
+            f"{self.make_prefix(application)}:durations", 0, -1
+        )
+        if len(durations) < self.settings.hedging_min_samples:
+            return None
+        return percentile(
+            [float(duration) for duration in durations],
+            self.settings.hedging_percentiles[application],
+        )
+
+    def stragglers(self, application: str, threshold: float) -> List[str]:
+        return [
+            key.decode("utf-8")
+            for key in self.redis.zrangebyscore(
+                f"{self.make_prefix(application)}:pending",
+                "-inf",
+                time.time() - threshold,
+            )
+        ]
+
+    def claim(self, application: str, key: str) -> Optional[Tuple[str, Message]]:
+        """take a straggling job out of pending, so it is hedged only once
+        even with several detectors running. Returns its topic and message."""
+        prefix = self.make_prefix(application)
+        if not self.redis.zrem(f"{prefix}:pending", key):
+            return None
+
+        p = self.redis.pipeline()
+        # the second dispatch is not started again when dequeued
+        p.sadd(f"{prefix}:hedged", key)
+        p.hget(f"{prefix}:topics", key)
+        p.hget(f"{prefix}:jobs", key)
+        _, topic, job = p.execute()
+        if topic is None or job is None:
+            # completed meanwhile
+            self.redis.srem(f"{prefix}:hedged", key)
+            return None
+        return topic.decode("utf-8"), deserialize_message(job)
+
+
+class StragglerDetector(object):
+    """StragglerDetector periodically sends the straggling jobs of hedged
+    applications to their topic again, through the fair queue of the topic
+    if the application has one.
+    """
+
+    hedged_counter = Counter(
+        "api_hedged_total",
+        "Straggling jobs dispatched a second time",
+        ["api"],
+    )
+    pruned_counter = Counter(
+        "api_hedging_pruned_total",
+        "Jobs forgotten by hedging as their result never arrived",
+        ["api"],
+    )
+    threshold_gauge = Gauge(
+        "api_hedging_threshold_seconds",
+        "Processing time after which a job is hedged",
+        ["api"],
+    )
+
+    def __init__(
+        self, state: State, hedger: Hedger, fair_queue: Optional[FairQueue] = None
+    ):
+        self.state = state
+        self.hedger = hedger
+        self.fair_queue = fair_queue
+        self.settings = hedger.settings
+
+    def hedge(self, application: str) -> int:
+        """dispatch straggling jobs of an application, return number of jobs
+        dispatched"""
+        self.pruned_counter.labels(api=application).inc(
+            self.hedger.prune(application)
+        )
+        threshold = self.hedger.threshold(application)
+        if threshold is None:
+            return 0
+        self.threshold_gauge.labels(api=application).set(threshold)
+
+        hedged = 0
+        for key in self.hedger.stragglers(application, threshold):
+            claimed = self.hedger.claim(application, key)
+            if claimed is None:
+                continue
+            topic, message = claimed
+            if self.fair_queue is not None and self.fair_queue.enabled(application):
+                self.fair_queue.push(topic, message.get("user"), message)
+            else:
+                self.state.write(topic, message)
+            hedged += 1
+
+        self.hedged_counter.labels(api=application).inc(hedged)
+        return hedged
+
+    def run(self) -> None:
+        while True:
+            for application in self.settings.hedging_percentiles:
+                self.hedge(application)
+            time.sleep(self.settings.hedging_interval)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    state = State(logger=logging)
+    detector = StragglerDetector(
+        state=state, hedger=Hedger(state.redis), fair_queue=FairQueue(state.redis)
+    )
+    start_http_server(detector.settings.hedging_metrics_port)
+    detector.run()
+
+
+if __name__ == "__main__":
+    main()
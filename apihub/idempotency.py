@@ -0,0 +1,59 @@
+from typing import Optional
+
+from pydantic import BaseSettings, Field
+
+
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+PENDING = "PENDING"
+
+
+class IdempotencySettings(BaseSettings):
+    idempotency_window: int = Field(
+        86400, title="seconds a retry with the same Idempotency-Key is recognized"
+    )
+    idempotency_pending_timeout: int = Field(
+        30,
+        title="seconds a submission in progress holds its Idempotency-Key, "
+        "retries are accepted afterwards if its server died",
+    )
+
+
+class IdempotencyKeys(object):
+    """IdempotencyKeys records the key of the request submitted with a client
+    supplied Idempotency-Key, scoped to a subscription, so that retries return
+    the original key instead of submitting a new job.
+    """
+
+    def __init__(self, redis, settings: Optional[IdempotencySettings] = None):
+        self.redis = redis
+        self.settings = settings or IdempotencySettings()
+
+    @staticmethod
+    def make_key(subscription_id: int, idempotency_key: str) -> str:
+        return f"idempotency:{subscription_id}:{idempotency_key}"
+
+    def claim(self, subscription_id: int, idempotency_key: str) -> Optional[str]:
+        """atomically record a first submission. Return None if this is the
+        first submission, otherwise the key of the original request, or
+        PENDING if it is still being submitted. The claim lasts until the
+        submission is recorded, or a few seconds if it never is"""
+        name = self.make_key(subscription_id, idempotency_key)
+        if self.redis.set(
+            name, PENDING, nx=True, ex=self.settings.idempotency_pending_timeout
+        ):
+            return None
+
+        key = self.redis.get(name)
+        return key.decode("utf-8") if key is not None else PENDING
+
+    def record(self, subscription_id: int, idempotency_key: str, key: str) -> None:
+        self.redis.set(
+            self.make_key(subscription_id, idempotency_key),
+            key,
+            ex=self.settings.idempotency_window,
+        )
+
+    def release(self, subscription_id: int, idempotency_key: str) -> None:
+        """forget a submission which failed, so that it can be retried"""
+        self.redis.delete(self.make_key(subscription_id, idempotency_key))
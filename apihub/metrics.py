@@ -0,0 +1,142 @@
+import os
+import glob
+import functools
+from typing import Dict, FrozenSet, List, Optional
+
+from fastapi import APIRouter
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.metrics_core import Metric
+from starlette import status
+from starlette.requests import Request
+from starlette.responses import Response
+
+
+# directory where each process writes its metrics when several processes serve
+# requests, it must be set before prometheus_client is imported
+MULTIPROC_DIR = "prometheus_multiproc_dir"
+
+
+def multiprocess_dir() -> Optional[str]:
+    return os.environ.get(MULTIPROC_DIR)
+
+
+def file_pid(path: str) -> int:
+    """pid of the process writing a metric file
+
+    >>> file_pid("/tmp/metrics/counter_123.db")
+    123
+    >>> file_pid("/tmp/metrics/gauge_liveall_123.db")
+    123
+    """
+    return int(os.path.basename(path)[:-3].rsplit("_", 1)[1])
+
+
+def is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class MultiProcessCollector(multiprocess.MultiProcessCollector):
+    """MultiProcessCollector merges the metric files of all processes like the
+    one of prometheus_client, but the counters and histograms of exited
+    processes are read and merged once: their files no longer change, while
+    they would otherwise be read again on every scrape for as long as the
+    server runs.
+    """
+
+    def __init__(self, registry, path: Optional[str] = None):
+        super().__init__(registry, path)
+        self.exited: FrozenSet[str] = frozenset()
+        self.exited_metrics: List[Metric] = []
+
+    def exited_files(self, files: List[str]) -> FrozenSet[str]:
+        # gauges of exited processes are either removed, or kept per pid
+        return frozenset(
+            path
+            for path in files
+            if not os.path.basename(path).startswith("gauge_")
+            and not is_alive(file_pid(path))
+        )
+
+    def collect(self):
+        files = glob.glob(os.path.join(self._path, "*.db"))
+        exited = self.exited_files(files)
+        if exited != self.exited:
+            self.exited_metrics = list(self.merge(list(exited), accumulate=False))
+            self.exited = exited
+
+        metrics: Dict[str, Metric] = self._read_metrics(
+            [path for path in files if path not in exited]
+        )
+        for merged in self.exited_metrics:
+            metric = metrics.get(merged.name)
+            if metric is None:
+                metric = metrics[merged.name] = Metric(
+                    merged.name, merged.documentation, merged.type
+                )
+            for sample in merged.samples:
+                metric.add_sample(
+                    sample.name, tuple(sorted(sample.labels.items())), sample.value
+                )
+        return self._accumulate_metrics(metrics, accumulate=True)
+
+
+def clean_multiprocess_dir() -> int:
+    """delete the metric files left by a previous run, before workers start.
+    Their pids may be reused, and counters of the previous run would be
+    merged into those of the new one. Returns the number of files deleted."""
+    path = multiprocess_dir()
+    if path is None:
+        return 0
+    os.makedirs(path, exist_ok=True)
+    deleted = 0
+    for name in glob.glob(os.path.join(path, "*.db")):
+        os.remove(name)
+        deleted += 1
+    return deleted
+
+
+def mark_process_dead(pid: Optional[int] = None) -> None:
+    """remove the live gauges of an exiting process"""
+    if multiprocess_dir() is not None:
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+@functools.lru_cache(maxsize=None)
+def get_metrics_registry() -> CollectorRegistry:
+    """registry exposed by /metrics, merging the metrics of all processes if
+    prometheus_multiproc_dir is set"""
+    if multiprocess_dir() is None:
+        return REGISTRY
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry)
+    return registry
+
+
+metrics_router = APIRouter()
+
+
+@metrics_router.get("/metrics", include_in_schema=False)
+def metrics_route(request: Request):
+    """
+    Endpoint for Prometheus metrics_route. Code taken from prometheus_client examples.
+    Examples:
+        app.include_router(metrics_router)
+    """
+    data = generate_latest(get_metrics_registry())
+    response_headers = {
+        "Content-type": CONTENT_TYPE_LATEST,
+        "Content-Length": str(len(data)),
+    }
+    return Response(data, status_code=status.HTTP_200_OK, headers=response_headers)
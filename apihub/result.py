@@ -1,30 +1,241 @@
+import sys
+import time
+import zlib
+import traceback
+from logging import Logger
+from queue import Empty, Queue
+from threading import Thread
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
 import redis
+from redis.exceptions import NoScriptError
+from pydantic import BaseSettings, Field, ValidationError
 from prometheus_client import Counter, Histogram
 from dotenv import load_dotenv
 
 from pipeline import ProcessorSettings, Processor, Command, CommandActions, Definition
 
 from .common.db_session import create_session
-from .utils import Result, RedisSettings, DefinitionManager
+from .activity.schemas import ActivityStatus
+from .admission import ConcurrencyLimiter
+from .codec import ResultCodec
+from .coalescing import RequestCoalescer
+from .hedging import Hedger
+from .retention import EVICTABLE, ResultRetention
+from .streams import StreamSource, use_streams
+from .usage import UsageBuffer, UsageTracker
+from .utils import (
+    DEQUEUED,
+    ENQUEUED,
+    PROCESSED,
+    RECEIVED,
+    STORED,
+    Result,
+    RedisSettings,
+    DefinitionManager,
+)
 from . import __worker__, __version__
 
 load_dotenv()
 
 
+CANCELLED = "CANCELLED"
+EXISTS = "EXISTS"
+DUPLICATE = "DUPLICATE"
+OVERWRITTEN = "OVERWRITTEN"
+
+# write a result unless it must not replace the stored one: a cancelled
+# result is final, an acceptance notification never replaces a result, and
+# for hedged jobs (ARGV[4] == '1') the first result wins
+WRITE_SCRIPT = """
+local existing = redis.call('GET', KEYS[1])
+if existing then
+    -- only processed results are compressed or kept in the blob store,
+    -- the others are JSON
+    local status = 'PROCESSED'
+    if string.sub(existing, 1, 1) == '{' then
+        status = cjson.decode(existing)['status']
+    end
+    if status == 'CANCELLED' then
+        return 'CANCELLED'
+    end
+    if ARGV[2] == 'ACCEPTED' then
+        return 'EXISTS'
+    end
+    if ARGV[4] == '1' and status ~= 'ACCEPTED' then
+        return 'DUPLICATE'
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+if existing then
+    return 'OVERWRITTEN'
+end
+return 'OK'
+"""
+
+
+# jobs take from milliseconds to minutes
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    300.0,
+    float("inf"),
+)
+
+
+def processing_time(result: Result) -> Optional[float]:
+    """seconds a worker spent processing a job, None if it was not processed"""
+    if (
+        result.status != ActivityStatus.PROCESSED
+        or DEQUEUED not in result.timestamps
+        or PROCESSED not in result.timestamps
+    ):
+        return None
+    return max(result.timestamps[PROCESSED] - result.timestamps[DEQUEUED], 0.0)
+
+
+class ResultWriterSettings(BaseSettings):
+    result_writer_concurrency: int = Field(
+        1, title="number of threads writing results to redis"
+    )
+    result_writer_queue_size: int = Field(
+        1000, title="results waiting per thread before reading is paused"
+    )
+    result_writer_batch_size: int = Field(
+        1, title="maximum number of results written in one round trip"
+    )
+    result_writer_batch_delay: float = Field(
+        0.005, title="seconds a result may wait for others to be written with"
+    )
+
+
+class ShardedBatcher(object):
+    """ShardedBatcher hands items to a fixed number of threads in batches,
+    an item is assigned to a thread by the hash of its key. Items of the same
+    key are therefore handled in the order they were submitted.
+
+    A thread waits at most `batch_delay` seconds after its first item for
+    more items, and hands at most `batch_size` items at once.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[List[Any]], None],
+        shards: int,
+        batch_size: int,
+        batch_delay: float,
+        queue_size: int,
+        logger: Logger,
+    ):
+        self.handler = handler
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.logger = logger
+        self.queues: List[Queue] = [Queue(maxsize=queue_size) for _ in range(shards)]
+        self.threads = [
+            Thread(target=self._run, args=(queue,), daemon=True)
+            for queue in self.queues
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self, queue: Queue) -> None:
+        stopped = False
+        while not stopped:
+            item = queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.batch_delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = queue.get(timeout=timeout)
+                except Empty:
+                    break
+                if item is None:
+                    stopped = True
+                    break
+                batch.append(item)
+
+            try:
+                self.handler(batch)
+            except Exception:
+                self.logger.error(traceback.format_exc())
+
+    def submit(self, key: str, item: Any) -> None:
+        """queue an item, blocks while the queue of its thread is full"""
+        queue = self.queues[zlib.crc32(key.encode("utf-8")) % len(self.queues)]
+        queue.put(item)
+
+    def shutdown(self) -> None:
+        """wait for queued items to be handled"""
+        for queue in self.queues:
+            queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
 class ResultWriter(Processor):
     """ResultWriter collects results from API service worker, and
     store these results in Redis
+
+    Results are written by RESULT_WRITER_CONCURRENCY threads, sharded by key
+    so that the results of a key keep their order, in batches of up to
+    RESULT_WRITER_BATCH_SIZE results sent in one round trip. Several replicas can run
+    side by side, results are written with a script which never lets an
+    acceptance notification replace a result.
+
+    By default results are written one at a time before their message is
+    acknowledged. With threads or batches, messages read from a Redis Stream
+    are acknowledged once their batch is written, so that a crashed writer
+    leaves them to be claimed by another; messages of other sources are
+    acknowledged when queued, and those still queued are lost on a crash.
     """
 
     api_counter = Counter(
         "api_requests_total",
         "API requests",
-        ["api", "user", "status"],
+        ["api", "status"],
     )
     request_duration = Histogram(
         "api_process_time_seconds",
         "Processing time (seconds)",
         labelnames=["api"],
+        buckets=LATENCY_BUCKETS,
+    )
+    queue_wait = Histogram(
+        "api_queue_wait_seconds",
+        "Time a job waits in its topic before a worker reads it (seconds)",
+        labelnames=["api"],
+        buckets=LATENCY_BUCKETS,
+    )
+    write_lag = Histogram(
+        "api_result_write_lag_seconds",
+        "Time from a job processed to its result stored (seconds)",
+        labelnames=["api"],
+        buckets=LATENCY_BUCKETS,
+    )
+    total_duration = Histogram(
+        "api_total_time_seconds",
+        "Time from a request received to its result stored (seconds)",
+        labelnames=["api"],
+        buckets=LATENCY_BUCKETS,
     )
 
     def __init__(self) -> None:
@@ -37,11 +248,42 @@ class ResultWriter(Processor):
         super().__init__(settings, input_class=dict, output_class=None)
 
         self.session = create_session()
+        self.shards = None
+        self.usage = None
+
+    def parse_args(self, args: List[str] = sys.argv[1:]) -> None:
+        super().parse_args(args)
+        use_streams(self, args)
 
     def setup(self) -> None:
         settings = RedisSettings()
         self.redis = redis.Redis.from_url(settings.redis)
         self.definitions = DefinitionManager(redis=self.redis)
+        self.coalescer = RequestCoalescer(redis=self.redis)
+        self.concurrency_limiter = ConcurrencyLimiter(redis=self.redis)
+        self.hedger = Hedger(redis=self.redis)
+        self.retention = ResultRetention(redis=self.redis, logger=self.logger)
+        self.codec = ResultCodec()
+        self.usage = UsageBuffer(UsageTracker(redis=self.redis), logger=self.logger)
+        self.last_purge = time.time()
+        self.write_script = self.redis.register_script(WRITE_SCRIPT)
+        # loaded once: a pipeline running registered scripts checks that they
+        # exist in a round trip of its own
+        self.redis.script_load(WRITE_SCRIPT)
+
+        writer_settings = ResultWriterSettings()
+        if (
+            writer_settings.result_writer_concurrency > 1
+            or writer_settings.result_writer_batch_size > 1
+        ):
+            self.shards = ShardedBatcher(
+                self.write_batch,
+                shards=writer_settings.result_writer_concurrency,
+                batch_size=writer_settings.result_writer_batch_size,
+                batch_delay=writer_settings.result_writer_batch_delay,
+                queue_size=writer_settings.result_writer_queue_size,
+                logger=self.logger,
+            )
 
     def set_db_session(self, session):
         self.session = session
@@ -58,26 +300,212 @@ class ResultWriter(Processor):
 
     def process(self, message_content, message_id):
         self.logger.info("Processing MESSAGE")
-        result = Result.parse_obj(message_content)
-        # if result.status == ActivityStatus.PROCESSED:
-        #     result.result = {
-        #         k: message_content.get(k) for k in self.message.logs[-1].updated
-        #     }
+        if self.shards is None:
+            self.write_batch([(message_id, message_content, None)])
+        else:
+            # the message is acknowledged once written, not when queued
+            ack = (
+                self.source.defer_acknowledge()
+                if isinstance(self.source, StreamSource)
+                else None
+            )
+            # results of a key are always written in order by the same thread
+            self.shards.submit(message_id, (message_id, message_content, ack))
+        return None
+
+    def write_batch(
+        self, batch: List[Tuple[str, Dict[str, Any], Optional[bytes]]]
+    ) -> None:
+        """write results in one round trip, along with the bookkeeping of
+        their jobs, then complete those written"""
+        results = []
+        p = self.redis.pipeline(transaction=False)
+        for message_id, message_content, _ in batch:
+            try:
+                result = Result.parse_obj(message_content)
+            except ValidationError:
+                # one invalid result must not fail the others of the batch
+                self.logger.error(traceback.format_exc())
+                continue
+            # if result.status == ActivityStatus.PROCESSED:
+            #     result.result = {
+            #         k: message_content.get(k) for k in self.message.logs[-1].updated
+            #     }
+            self.api_counter.labels(api=result.api, status=result.status.value).inc()
+            hedged = self.hedger.enabled(result.api)
+            stored = self.codec.encode(result, message_id)
+            results.append((message_id, result, hedged, stored))
+            self.add_write(p, *results[-1])
+
+        for message_id, result, hedged, _ in results:
+            if self.retention.budgeted(result.api):
+                self.retention.track(p, result.api, message_id, result.status)
+            if result.status == ActivityStatus.ACCEPTED:
+                # acceptances are counted by the server
+                continue
+            # rolled up in memory like the server does, a command per result
+            # would cost as much as the write itself
+            self.usage.add(result.api, result.user, result.status.value.lower())
+            if result.subscription_id is not None:
+                self.concurrency_limiter.release(
+                    result.subscription_id, message_id, pipeline=p
+                )
+            if hedged:
+                # a job processed twice gives two samples of processing time
+                self.hedger.complete(
+                    result.api, message_id, processing_time(result), pipeline=p
+                )
+
+        outcomes = self.execute_writes(p, results)
+        budgeted = {}
+        for (message_id, result, hedged, stored), outcome in zip(results, outcomes):
+            outcome = outcome.decode("utf-8")
+            blob = ResultCodec.blob(stored)
+            if blob is not None and outcome in (CANCELLED, EXISTS, DUPLICATE):
+                self.codec.blobs.delete(blob)
+            self.complete(message_id, result, outcome)
+            if self.retention.budgeted(result.api) and result.status in EVICTABLE:
+                budgeted[result.api] = message_id
 
-        self.api_counter.labels(api=result.api, user=result.user, status=result.status)
+        for application, message_id in budgeted.items():
+            self.retention.sample(application, message_id)
+            self.retention.enforce(application)
 
-        if self.redis.get(message_id) is not None:
-            self.logger.warning("Found result with key %s, overwriting...", message_id)
+        self.purge_blobs()
 
-        r = result.json()
-        self.redis.set(message_id, r, ex=86400)
+        acks = [ack for _, _, ack in batch if ack is not None]
+        if acks:
+            self.source.acknowledge_many(acks)
+
+    def add_write(self, p, message_id, result, hedged, stored) -> None:
+        p.evalsha(
+            self.write_script.sha,
+            1,
+            message_id,
+            stored,
+            result.status.value,
+            self.retention.ttl(result.api),
+            int(hedged),
+        )
+
+    def execute_writes(self, p, results) -> List[str]:
+        """execute a pipeline starting with the write scripts of `results`,
+        loading the script again if redis lost it, and return the outcomes of
+        the writes"""
+        replies = p.execute(raise_on_error=False)
+        outcomes = replies[: len(results)]
+        missing = [
+            i for i, reply in enumerate(outcomes) if isinstance(reply, NoScriptError)
+        ]
+        if missing:
+            # the script cache of redis was flushed since setup
+            self.redis.script_load(WRITE_SCRIPT)
+            retry = self.redis.pipeline(transaction=False)
+            for i in missing:
+                self.add_write(retry, *results[i])
+            for i, outcome in zip(missing, retry.execute()):
+                outcomes[i] = outcome
+        for reply in [*outcomes, *replies[len(results) :]]:
+            if isinstance(reply, Exception):
+                raise reply
+        return outcomes
+
+    def purge_blobs(self) -> None:
+        """delete blobs older than the longest result ttl, their pointer is
+        gone from redis"""
+        if (
+            self.codec.blobs is None
+            or time.time() - self.last_purge
+            < self.codec.blob_settings.result_blob_purge_interval
+        ):
+            return
+        self.last_purge = time.time()
+
+        settings = self.retention.settings
+        max_age = max([settings.result_ttl, *settings.result_ttls.values()])
+        deleted = self.codec.blobs.purge(max_age)
+        if deleted:
+            self.logger.info("Deleted %d blobs of expired results", deleted)
+
+    def complete(self, message_id: str, result: Result, outcome: str) -> None:
+        """log how a result was written, and copy it to the requests
+        coalesced with its job. Concurrency slots and hedging are completed
+        along with the write."""
+        if outcome == CANCELLED:
+            self.logger.info("Result with key %s was cancelled, discarding", message_id)
+            # requests coalesced with the job still get its result
+            self.complete_aliases(message_id, result)
+            return
+        elif outcome == EXISTS:
+            # a result arrived before its acceptance notification, or the
+            # acceptance of a cached request was stored by the server
+            self.logger.info("Found result with key %s, skipping...", message_id)
+            return
+        elif outcome == DUPLICATE:
+            # the job was dispatched twice, the first result wins
+            self.logger.info("Duplicate result with key %s, discarding", message_id)
+            return
+        elif outcome == OVERWRITTEN:
+            self.logger.warning("Found result with key %s, overwritten", message_id)
+
+        if result.status != ActivityStatus.ACCEPTED:
+            self.observe_latency(result)
+
+        self.complete_aliases(message_id, result)
 
         # if result.status == ActivityStatus.PROCESSED:
         #     ActivityQuery(self.session).update_activity(
         #         message_id, **{"status": ActivityStatus.PROCESSED}
         #     )
 
-        return None
+    def complete_aliases(self, message_id: str, result: Result) -> None:
+        """copy the result of a job to the requests coalesced with it"""
+        if result.status == ActivityStatus.ACCEPTED or not self.coalescer.enabled(
+            result.api
+        ):
+            return
+        aliases = self.coalescer.complete(message_id)
+        if not aliases:
+            return
+
+        p = self.redis.pipeline(transaction=False)
+        stored = []
+        for alias, user in aliases.items():
+            encoded = self.codec.encode(result.copy(update={"user": user}), alias)
+            # written like any result, an alias cancelled by its user stays so
+            self.write_script(
+                keys=[alias],
+                args=[encoded, result.status.value, self.retention.ttl(result.api), 0],
+                client=p,
+            )
+            stored.append(encoded)
+        for encoded, outcome in zip(stored, p.execute()):
+            blob = ResultCodec.blob(encoded)
+            if blob is not None and outcome.decode("utf-8") == CANCELLED:
+                self.codec.blobs.delete(blob)
+
+    def observe_latency(self, result: Result) -> None:
+        """record the time spent by a job at each stage, as far as it was
+        stamped"""
+        timestamps = dict(result.timestamps)
+        timestamps[STORED] = time.time()
+        for histogram, start, end in [
+            (self.queue_wait, ENQUEUED, DEQUEUED),
+            (self.request_duration, DEQUEUED, PROCESSED),
+            (self.write_lag, PROCESSED, STORED),
+            (self.total_duration, RECEIVED, STORED),
+        ]:
+            if start in timestamps and end in timestamps:
+                histogram.labels(api=result.api).observe(
+                    max(timestamps[end] - timestamps[start], 0.0)
+                )
+
+    def shutdown(self) -> None:
+        if self.shards is not None:
+            self.shards.shutdown()
+            self.shards = None
+        if self.usage is not None:
+            self.usage.close()
 
 
 def main():
@@ -0,0 +1,151 @@
+import math
+import time
+import random
+import logging
+from typing import Dict, Optional
+
+from pydantic import BaseSettings, Field
+from prometheus_client import Counter, Gauge
+
+from .activity.schemas import ActivityStatus
+
+
+# an accepted result is still awaited by its user, only final ones are evicted
+EVICTABLE = frozenset(
+    [ActivityStatus.PROCESSED, ActivityStatus.EXPIRED, ActivityStatus.CANCELLED]
+)
+
+
+class RetentionSettings(BaseSettings):
+    result_ttl: int = Field(86400, title="default seconds a result is kept")
+    result_ttls: Dict[str, int] = Field(
+        {}, title="seconds results of an application are kept, overriding RESULT_TTL"
+    )
+    result_memory_budgets: Dict[str, int] = Field(
+        {},
+        title="bytes of redis memory the results of an application may use, "
+        "oldest results are expired first once exceeded",
+    )
+    result_memory_sample_rate: float = Field(
+        0.01, title="fraction of results whose memory usage is measured"
+    )
+    result_memory_check_interval: float = Field(
+        10.0, title="seconds between two checks of the memory budget"
+    )
+
+
+class ResultRetention(object):
+    """ResultRetention decides how long results of an application are kept.
+    Final results of applications with a memory budget are indexed by write
+    time, their memory is estimated from the number of results and the size of a
+    sample of them measured with MEMORY USAGE, and the oldest results are
+    expired once the budget is exceeded.
+    """
+
+    memory_gauge = Gauge(
+        "api_result_memory_bytes",
+        "Estimated redis memory used by results",
+        ["api"],
+    )
+    evicted_counter = Counter(
+        "api_result_evicted_total",
+        "Results expired early to stay within the memory budget",
+        ["api"],
+    )
+
+    def __init__(
+        self, redis, settings: Optional[RetentionSettings] = None, logger=logging
+    ):
+        self.redis = redis
+        self.settings = settings or RetentionSettings()
+        self.logger = logger
+        # average bytes per result, measured by this process
+        self.sizes: Dict[str, float] = {}
+        self.last_check: Dict[str, float] = {}
+
+    @staticmethod
+    def make_key(application: str) -> str:
+        return f"results:{application}"
+
+    def ttl(self, application: str) -> int:
+        return self.settings.result_ttls.get(application, self.settings.result_ttl)
+
+    def budgeted(self, application: str) -> bool:
+        return application in self.settings.result_memory_budgets
+
+    def track(
+        self, pipeline, application: str, key: str, status: ActivityStatus
+    ) -> None:
+        """index a final result by the time it was first written, as part of
+        the pipeline writing it"""
+        if status not in EVICTABLE:
+            return
+        pipeline.zadd(self.make_key(application), {key: time.time()}, nx=True)
+
+    def sample(self, application: str, key: str) -> None:
+        if (
+            application in self.sizes
+            and random.random() >= self.settings.result_memory_sample_rate
+        ):
+            return
+
+        usage = self.redis.memory_usage(key)
+        if usage is None:
+            return
+        size = self.sizes.get(application)
+        self.sizes[application] = usage if size is None else 0.9 * size + 0.1 * usage
+
+    def memory(self, application: str) -> Optional[float]:
+        """estimated bytes used by results of an application"""
+        size = self.sizes.get(application)
+        if size is None:
+            return None
+
+        name = self.make_key(application)
+        p = self.redis.pipeline()
+        # forget results which expired by their ttl
+        p.zremrangebyscore(name, "-inf", time.time() - self.ttl(application))
+        p.zcard(name)
+        _, count = p.execute()
+        return count * size
+
+    def enforce(self, application: str) -> int:
+        """expire the oldest results of an application until it is within its
+        budget, return number of results expired"""
+        now = time.time()
+        if (
+            now - self.last_check.get(application, 0)
+            < self.settings.result_memory_check_interval
+        ):
+            return 0
+        self.last_check[application] = now
+
+        memory = self.memory(application)
+        if memory is None:
+            return 0
+        self.memory_gauge.labels(api=application).set(memory)
+
+        budget = self.settings.result_memory_budgets[application]
+        if memory <= budget:
+            return 0
+
+        excess = math.ceil((memory - budget) / self.sizes[application])
+        oldest = [
+            key for key, _ in self.redis.zpopmin(self.make_key(application), excess)
+        ]
+        if not oldest:
+            # trimmed meanwhile, e.g. by another writer
+            return 0
+        self.redis.delete(*oldest)
+        self.logger.warning(
+            "Results of %s exceed their memory budget by %d bytes, "
+            "expired %d oldest",
+            application,
+            memory - budget,
+            len(oldest),
+        )
+        self.evicted_counter.labels(api=application).inc(len(oldest))
+        self.memory_gauge.labels(api=application).set(
+            memory - len(oldest) * self.sizes[application]
+        )
+        return len(oldest)
@@ -1,5 +1,6 @@
 import sys
-from apihub.server import ServerSettings, api, metrics_router
+from apihub.metrics import clean_multiprocess_dir
+from apihub.server import ServerSettings, api
 
 
 def main():
@@ -8,8 +9,7 @@ def main():
     settings = ServerSettings()
     settings.parse_args(args=sys.argv)
 
-    if settings.monitoring:
-        api.include_router(metrics_router)
+    clean_multiprocess_dir()
 
     uvicorn.run(
         "run_server:api",
@@ -18,6 +18,7 @@ def main():
         log_level=settings.log_level,
         reload=settings.reload,
         debug=settings.debug,
+        workers=settings.workers,
     )
 
 
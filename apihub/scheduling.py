@@ -0,0 +1,79 @@
+from typing import Dict, List, Optional
+
+from pydantic import BaseSettings, Field
+
+from .subscription.schemas import SubscriptionTier
+from .utils import make_topic
+
+
+class SchedulingSettings(BaseSettings):
+    tiered_applications: List[str] = Field(
+        [], title="applications whose jobs are routed to one topic per tier"
+    )
+    tier_weights: Dict[str, int] = Field(
+        {
+            SubscriptionTier.PREMIUM.value: 6,
+            SubscriptionTier.STANDARD.value: 3,
+            SubscriptionTier.TRIAL.value: 1,
+        },
+        title="share of worker capacity given to each tier when all are busy",
+    )
+
+
+class TierRouter(object):
+    """TierRouter decides to which topic a job is sent, based on the tier of
+    the subscription which submitted it.
+    """
+
+    def __init__(self, settings: Optional[SchedulingSettings] = None):
+        self.settings = settings or SchedulingSettings()
+
+    def tiered(self, application: str) -> bool:
+        return application in self.settings.tiered_applications
+
+    def topic(self, application: str, tier: Optional[str] = None) -> str:
+        if tier is None or not self.tiered(application):
+            return make_topic(application)
+        return make_topic(application, tier)
+
+    def topics(self, application: str) -> List[str]:
+        """all topics jobs of an application can be waiting in"""
+        topics = [make_topic(application)]
+        if self.tiered(application):
+            topics.extend(
+                make_topic(application, tier.value) for tier in SubscriptionTier
+            )
+        return topics
+
+
+class TierScheduler(object):
+    """TierScheduler decides from which tier a worker takes its next job,
+    using smooth weighted round robin. Every tier with queued jobs is served
+    at least once every `sum(weights)` jobs, so lower tiers never starve.
+
+    >>> scheduler = TierScheduler({"PREMIUM": 2, "TRIAL": 1})
+    >>> served = []
+    >>> for _ in range(6):
+    ...     tier = scheduler.order()[0]
+    ...     scheduler.served(tier)
+    ...     served.append(tier)
+    >>> served
+    ['PREMIUM', 'TRIAL', 'PREMIUM', 'PREMIUM', 'TRIAL', 'PREMIUM']
+    """
+
+    def __init__(self, weights: Dict[str, int]):
+        if any(weight <= 0 for weight in weights.values()):
+            raise ValueError("tier weights must be positive")
+        self.weights = dict(weights)
+        self.total = sum(self.weights.values())
+        self.current = {tier: 0 for tier in self.weights}
+
+    def order(self) -> List[str]:
+        """tiers in the order they should be polled for the next job"""
+        for tier, weight in self.weights.items():
+            # idle tiers do not accumulate more than one round of credit
+            self.current[tier] = min(self.current[tier] + weight, self.total)
+        return sorted(self.weights, key=lambda tier: self.current[tier], reverse=True)
+
+    def served(self, tier: str) -> None:
+        self.current[tier] -= self.total
@@ -4,6 +4,7 @@ from pydantic import BaseModel
 from fastapi import HTTPException, Depends, Request
 from fastapi_jwt_auth import AuthJWT
 
+from ..timing import phase
 from .schemas import UserBaseWithId, SecurityToken
 
 
@@ -42,7 +43,8 @@ class RateLimiter:
             key = request.client.host
         else:
             key = self.key
-        rate_limited(key, self.limits, self.redis)
+        with phase("ratelimit"):
+            rate_limited(key, self.limits, self.redis)
 
 
 class UserOfRole:
@@ -50,9 +52,9 @@ class UserOfRole:
         self.roles = [role] if role is not None else roles
 
     def __call__(self, Authorize: AuthJWT = Depends()):
-        Authorize.jwt_required()
-
-        token = SecurityToken.from_token(Authorize)
+        with phase("auth"):
+            Authorize.jwt_required()
+            token = SecurityToken.from_token(Authorize)
 
         if token.role in self.roles:
             return UserBaseWithId(
@@ -69,9 +71,9 @@ class UserOfRole:
 
 
 def require_token(Authorize: AuthJWT = Depends()) -> UserBaseWithId:
-    Authorize.jwt_required()
-
-    token = SecurityToken.from_token(Authorize)
+    with phase("auth"):
+        Authorize.jwt_required()
+        token = SecurityToken.from_token(Authorize)
 
     return UserBaseWithId(
         id=token.user_id,
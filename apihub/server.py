@@ -1,12 +1,19 @@
 import sys
+import time
+import gzip
+import json
 import functools
 from functools import partial
+from itertools import chain
 import logging
-from typing import Coroutine, Dict, Any
+from typing import Coroutine, Dict, Any, List, Optional, Iterator, Tuple
 
 from fastapi import FastAPI, HTTPException, Request, Query, Depends
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import UploadFile
 from pydantic import BaseModel, Field
+from prometheus_client import REGISTRY
 from fastapi_jwt_auth import AuthJWT
 from fastapi_jwt_auth.exceptions import AuthJWTException
 from fastapi.openapi.utils import get_openapi
@@ -18,14 +25,50 @@ from pipeline import Message, Settings, Command, CommandActions, Monitor
 from .common.db_session import create_session
 from .activity.schemas import ActivityStatus
 from .activity.middlewares import ActivityLogger
-from .security.depends import RateLimiter, RateLimits, require_user
+from .security.depends import RateLimiter, RateLimits, require_admin, require_user
 from .security.router import router as security_router
 from .subscription.depends import require_subscription, SubscriptionToken
 from .subscription.router import router as subscription_router
+from .admission import QueueAdmission, ConcurrencyLimiter
+from .bodies import (
+    BodySizeLimit,
+    RequestBodyLimits,
+    RequestBodySettings,
+    decode_body,
+)
+from .cache import ResultCache
+from .cancellation import Cancellations
+from .codec import CODEC_HEADERS, ResultCodec, decompress_chunks
+from .coalescing import RequestCoalescer
+from .deadlines import DeadlineSettings, DEADLINE_HEADER, make_deadline
+from .fairness import FairQueue
+from .hedging import Hedger
+from .retention import ResultRetention
+from .scheduling import TierRouter
+from .metrics import (
+    clean_multiprocess_dir,
+    mark_process_dead,
+    metrics_router,
+    multiprocess_dir,
+)
+from .idempotency import (
+    IdempotencyKeys,
+    IDEMPOTENCY_KEY_HEADER,
+    IDEMPOTENCY_KEY_MAX_LENGTH,
+    PENDING,
+)
+from .timing import ServerTiming, phase
+from .usage import UsageBuffer, UsageTracker, today
+from .uploads import MULTIPART_MEDIA_TYPE, UPLOADS, UploadSpool, binary_fields
 from .utils import (
+    ENQUEUED,
+    RECEIVED,
+    stamp,
     State,
     make_topic,
     make_key,
+    make_input_hash,
+    utcnow_isoformat,
     Result,
     DefinitionManager,
 )
@@ -38,8 +81,20 @@ monitor = Monitor()
 operation_counter = monitor.use_counter(
     "APIHub",
     "API operation counts",
-    labels=["api", "user", "operation"],
+    labels=["api", "operation"],
 )
+if multiprocess_dir() is None:
+    # with several processes, all metrics are merged from their files
+    REGISTRY.register(monitor.registry)
+
+
+def count_operation(
+    application: str, email: str, operation: str, count: int = 1
+) -> None:
+    """count an operation in metrics, and in the usage of its user, written
+    to redis in the background"""
+    operation_counter.labels(api=application, operation=operation).inc(count)
+    get_usage_buffer().add(application, email, operation, count)
 
 
 @functools.lru_cache(maxsize=None)
@@ -57,6 +112,88 @@ def get_definition_manager():
     return DefinitionManager(redis=get_redis())
 
 
+@functools.lru_cache(maxsize=None)
+def get_result_codec():
+    return ResultCodec()
+
+
+@functools.lru_cache(maxsize=None)
+def get_result_cache():
+    return ResultCache(redis=get_redis(), codec=get_result_codec())
+
+
+@functools.lru_cache(maxsize=None)
+def get_result_retention():
+    return ResultRetention(redis=get_redis())
+
+
+@functools.lru_cache(maxsize=None)
+def get_request_coalescer():
+    return RequestCoalescer(redis=get_redis())
+
+
+@functools.lru_cache(maxsize=None)
+def get_request_body_settings():
+    return RequestBodySettings()
+
+
+@functools.lru_cache(maxsize=None)
+def get_upload_spool():
+    return UploadSpool()
+
+
+@functools.lru_cache(maxsize=None)
+def get_deadline_settings():
+    return DeadlineSettings()
+
+
+@functools.lru_cache(maxsize=None)
+def get_tier_router():
+    return TierRouter()
+
+
+@functools.lru_cache(maxsize=None)
+def get_fair_queue():
+    return FairQueue(redis=get_redis())
+
+
+@functools.lru_cache(maxsize=None)
+def get_hedger():
+    return Hedger(redis=get_redis())
+
+
+@functools.lru_cache(maxsize=None)
+def get_queue_admission():
+    return QueueAdmission(
+        state=get_state(), router=get_tier_router(), fair_queue=get_fair_queue()
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_concurrency_limiter():
+    return ConcurrencyLimiter(redis=get_redis())
+
+
+@functools.lru_cache(maxsize=None)
+def get_cancellations():
+    return Cancellations(redis=get_redis())
+
+
+@functools.lru_cache(maxsize=None)
+def get_usage_tracker():
+    return UsageTracker(redis=get_redis())
+
+
+@functools.lru_cache(maxsize=None)
+def get_usage_buffer():
+    return UsageBuffer(get_usage_tracker(), logger=logging)
+
+
+@functools.lru_cache(maxsize=None)
+def get_idempotency_keys():
+    return IdempotencyKeys(redis=get_redis())
+
+
 ip_rate_limited = RateLimiter(
     key="ip", limits=RateLimits(limit=10, window_secs=10), redis=get_redis()
 )
@@ -88,6 +225,13 @@ api.include_router(
 )
 
 api.add_middleware(ActivityLogger)
+# around ActivityLogger, so that no body is buffered before its size is checked
+api.add_middleware(
+    BodySizeLimit,
+    limits=RequestBodyLimits(get_definition_manager(), get_request_body_settings()),
+)
+# outside of all middlewares, so that their phases are collected
+api.add_middleware(ServerTiming)
 
 
 @api.exception_handler(AuthJWTException)
@@ -106,6 +250,24 @@ class AsyncAPIResultResponse(BaseModel):
     result: Dict[str, Any] = Field(title="result")
 
 
+class AsyncAPIBulkResultRequest(BaseModel):
+    keys: List[str] = Field(
+        title="unique keys returned by requests",
+        example=["91cb3a68-dd59-11ea-9f2a-82527949ac01"],
+    )
+
+
+class AsyncAPIBulkResultItem(BaseModel):
+    key: str = Field(title="unique key", example="91cb3a68-dd59-11ea-9f2a-82527949ac01")
+    status: str = Field(title="status of the request", example="PROCESSED")
+    result: Optional[Dict[str, Any]] = Field(None, title="result")
+
+
+class AsyncAPIBulkResultResponse(BaseModel):
+    success: bool = Field(title="boolean", example=True)
+    results: List[AsyncAPIBulkResultItem] = Field(title="results")
+
+
 @api.get("/", include_in_schema=False, dependencies=[Depends(ip_rate_limited)])
 async def root():
     return {
@@ -129,74 +291,330 @@ async def define_service(
     return {"define": f"application {application}"}
 
 
-async def make_request(email: str, application: str, request: Request):
+async def read_input(
+    request: Request,
+) -> Tuple[Dict[str, Any], Dict[str, UploadFile]]:
+    """input of a request from its body and query parameters, and the files
+    uploaded with it by field"""
+    uploads: Dict[str, UploadFile] = {}
+    content_type = request.headers.get("Content-Type", "")
+    with phase("body"):
+        if content_type.startswith(MULTIPART_MEDIA_TYPE):
+            # files are spooled to temporary files as they arrive
+            dct = {}
+            for field, value in (await request.form()).multi_items():
+                if isinstance(value, UploadFile):
+                    uploads[field] = value
+                else:
+                    dct[field] = value
+        else:
+            dct = decode_body(
+                await request.body(),
+                content_type,
+                request.headers.get("Content-Encoding"),
+                get_request_body_settings(),
+            )
+
+    # inject query parameters
+    dct.update(request.query_params)
+    return dct, uploads
+
+
+def check_uploads(
+    key: str, input_schema: Dict[str, Any], dct: Dict[str, Any], uploads
+) -> None:
+    """reject files sent to fields not accepting them, or too large, and name
+    the files in the input, they are passed to workers by name"""
+    binary = binary_fields(input_schema)
+    for field in uploads:
+        if field not in binary:
+            raise HTTPException(422, f"Field {field} does not accept files")
+    get_upload_spool().check(uploads)
+    dct.update({field: UploadSpool.make_name(key, field) for field in uploads})
+
+
+async def save_uploads(key: str, dct: Dict[str, Any], uploads) -> None:
+    """copy uploaded files to the upload store, once the request is admitted
+    so that rejected requests leave none behind"""
+    with phase("upload"):
+        dct[UPLOADS] = await run_in_threadpool(get_upload_spool().save, key, uploads)
+        for upload in uploads.values():
+            await upload.close()
+
+
+def reply_from_cache(
+    email: str,
+    application: str,
+    input_hash: str,
+    key: str,
+    received: float,
+    subscription_id: Optional[int] = None,
+    deadline: Optional[float] = None,
+) -> Optional[str]:
+    """key to return for a request whose identical request was already made,
+    none if there is none"""
+    with phase("cache"):
+        cached = get_result_cache().get(application, input_hash)
+    if cached is None:
+        return None
+
+    cached_key, result = cached
+    if result.status == ActivityStatus.ACCEPTED:
+        # identical request is still in flight
+        return cached_key
+
+    # the output is shared, the rest belongs to this request
+    result = result.copy(
+        update={
+            "user": email,
+            "subscription_id": subscription_id,
+            "deadline": deadline,
+            "submission_time": utcnow_isoformat(),
+            # only the total time of a cached result is meaningful
+            "timestamps": {RECEIVED: received},
+        }
+    )
+    with phase("enqueue"):
+        get_state().write(make_topic("result"), Message(content=result.dict(), id=key))
+    return key
+
+
+def admit(
+    application: str, tier: Optional[str], subscription_id: Optional[int], key: str
+) -> None:
+    with phase("admission"):
+        # reject new jobs if the application is falling behind
+        get_queue_admission()(application)
+
+        # reject new jobs if the subscription has too many in flight
+        if subscription_id is not None:
+            get_concurrency_limiter().acquire(application, subscription_id, tier, key)
+
+
+def send_job(application: str, email: str, tier: Optional[str], job: Message) -> None:
+    """send a job to the topic of its application and tier"""
+    topic = get_tier_router().topic(application, tier)
+    stamp(job.content, ENQUEUED)
+    hedger = get_hedger()
+    with phase("enqueue"):
+        if hedger.enabled(application):
+            # tracked before sending, the result may arrive before we return
+            hedger.track(application, topic, job)
+        fair_queue = get_fair_queue()
+        if fair_queue.enabled(application):
+            # jobs are dispatched to the worker topic by FairQueueDispatcher
+            fair_queue.push(topic, email, job)
+        else:
+            get_state().write(topic, job)
+
+
+async def make_request(
+    email: str,
+    application: str,
+    request: Request,
+    tier: Optional[str] = None,
+    subscription_id: Optional[int] = None,
+):
     """Make request to application"""
 
+    received = time.time()
     key = make_key()
 
-    dct: Dict[str, Any] = {}
+    dct, uploads = await read_input(request)
 
-    data = await request.body()
-    if len(data):
-        dct.update(await request.json())
+    with phase("definition"):
+        definition = get_definition_manager().get(application)
 
-    # inject query parameters
-    dct.update(request.query_params)
+    if uploads:
+        check_uploads(key, definition.input_schema, dct, uploads)
 
-    definition = get_definition_manager().get(application)
+    with phase("validate"):
+        try:
+            validate(instance=dct, schema=definition.input_schema)
+        except ValidationError as e:
+            raise HTTPException(422, str(e))
 
-    try:
-        validate(instance=dct, schema=definition.input_schema)
-    except ValidationError as e:
-        raise HTTPException(422, str(e))
-
-    # inject user information
-    info = Result(
-        user=email,
-        api=application,
-        status=ActivityStatus.ACCEPTED,
+    deadline = make_deadline(
+        application, request.headers.get(DEADLINE_HEADER), get_deadline_settings()
     )
-    accept_notification = Message(content=info.dict(), id=key)
-    get_state().write(make_topic("result"), accept_notification)
 
-    # send job request to its approporate topic
-    info.status = ActivityStatus.PROCESSED
-    dct.update(info.dict())
+    input_hash = None
+    cache = get_result_cache()
+    if cache.enabled(application):
+        with phase("cache"):
+            input_hash = make_input_hash(application, definition.version, dct)
+        cached_key = reply_from_cache(
+            email, application, input_hash, key, received, subscription_id, deadline
+        )
+        if cached_key is not None:
+            return cached_key
+
+    admit(application, tier, subscription_id, key)
+
+    try:
+        # inject user information
+        info = Result(
+            user=email,
+            api=application,
+            status=ActivityStatus.ACCEPTED,
+            subscription_id=subscription_id,
+            deadline=deadline,
+            timestamps={RECEIVED: received},
+        )
+        accept_notification = Message(content=info.dict(), id=key)
+        with phase("enqueue"):
+            get_state().write(make_topic("result"), accept_notification)
+
+        coalescer = get_request_coalescer()
+        if coalescer.enabled(application):
+            if input_hash is None:
+                input_hash = make_input_hash(application, definition.version, dct)
+            ttl = get_result_retention().ttl(application)
+            if coalescer.attach(application, input_hash, key, email, ttl) is not None:
+                # result of the identical pending job will be copied to this key
+                if subscription_id is not None:
+                    get_concurrency_limiter().release(subscription_id, key)
+                return key
+
+        if uploads:
+            await save_uploads(key, dct, uploads)
+
+        # send job request to its approporate topic
+        info.status = ActivityStatus.PROCESSED
+        dct.update(info.dict())
+        send_job(application, email, tier, Message(content=dct, id=key))
+    except Exception:
+        # the job was not sent, no result will release its slot
+        if subscription_id is not None:
+            get_concurrency_limiter().release(subscription_id, key)
+        if uploads:
+            get_upload_spool().delete(key, uploads)
+        raise
+
+    if input_hash is not None:
+        cache.add(
+            application,
+            input_hash,
+            key,
+            Result.parse_obj(accept_notification.content),
+            get_result_retention().ttl(application),
+        )
 
-    get_state().write(make_topic(application), Message(content=dct, id=key))
     return key
 
 
-def fetch_result(email: str, application: str, key: str):
-    """fetch result"""
-    result = get_redis().get(key)
-    if result is None:
-        operation_counter.labels(
-            api=application, user=email, operation="result_not_found"
-        ).inc()
+def fetch_stored_result(email: str, application: str, key: str) -> bytes:
+    """fetch a processed result as stored in redis"""
+    stored = get_redis().get(key)
+    if stored is None:
+        count_operation(application, email, "result_not_found")
         raise HTTPException(
             status_code=404,
             detail="Result with this key cannot be found",
         )
 
-    result = Result.parse_raw(result)
+    status = ResultCodec.status(stored)
 
-    if result.status == ActivityStatus.ACCEPTED:
+    if status == ActivityStatus.ACCEPTED:
         raise HTTPException(
             status_code=202,
             detail="Result is not ready",
         )
-    elif result.status != ActivityStatus.PROCESSED:
-        operation_counter.labels(
-            api=application, user=email, operation="error"
-        ).inc()
+    elif status == ActivityStatus.EXPIRED:
+        raise HTTPException(
+            status_code=504,
+            detail="Request was not processed before its deadline",
+        )
+    elif status == ActivityStatus.CANCELLED:
+        raise HTTPException(
+            status_code=410,
+            detail="Request was cancelled",
+        )
+    elif status != ActivityStatus.PROCESSED:
+        count_operation(application, email, "error")
         # FIXME change status code
         raise HTTPException(
             status_code=501,
             detail="Unexpected error happened",
         )
 
-    return result
+    return stored
+
+
+def gzip_result_response(key: str, gzipped: bytes) -> Response:
+    """response to a result stored with gzip, sent without decompressing it.
+    Concatenated gzip members decompress to the concatenation of their
+    contents, so the result is wrapped in members holding the rest of the
+    response."""
+    head = f'{{"success":true,"key":{json.dumps(key)},"result":'.encode("utf-8")
+    body = gzip.compress(head, mtime=0) + gzipped + gzip.compress(b"}", mtime=0)
+    return Response(
+        body,
+        media_type="application/json",
+        headers={"Content-Encoding": "gzip", "Vary": "Accept-Encoding"},
+    )
+
+
+def blob_result_response(key: str, stored: bytes, accept_gzip: bool) -> Response:
+    """response to a result kept in the blob store, streamed in chunks as it
+    is read. A blob stored with gzip is sent without decompressing it if the
+    client accepts gzip."""
+    try:
+        header, chunks = get_result_codec().open(stored)
+    except KeyError:
+        raise HTTPException(
+            status_code=404,
+            detail="Result with this key cannot be found",
+        )
+
+    head = f'{{"success":true,"key":{json.dumps(key)},"result":'.encode("utf-8")
+    if header == CODEC_HEADERS["gzip"] and accept_gzip:
+        body = chain(
+            [gzip.compress(head, mtime=0)], chunks, [gzip.compress(b"}", mtime=0)]
+        )
+        headers = {"Content-Encoding": "gzip", "Vary": "Accept-Encoding"}
+    else:
+        body = chain([head], decompress_chunks(header, chunks), [b"}"])
+        headers = {}
+    return StreamingResponse(body, media_type="application/json", headers=headers)
+
+
+RESULT_NOT_FOUND = "NOT_FOUND"
+
+
+def fetch_results(
+    email: str, application: str, keys: List[str]
+) -> Iterator[AsyncAPIBulkResultItem]:
+    """fetch results of many keys, one MGET per chunk of keys"""
+    chunk_size = settings.bulk_result_chunk_size
+    for i in range(0, len(keys), chunk_size):
+        chunk = keys[i : i + chunk_size]
+        items = [
+            fetch_result_item(key, stored)
+            for key, stored in zip(chunk, get_redis().mget(chunk))
+        ]
+        missing = sum(item.status == RESULT_NOT_FOUND for item in items)
+        if missing:
+            # counted once per chunk rather than once per key
+            count_operation(application, email, "result_not_found", missing)
+        yield from items
+
+
+def fetch_result_item(key: str, stored: Optional[bytes]) -> AsyncAPIBulkResultItem:
+    """item of a stored result, only processed results are decoded"""
+    if stored is None:
+        return AsyncAPIBulkResultItem(key=key, status=RESULT_NOT_FOUND)
+
+    status = ResultCodec.status(stored)
+    if status != ActivityStatus.PROCESSED:
+        return AsyncAPIBulkResultItem(key=key, status=status)
+
+    try:
+        result = get_result_codec().decode(stored)
+    except KeyError:
+        # its blob was purged
+        return AsyncAPIBulkResultItem(key=key, status=RESULT_NOT_FOUND)
+    return AsyncAPIBulkResultItem(key=key, status=status, result=result.dict())
 
 
 @api.post(
@@ -211,11 +629,54 @@ async def async_service(
 ):
     """generic handler for async api."""
 
-    operation_counter.labels(api=subscription.application, user=subscription.email, operation="received").inc()
+    count_operation(subscription.application, subscription.email, "received")
 
-    key = await make_request(subscription.email, subscription.application, request)
-
-    operation_counter.labels(api=subscription.application, user=subscription.email, operation="accepted").inc()
+    idempotency_key = request.headers.get(IDEMPOTENCY_KEY_HEADER)
+    if idempotency_key is None:
+        key = await make_request(
+            subscription.email,
+            subscription.application,
+            request,
+            subscription.tier,
+            subscription.subscription_id,
+        )
+    else:
+        if len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            raise HTTPException(
+                422,
+                f"{IDEMPOTENCY_KEY_HEADER} is longer than {IDEMPOTENCY_KEY_MAX_LENGTH}",
+            )
+
+        idempotency_keys = get_idempotency_keys()
+        with phase("idempotency"):
+            original_key = idempotency_keys.claim(
+                subscription.subscription_id, idempotency_key
+            )
+        if original_key == PENDING:
+            raise HTTPException(
+                409, f"Request with this {IDEMPOTENCY_KEY_HEADER} is in progress"
+            )
+        elif original_key is not None:
+            count_operation(subscription.application, subscription.email, "replayed")
+            return AsyncAPIRequestResponse(success=True, key=original_key)
+
+        try:
+            key = await make_request(
+                subscription.email,
+                subscription.application,
+                request,
+                subscription.tier,
+                subscription.subscription_id,
+            )
+            idempotency_keys.record(
+                subscription.subscription_id, idempotency_key, key
+            )
+        except BaseException:
+            # also when the client disconnects and the request is cancelled
+            idempotency_keys.release(subscription.subscription_id, idempotency_key)
+            raise
+
+    count_operation(subscription.application, subscription.email, "accepted")
 
     return AsyncAPIRequestResponse(success=True, key=key)
 
@@ -227,6 +688,7 @@ async def async_service(
 )
 async def async_service_result(
     application: str,
+    request: Request,
     key: str = Query(
         ...,
         title="unique key returned by a request",
@@ -236,15 +698,155 @@ async def async_service_result(
 ):
     """ """
 
-    result = fetch_result(username, application, request)
+    stored = fetch_stored_result(username.email, application, key)
+    accept_gzip = "gzip" in request.headers.get("Accept-Encoding", "")
+
+    if ResultCodec.blob(stored) is not None:
+        return blob_result_response(key, stored, accept_gzip)
+
+    gzipped = ResultCodec.gzipped(stored)
+    if gzipped is not None and accept_gzip:
+        return gzip_result_response(key, gzipped)
+
+    result = get_result_codec().decode(stored)
 
     return AsyncAPIResultResponse(
         success=True,
-        key=result.get("key"),
-        result=result,
+        key=key,
+        result=result.dict(),
     )
 
 
+@api.delete(
+    "/async/{application}",
+    include_in_schema=False,
+    response_model=AsyncAPIRequestResponse,
+    dependencies=[Depends(ip_rate_limited)],
+)
+async def async_service_cancel(
+    key: str = Query(
+        ...,
+        title="unique key returned by a request",
+        example="91cb3a68-dd59-11ea-9f2a-82527949ac01",
+    ),
+    subscription: SubscriptionToken = Depends(require_subscription),
+):
+    """cancel a request which is not processed yet"""
+
+    redis = get_redis()
+    raw = redis.get(key)
+    if raw is None:
+        raise HTTPException(
+            status_code=404,
+            detail="Result with this key cannot be found",
+        )
+
+    result = get_result_codec().decode(raw)
+    if result.user != subscription.email or result.api != subscription.application:
+        raise HTTPException(
+            status_code=403,
+            detail="The request was not made with this subscription",
+        )
+
+    # requests coalesced with the job keep it running, only this request is
+    # cancelled
+    coalescer = get_request_coalescer()
+    keep_job = coalescer.enabled(subscription.application) and coalescer.cancel(key)
+
+    if not get_cancellations().cancel(subscription.application, key, raw, keep_job):
+        raise HTTPException(
+            status_code=409,
+            detail="Request is already processed",
+        )
+
+    if result.subscription_id is not None:
+        get_concurrency_limiter().release(result.subscription_id, key)
+
+    hedger = get_hedger()
+    if hedger.enabled(subscription.application) and not keep_job:
+        # the job must not be dispatched again
+        hedger.complete(subscription.application, key)
+
+    count_operation(subscription.application, subscription.email, "cancelled")
+
+    return AsyncAPIRequestResponse(success=True, key=key)
+
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+@api.post(
+    "/async/{application}/results",
+    dependencies=[Depends(ip_rate_limited)],
+    include_in_schema=False,
+    response_model=AsyncAPIBulkResultResponse,
+)
+async def async_service_bulk_result(
+    application: str,
+    request: Request,
+    bulk: AsyncAPIBulkResultRequest,
+    username=Depends(require_user),
+):
+    """obtain results of many keys at once. Results are streamed as
+    newline-delimited JSON if the client accepts application/x-ndjson."""
+
+    if len(bulk.keys) > settings.bulk_result_max_keys:
+        raise HTTPException(
+            status_code=422,
+            detail=f"At most {settings.bulk_result_max_keys} keys are allowed",
+        )
+
+    results = fetch_results(username.email, application, bulk.keys)
+
+    if NDJSON_MEDIA_TYPE in request.headers.get("Accept", ""):
+        return StreamingResponse(
+            (item.json() + "\n" for item in results),
+            media_type=NDJSON_MEDIA_TYPE,
+        )
+
+    return AsyncAPIBulkResultResponse(success=True, results=list(results))
+
+
+class UsageTopItem(BaseModel):
+    user: str = Field(title="email of the user")
+    count: int = Field(title="number of operations")
+
+
+@api.get(
+    "/usage/{application}",
+    include_in_schema=False,
+    dependencies=[Depends(ip_rate_limited)],
+)
+async def usage_by_user(
+    application: str,
+    day: Optional[str] = Query(None, title="UTC day as YYYY-MM-DD, today if unset"),
+    username=Depends(require_admin),
+) -> Dict[str, Dict[str, int]]:
+    """count of operations of each user of an application on a day"""
+
+    return get_usage_tracker().usage(application, day or today())
+
+
+@api.get(
+    "/usage/{application}/top",
+    include_in_schema=False,
+    response_model=List[UsageTopItem],
+    dependencies=[Depends(ip_rate_limited)],
+)
+async def usage_top_users(
+    application: str,
+    day: Optional[str] = Query(None, title="UTC day as YYYY-MM-DD, today if unset"),
+    k: int = Query(10, ge=1, le=1000, title="number of users"),
+    username=Depends(require_admin),
+):
+    """heaviest users of an application on a day"""
+
+    return [
+        UsageTopItem(user=user, count=count)
+        for user, count in get_usage_tracker().top(application, day or today(), k)
+    ]
+
+
 def extract_components(schema, components):
     definitions = schema.get("definitions")
     if definitions:
@@ -303,7 +905,10 @@ def get_paths(redis=get_redis()):
             "content": {
                 "application/json": {
                     "schema": definition.input_schema,  # ["properties"],
-                }
+                },
+                "application/msgpack": {
+                    "schema": definition.input_schema,
+                },
             },
             "required": True,
         }
@@ -394,22 +999,40 @@ class ServerSettings(Settings):
     log_level: str = "debug"
     reload: bool = True
     server: str = "https://apihub.tanbih.org"
+    bulk_result_max_keys: int = 1000
+    bulk_result_chunk_size: int = 100
+    monitoring: bool = True
+    workers: int = 1
 
 settings = ServerSettings()
 
+if settings.monitoring:
+    # included here rather than in main, which worker processes do not run
+    api.include_router(metrics_router)
+
+
+@api.on_event("shutdown")
+def remove_live_metrics():
+    mark_process_dead()
+
+
+@api.on_event("shutdown")
+def flush_usage():
+    get_usage_buffer().close()
+
 
 def main():
     import uvicorn
 
-    monitor.expose()
-
     settings.parse_args(args=sys.argv)
+    clean_multiprocess_dir()
     uvicorn.run(
         "apihub.server:api",
         host="0.0.0.0",
         port=settings.port,
         log_level=settings.log_level,
         reload=settings.reload,
+        workers=settings.workers,
     )
 
 
@@ -0,0 +1,300 @@
+import time
+from datetime import datetime
+from logging import Logger
+from typing import Any, Iterator, List, Optional, Tuple, Union
+
+from pydantic import Field, parse_obj_as
+from prometheus_client import Counter, Gauge
+from redis import ResponseError
+from pipeline import Processor, Message, Command, TapKind, deserialize_message
+from pipeline.message import Kind
+from pipeline.exception import PipelineMessageError
+from pipeline.backends.redis import (
+    RedisStreamSource,
+    RedisStreamSourceSettings,
+    RedisStreamDestination,
+    RedisStreamDestinationSettings,
+)
+from pipeline.tap import DestinationAndSettingsClasses
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+# messages serialized by tanbih-pipeline start with "{" or "Z" (zstd), those
+# serialized with msgpack start with "M"
+MSGPACK_HEADER = b"M"
+
+
+def _msgpack_default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    elif isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"cannot serialize {type(value)}")
+
+
+def serialize_msgpack(message: Union[Message, Command]) -> bytes:
+    return MSGPACK_HEADER + msgpack.packb(message.dict(), default=_msgpack_default)
+
+
+def deserialize(raw: bytes) -> Union[Message, Command]:
+    """deserialize a message written with either wire format"""
+    if raw[:1] != MSGPACK_HEADER:
+        return deserialize_message(raw)
+    if msgpack is None:
+        raise PipelineMessageError("message is msgpack, which is not installed")
+
+    message_dict = msgpack.unpackb(raw[1:])
+    if message_dict["kind"] == Kind.Message:
+        return parse_obj_as(Message, message_dict)
+    elif message_dict["kind"] == Kind.Command:
+        return parse_obj_as(Command, message_dict)
+    raise PipelineMessageError("Unknown format")
+
+
+class StreamSourceSettings(RedisStreamSourceSettings):
+    min_idle_time: int = Field(
+        60000,
+        title="milliseconds after which a message not acknowledged by its "
+        "consumer is claimed by another one",
+    )
+    claim_interval: int = Field(
+        5, title="seconds between two checks for messages of idle consumers"
+    )
+    block: int = Field(1000, title="milliseconds to wait for a new message")
+    lag_interval: int = Field(10, title="seconds between two lag measurements")
+
+
+class StreamDestinationSettings(RedisStreamDestinationSettings):
+    maxlen: int = Field(100000, title="approximate maximum length of the stream")
+    msgpack_topics: List[str] = Field(
+        [],
+        title="topics whose messages are serialized with msgpack instead of JSON, "
+        "all their readers must understand msgpack",
+    )
+
+
+class StreamSource(RedisStreamSource):
+    """StreamSource reads from a Redis Stream as a member of a consumer group,
+    so that several replicas share the messages of a topic. A message is
+    acknowledged once processed, messages left unacknowledged by a crashed
+    consumer for `min_idle_time` are claimed by another consumer.
+
+    It fixes what keeps RedisStreamSource of tanbih-pipeline 0.12 from
+    serving replicas: its XAUTOCLAIM passes the group as the stream, so
+    reading fails on the first message; creating the group fails for every
+    replica but the first (BUSYGROUP); and closing deletes the consumer,
+    dropping its pending messages. It also blocks on XREADGROUP instead of
+    polling, and reads msgpack messages.
+    """
+
+    settings: StreamSourceSettings
+
+    lag_gauge = Gauge(
+        "api_stream_lag",
+        "Messages of a stream not yet delivered to its consumer group",
+        ["topic", "group"],
+    )
+    pending_gauge = Gauge(
+        "api_stream_pending",
+        "Messages delivered to a consumer group but not acknowledged",
+        ["topic", "group"],
+    )
+    claimed_counter = Counter(
+        "api_stream_claimed_total",
+        "Messages claimed from idle consumers",
+        ["topic", "group"],
+    )
+
+    def __init__(self, settings: StreamSourceSettings, logger: Logger) -> None:
+        super().__init__(settings, logger)
+        self.last_msg: Optional[bytes] = None
+        self.last_claim_time = 0.0
+        self.last_lag_time = 0.0
+
+    def __repr__(self) -> str:
+        return (
+            f'StreamSource(host="{self.settings.redis}", topic="{self.topic}", '
+            f'group="{self.group}")'
+        )
+
+    def create_group(self) -> None:
+        try:
+            self.redis.xgroup_create(self.topic, self.group, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    def claim(self) -> List[Tuple[bytes, dict]]:
+        """take over messages left unacknowledged by idle consumers"""
+        claimed = self.redis.xautoclaim(
+            self.topic,
+            self.group,
+            self.consumer,
+            self.settings.min_idle_time,
+            "0-0",
+            count=1,
+        )
+        # [next start id, messages] and, from Redis 7, deleted ids
+        messages = [(msg_id, data) for msg_id, data in claimed[1] if data]
+        if messages:
+            self.claimed_counter.labels(topic=self.topic, group=self.group).inc(
+                len(messages)
+            )
+        return messages
+
+    def fetch(self) -> List[Tuple[bytes, dict]]:
+        if time.time() - self.last_claim_time > self.settings.claim_interval:
+            messages = self.claim()
+            if messages:
+                return messages
+            self.last_claim_time = time.time()
+
+        streams = self.redis.xreadgroup(
+            self.group,
+            self.consumer,
+            {self.topic: ">"},
+            count=1,
+            block=self.settings.block,
+        )
+        return streams[0][1] if streams else []
+
+    def record_lag(self) -> None:
+        for group in self.redis.xinfo_groups(self.topic):
+            if group["name"].decode("utf-8") != self.group:
+                continue
+            self.pending_gauge.labels(topic=self.topic, group=self.group).set(
+                group["pending"]
+            )
+            # lag is only reported by Redis 7 and later
+            if group.get("lag") is not None:
+                self.lag_gauge.labels(topic=self.topic, group=self.group).set(
+                    group["lag"]
+                )
+
+    def read(self) -> Iterator[Message]:
+        self.create_group()
+
+        timedOut = False
+        last_message_time = time.time()
+        while not timedOut:
+            try:
+                if time.time() - self.last_lag_time > self.settings.lag_interval:
+                    self.record_lag()
+                    self.last_lag_time = time.time()
+
+                for msg_id, data in self.fetch():
+                    self.last_msg = msg_id
+                    msg = deserialize(data[b"data"])
+                    self.logger.info("Read message %s", str(msg))
+                    yield msg
+                    last_message_time = time.time()
+            except Exception as ex:
+                self.logger.error(ex)
+                break
+            if self.timeout > 0:
+                elapsed_time = time.time() - last_message_time
+                if elapsed_time > self.timeout:
+                    self.logger.warning(
+                        "reader timed out after %d seconds (timeout %d)",
+                        elapsed_time,
+                        self.timeout,
+                    )
+                    timedOut = True
+
+    def acknowledge(self) -> None:
+        if self.last_msg is not None:
+            self.redis.xack(self.topic, self.group, self.last_msg)
+            self.last_msg = None
+
+    def defer_acknowledge(self) -> Optional[bytes]:
+        """leave the last message pending when the processor acknowledges
+        it, returns its id to be passed to `acknowledge_many` later"""
+        msg_id, self.last_msg = self.last_msg, None
+        return msg_id
+
+    def acknowledge_many(self, msg_ids: List[bytes]) -> None:
+        self.redis.xack(self.topic, self.group, *msg_ids)
+
+    def close(self) -> None:
+        # the consumer is not deleted, its pending messages would be lost
+        self.redis.close()
+
+
+class StreamDestination(RedisStreamDestination):
+    """StreamDestination appends to a Redis Stream, trimmed to about `maxlen`
+    messages. Messages of topics listed in `msgpack_topics` are serialized
+    with msgpack, StreamSource reads both formats so that a topic is switched
+    once all its readers are upgraded.
+
+    Unlike RedisStreamDestination, whose `maxlen` of 1 drops messages not yet
+    read, streams keep a backlog, and its length is the backlog of the
+    slowest consumer group rather than the length of the stream.
+    """
+
+    settings: StreamDestinationSettings
+
+    def __init__(self, settings: StreamDestinationSettings, logger: Logger) -> None:
+        super().__init__(settings, logger)
+        self.msgpack = settings.topic in settings.msgpack_topics
+        if self.msgpack and msgpack is None:
+            raise ValueError("msgpack is not installed")
+
+    def __repr__(self) -> str:
+        return f'StreamDestination(host="{self.settings.redis}", topic="{self.topic}")'
+
+    def __len__(self) -> int:
+        """messages waiting for the slowest consumer group, or the length of
+        the stream if Redis does not report lag"""
+        backlog = 0
+        try:
+            groups = self.redis.xinfo_groups(self.topic)
+        except ResponseError:
+            # stream does not exist yet
+            return 0
+        if not groups:
+            return self.redis.xlen(self.topic)
+        for group in groups:
+            if group.get("lag") is None:
+                return self.redis.xlen(self.topic)
+            backlog = max(backlog, group["lag"] + group["pending"])
+        return backlog
+
+    def write(self, message: Message) -> int:
+        if self.msgpack:
+            serialized = serialize_msgpack(message)
+        else:
+            serialized = message.serialize(compress=self.settings.compress)
+        self.redis.xadd(
+            self.topic,
+            fields={"data": serialized},
+            maxlen=self.settings.maxlen,
+            approximate=True,
+        )
+        return len(serialized)
+
+
+STREAM_DESTINATION_CLASSES = DestinationAndSettingsClasses(
+    destination_class=StreamDestination, settings_class=StreamDestinationSettings
+)
+
+
+def use_streams(processor: Processor, args: List[str]) -> None:
+    """replace the Redis Stream taps of tanbih-pipeline with their subclasses
+    StreamSource and StreamDestination, to be called after
+    `Processor.parse_args`"""
+    if processor.has_input() and processor.settings.in_kind == TapKind.XREDIS:
+        processor.source = StreamSource(
+            StreamSourceSettings(_args=args), logger=processor.logger
+        )
+        processor.logger.info(f"Source: {processor.source}")
+
+    if processor.has_output() and processor.settings.out_kind == TapKind.XREDIS:
+        processor.destination_and_settings_classes = STREAM_DESTINATION_CLASSES
+        processor.destination = StreamDestination(
+            StreamDestinationSettings(_args=args), logger=processor.logger
+        )
+        processor.logger.info(f"Destination: {processor.destination}")
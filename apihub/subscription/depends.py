@@ -5,6 +5,7 @@ from redis import Redis
 
 from ..common.db_session import create_session
 from ..common.redis_session import redis_conn
+from ..timing import phase
 
 from .schemas import SubscriptionToken
 from .queries import SubscriptionQuery
@@ -24,8 +25,9 @@ def require_subscription(
     :param Authorize: AuthJWT object.
     :return: SubscriptionBase object.
     """
-    Authorize.jwt_required()
-    subscription_token = SubscriptionToken.from_token(Authorize)
+    with phase("auth"):
+        Authorize.jwt_required()
+        subscription_token = SubscriptionToken.from_token(Authorize)
 
     if  subscription_token.application != application:
         raise HTTPException(
@@ -49,7 +51,8 @@ def require_subscription_balance(
     :return: email str.
     """
     key = make_key(subscription)
-    balance = redis.decr(key)
+    with phase("balance"):
+        balance = redis.decr(key)
     
 
     if balance is None or balance == -1:
@@ -0,0 +1,125 @@
+import os
+import time
+from typing import Any, Dict, Iterator, Optional, Set
+
+from fastapi import HTTPException
+from pydantic import BaseSettings, Field
+from starlette.datastructures import UploadFile
+
+from .blobs import BlobStore, FileBlobStore, S3BlobStore
+
+
+MULTIPART_MEDIA_TYPE = "multipart/form-data"
+# key of the job content describing its uploaded files
+UPLOADS = "uploads"
+
+
+class UploadSettings(BaseSettings):
+    upload_store: str = Field("file", title="where uploaded files are kept: file or s3")
+    upload_path: str = Field(
+        "/var/lib/apihub/uploads",
+        title="directory of the file upload store, shared with workers",
+    )
+    upload_bucket: Optional[str] = Field(None, title="bucket of the s3 upload store")
+    upload_endpoint: Optional[str] = Field(
+        None, title="endpoint of an s3 compatible upload store, AWS if unset"
+    )
+    upload_max_size: int = Field(
+        100 * 1024 * 1024, title="maximum bytes of an uploaded file"
+    )
+    upload_ttl: int = Field(
+        86400, title="seconds after which uploaded files are deleted"
+    )
+    upload_purge_interval: float = Field(
+        3600.0, title="seconds between two deletions of old uploaded files"
+    )
+
+
+def binary_fields(schema: Dict[str, Any]) -> Set[str]:
+    """fields of an input schema accepting files, i.e. strings of format
+    binary as pydantic declares `bytes` fields
+
+    >>> sorted(binary_fields({"properties": {
+    ...     "text": {"type": "string"},
+    ...     "document": {"type": "string", "format": "binary"},
+    ... }}))
+    ['document']
+    """
+    return {
+        name
+        for name, field in schema.get("properties", {}).items()
+        if field.get("type") == "string" and field.get("format") == "binary"
+    }
+
+
+def file_size(upload: UploadFile) -> int:
+    upload.file.seek(0, os.SEEK_END)
+    size = upload.file.tell()
+    upload.file.seek(0)
+    return size
+
+
+class UploadSpool(object):
+    """UploadSpool keeps files uploaded with a request in a blob store shared
+    by servers and workers. Jobs carry the name of their files instead of
+    their content, and workers read them back in chunks.
+    """
+
+    def __init__(self, settings: Optional[UploadSettings] = None):
+        self.settings = settings or UploadSettings()
+        self.store = self.make_store(self.settings)
+        self.last_purge = 0.0
+
+    @staticmethod
+    def make_store(settings: UploadSettings) -> BlobStore:
+        if settings.upload_store == "file":
+            return FileBlobStore(settings.upload_path)
+        elif settings.upload_store == "s3":
+            return S3BlobStore(settings.upload_bucket, settings.upload_endpoint)
+        raise ValueError(f"unknown upload store {settings.upload_store}")
+
+    @staticmethod
+    def make_name(key: str, field: str) -> str:
+        return f"{key}.{field}"
+
+    def check(self, uploads: Dict[str, UploadFile]) -> None:
+        for field, upload in uploads.items():
+            if file_size(upload) > self.settings.upload_max_size:
+                raise HTTPException(
+                    413,
+                    f"File {field} is larger than "
+                    f"{self.settings.upload_max_size} bytes",
+                )
+
+    def save(
+        self, key: str, uploads: Dict[str, UploadFile]
+    ) -> Dict[str, Dict[str, Any]]:
+        """copy uploaded files of a request to the store, in chunks. Returns
+        their description by field."""
+        self.purge()
+        saved = {}
+        for field, upload in uploads.items():
+            name = self.make_name(key, field)
+            size = file_size(upload)
+            self.store.put_file(name, upload.file)
+            saved[field] = {
+                "name": name,
+                "filename": upload.filename,
+                "content_type": upload.content_type,
+                "size": size,
+            }
+        return saved
+
+    def delete(self, key: str, uploads: Dict[str, UploadFile]) -> None:
+        """delete files saved for a request whose job was not sent"""
+        for field in uploads:
+            self.store.delete(self.make_name(key, field))
+
+    def open(self, name: str) -> Iterator[bytes]:
+        return self.store.open(name)
+
+    def purge(self) -> int:
+        if time.time() - self.last_purge < self.settings.upload_purge_interval:
+            return 0
+        self.last_purge = time.time()
+        return self.store.purge(self.settings.upload_ttl)
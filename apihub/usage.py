@@ -0,0 +1,159 @@
+import logging
+import traceback
+from collections import Counter
+from datetime import datetime
+from threading import Event, Lock, Thread
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+from pydantic import BaseSettings, Field
+
+
+class UsageSettings(BaseSettings):
+    usage_retention_days: int = Field(
+        90, title="days the usage of users is kept, usage is counted per day"
+    )
+    usage_top_operation: str = Field(
+        "accepted", title="operation by which the heaviest users are ranked"
+    )
+    usage_flush_interval: float = Field(
+        1.0,
+        title="seconds the operations counted by a server are rolled up in "
+        "memory before they are written, 0 to write each at once",
+    )
+
+
+def today() -> str:
+    return datetime.utcnow().strftime("%Y-%m-%d")
+
+
+class UsageTracker(object):
+    """UsageTracker counts the operations of each user of an application
+    per day, in a Redis hash holding a counter per user and operation. Users
+    are also ranked by one operation in a sorted set, for the heaviest users
+    to be found without reading the whole hash. Days older than
+    `usage_retention_days` expire.
+
+    Prometheus metrics are labelled by application only, as a label per user
+    makes the number of time series grow with the number of users.
+    """
+
+    def __init__(self, redis, settings: Optional[UsageSettings] = None):
+        self.redis = redis
+        self.settings = settings or UsageSettings()
+
+    @staticmethod
+    def make_key(application: str, day: str) -> str:
+        return f"usage:{application}:{day}"
+
+    @staticmethod
+    def make_top_key(application: str, day: str) -> str:
+        return f"usage:{application}:{day}:top"
+
+    @staticmethod
+    def make_field(user: str, operation: str) -> str:
+        # operations have no space, unlike what a user may have
+        return f"{user} {operation}"
+
+    def record(self, application: str, user: str, operation: str) -> None:
+        self.record_many([(application, user, operation)])
+
+    def record_many(self, operations: Iterable[Tuple[str, str, str]]) -> None:
+        """count operations, given as application, user and operation, in
+        one round trip"""
+        self.write(Counter(operations))
+
+    def write(self, counts: Mapping[Tuple[str, str, str], int]) -> None:
+        """add counts of operations, by application, user and operation, in
+        one round trip"""
+        day = today()
+        ttl = self.settings.usage_retention_days * 86400
+        p = self.redis.pipeline(transaction=False)
+        keys = set()
+        for (application, user, operation), count in counts.items():
+            key = self.make_key(application, day)
+            p.hincrby(key, self.make_field(user, operation), count)
+            keys.add(key)
+            if operation == self.settings.usage_top_operation:
+                top_key = self.make_top_key(application, day)
+                p.zincrby(top_key, count, user)
+                keys.add(top_key)
+        if not keys:
+            return
+        for key in keys:
+            p.expire(key, ttl)
+        p.execute()
+
+    def usage(self, application: str, day: str) -> Dict[str, Dict[str, int]]:
+        """counters of an application on a day, by user and operation"""
+        usage: Dict[str, Dict[str, int]] = {}
+        for field, count in self.redis.hscan_iter(self.make_key(application, day)):
+            user, operation = field.decode("utf-8").rsplit(" ", 1)
+            usage.setdefault(user, {})[operation] = int(count)
+        return usage
+
+    def top(self, application: str, day: str, k: int) -> List[Tuple[str, int]]:
+        """the k heaviest users of an application on a day"""
+        return [
+            (user.decode("utf-8"), int(count))
+            for user, count in self.redis.zrevrange(
+                self.make_top_key(application, day), 0, k - 1, withscores=True
+            )
+        ]
+
+
+class UsageBuffer(object):
+    """UsageBuffer rolls up the operations counted by a server in memory,
+    and a thread writes them with UsageTracker every `usage_flush_interval`
+    seconds, so that requests do not wait for Redis to be counted. Counts
+    not yet written are lost if the process is killed, they are written
+    when it is closed.
+    """
+
+    def __init__(self, tracker: UsageTracker, logger=logging):
+        self.tracker = tracker
+        self.logger = logger
+        self.interval = tracker.settings.usage_flush_interval
+        self.counts: Counter = Counter()
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread: Optional[Thread] = None
+        if self.interval > 0:
+            self.thread = Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def add(
+        self, application: str, user: str, operation: str, count: int = 1
+    ) -> None:
+        if self.thread is None:
+            self.tracker.write({(application, user, operation): count})
+            return
+        with self.lock:
+            self.counts[(application, user, operation)] += count
+
+    def flush(self) -> None:
+        with self.lock:
+            counts, self.counts = self.counts, Counter()
+        if not counts:
+            return
+        try:
+            self.tracker.write(counts)
+        except Exception:
+            # kept for the next flush
+            with self.lock:
+                self.counts.update(counts)
+            raise
+
+    def _run(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                self.logger.error(traceback.format_exc())
+
+    def close(self) -> None:
+        """stop the thread and write what is left"""
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+        self.flush()
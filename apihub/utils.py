@@ -1,24 +1,14 @@
+import time
 import uuid
+import json
+import hashlib
 from datetime import datetime
-from typing import Dict, Any
-
-import os
-
-from prometheus_client import (
-    generate_latest,
-    CONTENT_TYPE_LATEST,
-    REGISTRY,
-    multiprocess,
-    CollectorRegistry,
-)
-from starlette import status
-from starlette.requests import Request
-from starlette.responses import Response
+from typing import Dict, Any, Optional
 
 from pydantic import Field, BaseModel
 import redis
 
-from pipeline import Settings, Pipeline, Definition
+from pipeline import Settings, Pipeline, Definition, TapKind
 
 from .activity.schemas import ActivityStatus
 
@@ -30,11 +20,27 @@ def utcnow_isoformat():
     return datetime.utcnow().isoformat()
 
 
+# stages of a job, stamped in its `timestamps` in seconds since epoch
+RECEIVED = "received"  # request received by the server
+ENQUEUED = "enqueued"  # job written to the topic of its application
+DEQUEUED = "dequeued"  # job read by a worker
+PROCESSED = "processed"  # job processed by a worker
+STORED = "stored"  # result written to redis
+
+
+def stamp(content: Dict[str, Any], stage: str) -> None:
+    """record the time a job reached a stage in its content"""
+    content.setdefault("timestamps", {})[stage] = time.time()
+
+
 class Result(BaseModel):
     user: str
     api: str
     status: ActivityStatus
+    subscription_id: Optional[int] = None
     submission_time: str = Field(default_factory=utcnow_isoformat)
+    deadline: Optional[float] = None
+    timestamps: Dict[str, float] = dict()
     result: Dict[str, Any] = dict()
 
 
@@ -45,50 +51,50 @@ class RedisSettings(Settings):
 class State:
     def __init__(self, logger):
         self.pipeline = Pipeline(logger=logger)
+        if self.pipeline.settings.out_kind == TapKind.XREDIS:
+            from .streams import STREAM_DESTINATION_CLASSES, StreamDestinationSettings
+
+            self.pipeline.destination_and_settings_classes = STREAM_DESTINATION_CLASSES
+            self.pipeline.destination_settings = StreamDestinationSettings(_args=[])
         settings = RedisSettings()
         settings.parse_args(args=[])
         self.redis = redis.Redis.from_url(settings.redis)
 
-    def write(self, name, message):
+    def destination_of(self, name):
         # add topic to pipeline if it is not already done
         if name not in self.pipeline.destinations:
             self.pipeline.add_destination_topic(name)
+        return self.pipeline.destination_of(name)
+
+    def write(self, name, message):
         # write message to pipeline
-        self.pipeline.destination_of(name).write(message)
+        self.destination_of(name).write(message)
+
+    def length(self, name):
+        """number of messages waiting in a topic, -1 if unknown"""
+        return len(self.destination_of(name))
 
 
 def make_key():
     return str(uuid.uuid1())
 
 
-def make_topic(service_name: str):
-    return service_name
-
-
-from fastapi import APIRouter
-
-metrics_router = APIRouter()
-
+def make_topic(service_name: str, tier: Optional[str] = None):
+    if tier is None:
+        return service_name
+    return f"{service_name}:{tier}"
 
-@metrics_router.get("/metrics", include_in_schema=False)
-def metrics_route(request: Request):
-    """
-    Endpoint for Prometheus metrics_route. Code taken from prometheus_client examples.
-    Examples:
-        app.add_middleware(PrometheusMiddleware, {params})
-        app.add_route("/metrics_route", metrics_route)
-    """
-    registry = REGISTRY
-    if "prometheus_multiproc_dir" in os.environ:
-        registry = CollectorRegistry()
-        multiprocess.MultiProcessCollector(registry)
 
-    data = generate_latest(registry)
-    response_headers = {
-        "Content-type": CONTENT_TYPE_LATEST,
-        "Content-Length": str(len(data)),
-    }
-    return Response(data, status_code=status.HTTP_200_OK, headers=response_headers)
+def make_input_hash(application: str, version: str, dct: Dict[str, Any]) -> str:
+    """canonical hash of a validated input, identical inputs to the same
+    version of an application share the same hash"""
+    canonical = json.dumps(
+        [application, version, dct],
+        sort_keys=True,
+        separators=(",", ":"),
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
 
 
 class DefinitionManager(object):
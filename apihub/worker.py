@@ -0,0 +1,190 @@
+import sys
+import time
+from logging import Logger
+from typing import Iterator, KeysView, List, Optional, Union
+
+import redis
+from pipeline import Processor, Message, TapKind, deserialize_message
+from pipeline.helpers import namespaced_topic
+from pipeline.backends.redis import RedisListSource, RedisListSourceSettings
+
+from .activity.schemas import ActivityStatus
+from .cancellation import Cancellations
+from .deadlines import expired
+from .hedging import Hedger
+from .scheduling import SchedulingSettings, TierScheduler, TierRouter
+from .streams import use_streams
+from .uploads import UploadSpool
+from .utils import DEQUEUED, PROCESSED, RedisSettings, stamp
+
+
+class TieredListSource(RedisListSource):
+    """TieredListSource reads jobs of an application from its per-tier Redis
+    lists, polling tiers in the order given by a TierScheduler. The untiered
+    topic is always polled first, it carries commands and jobs from servers
+    not routing on tiers.
+    """
+
+    def __init__(
+        self,
+        settings: RedisListSourceSettings,
+        scheduler: TierScheduler,
+        router: TierRouter,
+        logger: Logger,
+    ) -> None:
+        super().__init__(settings, logger)
+        self.scheduler = scheduler
+        self.tier_topics = {
+            tier: namespaced_topic(
+                router.topic(settings.topic, tier), settings.namespace
+            )
+            for tier in scheduler.weights
+        }
+
+    def __repr__(self) -> str:
+        return f'TieredListSource(host="{self.settings.redis}", topic="{self.topic}")'
+
+    def __len__(self) -> int:
+        p = self.redis.pipeline()
+        p.llen(self.topic)
+        for topic in self.tier_topics.values():
+            p.llen(topic)
+        return sum(p.execute())
+
+    def pop(self) -> Optional[bytes]:
+        value = self.redis.lpop(self.topic)
+        if value:
+            return value
+
+        for tier in self.scheduler.order():
+            value = self.redis.lpop(self.tier_topics[tier])
+            if value:
+                self.scheduler.served(tier)
+                return value
+        return None
+
+    def read(self) -> Iterator[Message]:
+        timedOut = False
+        last_message_time = time.time()
+        while not timedOut:
+            try:
+                value = self.pop()
+                if value:
+                    msg = deserialize_message(value)
+                    self.logger.info("Read message %s", str(msg))
+                    yield msg
+                    last_message_time = time.time()
+                    continue
+            except Exception as ex:
+                self.logger.error(ex)
+                break
+            time.sleep(0.01)
+            if self.timeout > 0:
+                elapsed_time = time.time() - last_message_time
+                if elapsed_time > self.timeout:
+                    self.logger.warning(
+                        "reader timed out after %d seconds (timeout %d)",
+                        elapsed_time,
+                        self.timeout,
+                    )
+                    timedOut = True
+
+
+class Worker(Processor):
+    """Worker is the base class for workers serving an APIHub application.
+    It reads jobs the way APIHub server routes them, e.g. from per-tier
+    topics for applications listed in TIERED_APPLICATIONS, or as a member
+    of a Redis Stream consumer group for XREDIS. Jobs which were cancelled
+    or whose deadline has passed are skipped.
+
+    Files uploaded with a request arrive as the name of the file, which
+    `open_upload` reads in chunks.
+
+    Usage:
+
+    .. code-block:: python
+
+        class MyWorker(Worker):
+            def process(self, message_content, message_id):
+                for chunk in self.open_upload(message_content["document"]):
+                    ...
+
+        worker = MyWorker(settings, input_class=Input, output_class=Output)
+        worker.parse_args()
+        worker.start()
+    """
+
+    def parse_args(self, args: List[str] = sys.argv[1:]) -> None:
+        super().parse_args(args)
+        use_streams(self, args)
+
+        redis_client = redis.Redis.from_url(RedisSettings().redis)
+        self.cancellations = Cancellations(redis_client)
+        self.hedger = Hedger(redis_client)
+        self.uploads: Optional[UploadSpool] = None
+
+        if not self.has_input() or not hasattr(self, "source"):
+            return
+
+        scheduling_settings = SchedulingSettings()
+        router = TierRouter(scheduling_settings)
+        if router.tiered(self.source.settings.topic):
+            if self.settings.in_kind != TapKind.LREDIS:
+                self.logger.warning(
+                    "Tiered topics are only supported for LREDIS, reading from %s",
+                    self.source,
+                )
+                return
+            self.source = TieredListSource(
+                self.source.settings,
+                scheduler=TierScheduler(scheduling_settings.tier_weights),
+                router=router,
+                logger=self.logger,
+            )
+            self.logger.info(f"Source: {self.source}")
+
+    def open_upload(self, name: str) -> Iterator[bytes]:
+        """chunks of a file uploaded with a request"""
+        if self.uploads is None:
+            self.uploads = UploadSpool()
+        return self.uploads.open(name)
+
+    def process_message(self, msg: Message) -> Union[KeysView[str], None]:
+        stamp(msg.content, DEQUEUED)
+        try:
+            return self.process_job(msg)
+        finally:
+            stamp(msg.content, PROCESSED)
+
+    def process_job(self, msg: Message) -> Union[KeysView[str], None]:
+        if expired(msg.get("deadline")):
+            self.logger.warning("Message %s passed its deadline, skipping", msg.id)
+            self.monitor.counter(
+                "worker_operation",
+                labels=dict(
+                    name=self.name, operation="expire", topic=self.source.topic
+                ),
+            )
+            # the message is still written to the result topic, as EXPIRED
+            msg.content["status"] = ActivityStatus.EXPIRED
+            return None
+
+        application = msg.get("api")
+        if application is not None and self.cancellations.cancelled(
+            application, msg.id
+        ):
+            self.logger.info("Message %s was cancelled, skipping", msg.id)
+            self.monitor.counter(
+                "worker_operation",
+                labels=dict(
+                    name=self.name, operation="cancel", topic=self.source.topic
+                ),
+            )
+            msg.content["status"] = ActivityStatus.CANCELLED
+            return None
+
+        if application is not None and self.hedger.enabled(application):
+            # processing time is what makes a job straggle, not queueing
+            self.hedger.start(application, msg.id)
+
+        return super().process_message(msg)
@@ -0,0 +1,120 @@
+"""Measure the time to scrape /metrics as the number of server processes grows.
+
+Usage:
+
+    poetry run python performance_testing/metrics_scrape_benchmark.py
+
+With several uvicorn workers, each process writes its metrics to files in
+prometheus_multiproc_dir, and every scrape merges the files of all of them.
+For each number of processes, metric files are written by as many processes,
+with the labels of a server serving a few applications, and /metrics is
+rendered:
+
+- upstream: prometheus_client's collector, built on every scrape as before
+- live: apihub's collector while the processes run, nothing can be cached
+- exited: apihub's collector once they exited, their files are merged once
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from prometheus_client import CollectorRegistry, generate_latest, multiprocess
+
+from apihub.metrics import MultiProcessCollector
+
+
+WRITE_METRICS = """
+import sys
+from prometheus_client import Counter, Histogram, Gauge
+operations = Counter("APIHub", "operations", ["api", "operation"])
+latency = Histogram("api_total_time_seconds", "latency", ["api"])
+phases = Histogram("api_request_phase_seconds", "phases", ["phase"])
+depth = Gauge("api_queue_depth", "depth", ["api"], multiprocess_mode="liveall")
+for api in range(int(sys.argv[1])):
+    for operation in ["received", "accepted", "replayed", "cancelled", "error"]:
+        operations.labels(str(api), operation).inc()
+    latency.labels(str(api)).observe(0.1)
+    depth.labels(str(api)).set(1)
+for phase in ["auth", "ratelimit", "balance", "body", "enqueue", "total"]:
+    phases.labels(phase).observe(0.001)
+print("ready", flush=True)
+sys.stdin.read()
+"""
+
+
+def start_processes(path, processes, applications):
+    """processes which wrote their metrics and wait for their stdin to close"""
+    env = dict(os.environ, prometheus_multiproc_dir=path)
+    running = [
+        subprocess.Popen(
+            [sys.executable, "-c", WRITE_METRICS, str(applications)],
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+        for _ in range(processes)
+    ]
+    for process in running:
+        process.stdout.readline()
+    return running
+
+
+def stop_processes(running):
+    for process in running:
+        process.stdin.close()
+        process.wait()
+
+
+def scrape_upstream(path, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=path)
+        generate_latest(registry)
+    return (time.perf_counter() - start) / n
+
+
+def scrape_cached(path, n):
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry, path=path)
+    start = time.perf_counter()
+    for _ in range(n):
+        generate_latest(registry)
+    return (time.perf_counter() - start) / n
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=20, help="scrapes per run")
+    parser.add_argument("--applications", type=int, default=20)
+    parser.add_argument(
+        "--processes", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64]
+    )
+    args = parser.parse_args()
+
+    print(f"{'processes':>9} {'files':>6} {'upstream':>9} {'live':>9} {'exited':>9}")
+    for processes in args.processes:
+        path = tempfile.mkdtemp(prefix="metrics-")
+        try:
+            running = start_processes(path, processes, args.applications)
+            try:
+                files = len(os.listdir(path))
+                upstream = scrape_upstream(path, args.n)
+                live = scrape_cached(path, args.n)
+            finally:
+                stop_processes(running)
+            exited = scrape_cached(path, args.n)
+        finally:
+            shutil.rmtree(path)
+        print(
+            f"{processes:>9} {files:>6} {upstream * 1000:7.2f}ms "
+            f"{live * 1000:7.2f}ms {exited * 1000:7.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""Measure how many results per second ResultWriter stores in Redis.
+
+Usage:
+
+    REDIS=redis://localhost:6379/1 poetry run python performance_testing/result_writer_benchmark.py
+
+Three ways of writing are compared:
+
+- get-set: a GET followed by a SET per result, as ResultWriter used to do
+- unbatched: one conditional write script per result (batch size 1)
+- batched: conditional write scripts pipelined by RESULT_WRITER_BATCH_SIZE
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+
+from apihub.activity.schemas import ActivityStatus
+from apihub.utils import Result
+
+
+def make_results(n, prefix):
+    return [
+        (
+            f"{prefix}-{i}",
+            Result(
+                user="user",
+                api="benchmark",
+                status=ActivityStatus.PROCESSED,
+                result={"text": "this is simple", "labels": ["a", "b", "c"]},
+            ).dict(),
+        )
+        for i in range(n)
+    ]
+
+
+def bench_get_set(writer, results):
+    start = time.perf_counter()
+    for key, content in results:
+        writer.redis.get(key)
+        writer.redis.set(key, Result.parse_obj(content).json(), ex=86400)
+    return time.perf_counter() - start
+
+
+def bench_writer(writer, results):
+    start = time.perf_counter()
+    for key, content in results:
+        writer.process(content, key)
+    writer.shutdown()
+    return time.perf_counter() - start
+
+
+def make_writer(batch_size):
+    os.environ["RESULT_WRITER_BATCH_SIZE"] = str(batch_size)
+    from apihub.result import ResultWriter
+
+    writer = ResultWriter()
+    writer.parse_args("--in-kind MEM".split())
+    writer.logger.setLevel(logging.ERROR)
+    writer.setup()
+    return writer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=10000, help="number of results")
+    parser.add_argument("--batch-size", type=int, default=100)
+    args = parser.parse_args()
+    os.environ.setdefault("MONITORING", "FALSE")
+
+    runs = [
+        ("get-set", make_writer(1), bench_get_set),
+        ("unbatched", make_writer(1), bench_writer),
+        (f"batched ({args.batch_size})", make_writer(args.batch_size), bench_writer),
+    ]
+    for name, writer, bench in runs:
+        prefix = f"benchmark-{name.split()[0]}"
+        elapsed = bench(writer, make_results(args.n, prefix))
+        print(f"{name:>16}: {args.n / elapsed:10.0f} results/s")
+        for key in writer.redis.scan_iter(f"{prefix}-*"):
+            writer.redis.delete(key)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""Compare the JSON and msgpack wire formats of pipeline messages.
+
+Usage:
+
+    REDIS=redis://localhost:6379/1 poetry run python performance_testing/wire_format_benchmark.py
+
+For each payload shape, a message is serialized and deserialized as a worker
+would, and the size of the serialized message and of its entry in a Redis
+Stream are reported:
+
+- job: a short text submitted to an application
+- result: a processed result with labels and scores
+- document: a long text with many tokens
+"""
+import sys
+import time
+import argparse
+
+from redis import Redis
+from pipeline import Message
+
+from apihub.activity.schemas import ActivityStatus
+from apihub.streams import serialize_msgpack, deserialize
+from apihub.utils import Result, RedisSettings
+
+
+def make_payloads():
+    text = "this is a simple sentence about nothing in particular. " * 4
+    return {
+        "job": {"text": text, "lang": "en"},
+        "result": Result(
+            user="user@example.com",
+            api="benchmark",
+            status=ActivityStatus.PROCESSED,
+            result={
+                "labels": ["positive", "negative", "neutral"],
+                "scores": [0.71, 0.18, 0.11],
+                "entities": [
+                    {"text": "sentence", "start": 10, "end": 18, "score": 0.93}
+                ]
+                * 10,
+            },
+        ).dict(),
+        "document": {
+            "text": text * 100,
+            "tokens": [
+                {"text": "word", "pos": "NOUN", "offset": i} for i in range(1000)
+            ],
+        },
+    }
+
+
+def serialize_json(message):
+    return message.serialize()
+
+
+def bench(serialize, message, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        deserialize(serialize(message))
+    return (time.perf_counter() - start) / n
+
+
+def stream_bytes(redis, serialized, n):
+    """redis memory used per message in a stream"""
+    redis.delete("benchmark/wire")
+    for _ in range(n):
+        redis.xadd("benchmark/wire", {"data": serialized})
+    usage = redis.memory_usage("benchmark/wire", samples=0)
+    redis.delete("benchmark/wire")
+    return usage / n
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=2000, help="messages per run")
+    args = parser.parse_args()
+    redis = Redis.from_url(RedisSettings().redis)
+
+    print(f"{'payload':>10} {'format':>8} {'us/msg':>8} {'bytes':>8} {'redis':>8}")
+    for name, content in make_payloads().items():
+        message = Message(content=content)
+        formats = [("json", serialize_json), ("msgpack", serialize_msgpack)]
+        for format, serialize in formats:
+            elapsed = bench(serialize, message, args.n)
+            serialized = serialize(message)
+            redis_bytes = stream_bytes(redis, serialized, min(args.n, 1000))
+            print(
+                f"{name:>10} {format:>8} {elapsed * 1e6:8.1f} "
+                f"{len(serialized):8d} {redis_bytes:8.0f}"
+            )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+import pytest
+from fastapi import HTTPException
+from redis import Redis
+
+from apihub.admission import QueueAdmission, ConcurrencyLimiter, AdmissionSettings
+from apihub.utils import RedisSettings
+
+
+class DummyState:
+    def __init__(self):
+        self.lengths = {}
+        self.calls = 0
+
+    def length(self, name):
+        self.calls += 1
+        return self.lengths.get(name, 0)
+
+
+def test_queue_admission():
+    state = DummyState()
+    settings = AdmissionSettings(
+        queue_high_water_marks={"test": 2}, queue_sample_interval=0
+    )
+    admission = QueueAdmission(state=state, settings=settings)
+
+    state.lengths["test"] = 1
+    admission("test")
+
+    state.lengths["test"] = 2
+    with pytest.raises(HTTPException) as e:
+        admission("test")
+    assert e.value.status_code == 503
+    assert e.value.headers["Retry-After"] == str(settings.queue_retry_after)
+
+    # applications without a high-water mark are not limited
+    state.lengths["other"] = 100
+    admission("other")
+
+
+def test_queue_depth_is_sampled():
+    state = DummyState()
+    settings = AdmissionSettings(queue_sample_interval=60)
+    admission = QueueAdmission(state=state, settings=settings)
+
+    state.lengths["test"] = 5
+    assert admission.depth("test") == 5
+    state.lengths["test"] = 10
+    assert admission.depth("test") == 5
+    assert state.calls == 1
+
+
+@pytest.fixture(scope="function")
+def limiter():
+    redis = Redis.from_url(RedisSettings().redis)
+    settings = AdmissionSettings(concurrency_limits={"TRIAL": 2})
+    yield ConcurrencyLimiter(redis=redis, settings=settings)
+    redis.delete(ConcurrencyLimiter.make_key(1))
+
+
+def test_concurrency_limiter(limiter):
+    limiter.acquire("test", 1, "TRIAL", "key-1")
+    limiter.acquire("test", 1, "TRIAL", "key-2")
+    assert limiter.in_flight(1) == 2
+
+    with pytest.raises(HTTPException) as e:
+        limiter.acquire("test", 1, "TRIAL", "key-3")
+    assert e.value.status_code == 429
+
+    limiter.release(1, "key-1")
+    limiter.acquire("test", 1, "TRIAL", "key-3")
+
+    # tiers without a limit are not counted
+    limiter.acquire("test", 1, "PREMIUM", "key-4")
+    assert limiter.in_flight(1) == 2
@@ -0,0 +1,69 @@
+import os
+
+import pytest
+
+from apihub.activity.schemas import ActivityStatus
+from apihub.blobs import BlobSettings, FileBlobStore
+from apihub.codec import BLOB_HEADER, CodecSettings, ResultCodec
+from apihub.utils import Result
+
+
+def make_result():
+    return Result(
+        user="user",
+        api="test",
+        status=ActivityStatus.PROCESSED,
+        result={"text": "".join(str(i) for i in range(20000))},
+    )
+
+
+def make_codec(path, compression="gzip"):
+    return ResultCodec(
+        CodecSettings(result_compression=compression),
+        BlobSettings(
+            result_blob_store="file",
+            result_blob_path=str(path),
+            result_blob_threshold=0,
+        ),
+    )
+
+
+def test_file_blob_store(tmp_path):
+    store = FileBlobStore(str(tmp_path))
+    data = os.urandom(200 * 1024)
+    store.put("key/1", data)
+    chunks = list(store.open("key/1"))
+    assert len(chunks) > 1
+    assert b"".join(chunks) == data
+
+    with pytest.raises(KeyError):
+        store.open("key/2")
+
+    assert store.purge(3600) == 0
+    assert store.purge(-1) == 1
+    with pytest.raises(KeyError):
+        store.open("key/1")
+    store.delete("key/1")
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip", "zstd"])
+def test_codec_blob(tmp_path, compression):
+    codec = make_codec(tmp_path, compression)
+    result = make_result()
+    stored = codec.encode(result, "key")
+    assert stored[:1] == BLOB_HEADER
+    assert ResultCodec.status(stored) == ActivityStatus.PROCESSED
+    assert ResultCodec.gzipped(stored) is None
+    assert codec.blob(stored).startswith("key.")
+
+    assert codec.decode(stored) == result
+    assert b"".join(codec.stream(stored)) == result.json().encode("utf-8")
+
+
+def test_codec_blob_not_used(tmp_path):
+    codec = make_codec(tmp_path)
+    accepted = Result(user="user", api="test", status=ActivityStatus.ACCEPTED)
+    assert codec.encode(accepted, "key")[:1] == b"{"
+    # without a key there is no name for the blob
+    assert codec.encode(make_result())[:1] == b"g"
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,159 @@
+import asyncio
+import gzip
+
+import msgpack
+import pytest
+import zstandard
+from fastapi import HTTPException
+
+from apihub.bodies import RequestBodySettings, decode_body
+
+
+settings = RequestBodySettings(request_body_max_size=1000)
+dct = {"text": "this is simple", "probability": 0.6}
+
+
+def test_decode_body():
+    assert decode_body(b"", None, None, settings) == {}
+    assert decode_body(b'{"text": "a"}', None, None, settings) == {"text": "a"}
+    assert (
+        decode_body(msgpack.packb(dct), "application/msgpack", "identity", settings)
+        == dct
+    )
+    assert (
+        decode_body(
+            gzip.compress(msgpack.packb(dct)), "application/x-msgpack", "gzip", settings
+        )
+        == dct
+    )
+    assert (
+        decode_body(
+            zstandard.compress(b'{"text": "a"}'),
+            "application/json; charset=utf-8",
+            "zstd",
+            settings,
+        )
+        == {"text": "a"}
+    )
+    # integers beyond 64 bits were always accepted
+    assert decode_body(b'{"id": %d}' % 2 ** 70, None, None, settings) == {
+        "id": 2 ** 70
+    }
+
+
+@pytest.mark.parametrize(
+    "data,content_type,encoding,status_code",
+    [
+        (b"[1, 2]", None, None, 422),
+        (b"{", None, None, 400),
+        (b"\xc1", "application/msgpack", None, 400),
+        # binary values cannot be passed on as JSON
+        (msgpack.packb({"image": b"\x89PNG"}), "application/msgpack", None, 400),
+        (msgpack.packb([msgpack.ExtType(1, b"")]), "application/msgpack", None, 400),
+        (b'{"text": "a"}', None, "br", 415),
+        (b'{"text": "a"}', None, "gzip", 400),
+        (gzip.compress(b'{"text": "a"}')[:-4], None, "gzip", 400),
+        (b'{"text": "%s"}' % (b"a" * 1000), None, None, 413),
+        # bombs are rejected without being decompressed entirely
+        (gzip.compress(b" " * 10 ** 7), None, "gzip", 413),
+        (zstandard.compress(b" " * 10 ** 7), None, "zstd", 413),
+    ],
+)
+def test_decode_invalid_body(data, content_type, encoding, status_code):
+    with pytest.raises(HTTPException) as e:
+        decode_body(data, content_type, encoding, settings)
+    assert e.value.status_code == status_code
+
+
+def test_request_body_limits():
+    from pydantic import BaseModel
+    from apihub.bodies import RequestBodyLimits
+
+    class Definition(BaseModel):
+        input_schema: dict
+
+    class Definitions:
+        def get(self, application):
+            if application == "unknown":
+                raise TypeError()
+            return Definition(input_schema={"x-max-body-size": 100})
+
+    limits = RequestBodyLimits(
+        Definitions(),
+        RequestBodySettings(
+            request_body_max_size=500,
+            request_body_max_bytes=1000,
+            request_body_max_bytes_per_app={"app": 10},
+        ),
+    )
+    assert asyncio.run(limits("app")) == 10
+    assert asyncio.run(limits("other")) == 100
+    assert asyncio.run(limits("unknown", multipart=True)) == 1000
+    # a body decoded whole is held to the decoded limit
+    assert asyncio.run(limits("unknown")) == 500
+
+
+def test_body_size_limit():
+    from fastapi import FastAPI, Request
+    from fastapi.testclient import TestClient
+    from apihub.activity.middlewares import ActivityLogger
+    from apihub.bodies import BodySizeLimit
+
+    app = FastAPI()
+
+    @app.post("/async/{application}")
+    async def submit(application: str, request: Request):
+        return {"size": len(await request.body())}
+
+    async def limits(application, multipart):
+        return 20 if multipart else 10
+
+    app.add_middleware(ActivityLogger)
+    app.add_middleware(BodySizeLimit, limits=limits)
+    client = TestClient(app)
+
+    def chunks(n):
+        for _ in range(n):
+            yield b"12345"
+
+    response = client.post("/async/app", data=b"1234567890")
+    assert response.json() == {"size": 10}
+    response = client.post("/async/app", data=chunks(2))
+    assert response.json() == {"size": 10}
+
+    before = BodySizeLimit.rejected_counter.labels(api="app")._value.get()
+    # declared by Content-Length
+    response = client.post("/async/app", data=b"12345678901")
+    assert response.status_code == 413
+    # found while the body arrives, the first chunk is read by ActivityLogger
+    response = client.post("/async/app", data=chunks(3))
+    assert response.status_code == 413
+    assert BodySizeLimit.rejected_counter.labels(api="app")._value.get() == before + 2
+
+    # other paths are not limited
+    response = client.post("/async/app/results", data=b"12345678901")
+    assert response.status_code == 404
+
+    # uploads are not decoded whole, they have a limit of their own
+    multipart = {"Content-Type": "multipart/form-data; boundary=x"}
+    response = client.post("/async/app", data=b"1" * 15, headers=multipart)
+    assert response.json() == {"size": 15}
+    response = client.post("/async/app", data=b"1" * 21, headers=multipart)
+    assert response.status_code == 413
+
+
+def test_recorded_body():
+    from apihub.activity.middlewares import recorded_body
+
+    assert recorded_body(b'{"text": "a"}', "application/json", None) == '{"text": "a"}'
+    compressed = gzip.compress(b'{"text": "a"}')
+    assert (
+        recorded_body(compressed, "application/json", "gzip")
+        == f"<{len(compressed)} bytes, application/json, gzip>"
+    )
+    packed = msgpack.packb(dct)
+    assert (
+        recorded_body(packed, "application/msgpack", None)
+        == f"<{len(packed)} bytes, application/msgpack, identity>"
+    )
+    assert recorded_body(b"\xff\xfe", None, None) == "<2 bytes, no type, identity>"
@@ -0,0 +1,116 @@
+import pytest
+from redis import Redis
+
+from apihub.activity.schemas import ActivityStatus
+from apihub.cache import ResultCache, ResultCacheSettings
+from apihub.utils import Result, RedisSettings, make_input_hash
+
+
+@pytest.fixture(scope="function")
+def redis():
+    redis = Redis.from_url(RedisSettings().redis)
+    yield redis
+    for key in redis.scan_iter("cache:test*"):
+        redis.delete(key)
+    redis.delete("cache-key-1", "cache-key-2", "cache-key-3")
+
+
+@pytest.fixture(scope="function")
+def cache(redis):
+    settings = ResultCacheSettings(
+        result_cache_ttl={"test": 60}, result_cache_max_entries=2
+    )
+    yield ResultCache(redis=redis, settings=settings)
+
+
+def accepted():
+    return Result(user="user", api="test", status=ActivityStatus.ACCEPTED)
+
+
+def test_input_hash():
+    assert make_input_hash("test", "0.1", {"a": 1, "b": "x"}) == make_input_hash(
+        "test", "0.1", {"b": "x", "a": 1}
+    )
+    assert make_input_hash("test", "0.1", {"a": 1}) != make_input_hash(
+        "test", "0.2", {"a": 1}
+    )
+
+
+def test_cache_hit_and_miss(cache, redis):
+    assert cache.enabled("test")
+    assert not cache.enabled("other")
+
+    assert cache.get("test", "hash1") is None
+
+    redis.set(
+        "cache-key-1",
+        Result(user="user", api="test", status=ActivityStatus.PROCESSED).json(),
+    )
+    cache.add("test", "hash1", "cache-key-1", accepted(), 60)
+
+    key, result = cache.get("test", "hash1")
+    assert key == "cache-key-1"
+    assert result.status == ActivityStatus.PROCESSED
+
+    # expired result is not served
+    redis.delete("cache-key-1")
+    assert cache.get("test", "hash1") is None
+    assert redis.get(ResultCache.make_entry("test", "hash1")) is None
+
+
+def test_cache_eviction(cache, redis):
+    for i in range(1, 4):
+        redis.set(
+            f"cache-key-{i}",
+            Result(user="user", api="test", status=ActivityStatus.ACCEPTED).json(),
+        )
+        cache.add("test", f"hash{i}", f"cache-key-{i}", accepted(), 60)
+
+    assert cache.get("test", "hash1") is None
+    assert cache.get("test", "hash2") is not None
+    assert cache.get("test", "hash3") is not None
+
+
+def test_cached_key_is_accepted_before_the_result_writer(cache, redis):
+    cache.add("test", "hash1", "cache-key-1", accepted(), 60)
+
+    key, result = cache.get("test", "hash1")
+    assert key == "cache-key-1"
+    assert result.status == ActivityStatus.ACCEPTED
+    assert 0 < redis.ttl("cache-key-1") <= 60
+
+    # a result stored first is kept
+    redis.set(
+        "cache-key-2",
+        Result(user="user", api="test", status=ActivityStatus.PROCESSED).json(),
+    )
+    cache.add("test", "hash2", "cache-key-2", accepted(), 60)
+    assert cache.get("test", "hash2")[1].status == ActivityStatus.PROCESSED
+
+
+def test_cached_result_whose_blob_is_gone(redis, tmp_path):
+    import os
+    from apihub.blobs import BlobSettings
+    from apihub.codec import CodecSettings, ResultCodec
+
+    codec = ResultCodec(
+        CodecSettings(),
+        BlobSettings(
+            result_blob_store="file",
+            result_blob_path=str(tmp_path),
+            result_blob_threshold=0,
+        ),
+    )
+    cache = ResultCache(
+        redis=redis,
+        settings=ResultCacheSettings(result_cache_ttl={"test": 60}),
+        codec=codec,
+    )
+    result = Result(user="user", api="test", status=ActivityStatus.PROCESSED)
+    redis.set("cache-key-1", codec.encode(result, "cache-key-1"))
+    cache.add("test", "hash1", "cache-key-1", accepted(), 60)
+    assert cache.get("test", "hash1")[1] == result
+
+    for name in os.listdir(tmp_path):
+        os.remove(tmp_path / name)
+    assert cache.get("test", "hash1") is None
@@ -0,0 +1,66 @@
+import pytest
+from redis import Redis
+
+from apihub.coalescing import RequestCoalescer, RequestCoalescingSettings
+from apihub.utils import RedisSettings
+
+
+@pytest.fixture(scope="function")
+def coalescer():
+    redis = Redis.from_url(RedisSettings().redis)
+    settings = RequestCoalescingSettings(request_coalescing_applications=["test"])
+    yield RequestCoalescer(redis=redis, settings=settings)
+    for key in redis.scan_iter("coalescing:*"):
+        redis.delete(key)
+
+
+def test_attach_and_complete(coalescer):
+    assert coalescer.enabled("test")
+    assert not coalescer.enabled("other")
+
+    assert coalescer.attach("test", "hash", "key-1", "user1@test.com") is None
+    assert coalescer.attach("test", "hash", "key-2", "user2@test.com") == "key-1"
+    assert coalescer.attach("test", "hash", "key-3", "user3@test.com") == "key-1"
+
+    assert coalescer.complete("key-1") == {
+        "key-2": "user2@test.com",
+        "key-3": "user3@test.com",
+    }
+    assert coalescer.complete("key-1") == {}
+
+    # once completed, a new request becomes the pending job again
+    assert coalescer.attach("test", "hash", "key-4", "user4@test.com") is None
+
+
+def test_attach_to_a_new_pending_job(coalescer):
+    assert coalescer.attach("test", "hash", "key-1", "user1@test.com") is None
+    # the pending job expired, and another one took its place
+    coalescer.redis.delete(RequestCoalescer.make_pending("test", "hash"))
+    assert coalescer.attach("test", "hash", "key-2", "user2@test.com") is None
+    assert coalescer.attach("test", "hash", "key-3", "user3@test.com") == "key-2"
+
+    assert coalescer.complete("key-1") == {}
+    assert coalescer.complete("key-2") == {"key-3": "user3@test.com"}
+    assert coalescer.complete("unknown") == {}
+
+
+def test_cancel(coalescer):
+    assert coalescer.attach("test", "hash", "key-1", "user1@test.com") is None
+    # nothing attached, the job is released
+    assert not coalescer.cancel("key-1")
+    assert coalescer.attach("test", "hash", "key-2", "user2@test.com") is None
+    assert coalescer.attach("test", "hash", "key-3", "user3@test.com") == "key-2"
+    # the job is still processed for key-3
+    assert coalescer.cancel("key-2")
+    assert coalescer.complete("key-2") == {"key-3": "user3@test.com"}
+    assert not coalescer.cancel("unknown")
+
+
+def test_attached_requests_are_kept_as_long_as_results(coalescer):
+    assert coalescer.attach("test", "hash", "key-1", "user1@test.com", 3600) is None
+    assert coalescer.attach("test", "hash", "key-2", "user2@test.com", 3600)
+    group = RequestCoalescer.make_group("test", "hash")
+    redis = coalescer.redis
+    assert redis.ttl(RequestCoalescer.make_pending("test", "hash")) <= 600
+    assert redis.ttl(RequestCoalescer.make_aliases(group, "key-1")) > 600
+    assert redis.ttl(RequestCoalescer.make_leader("key-1")) > 600
@@ -0,0 +1,106 @@
+import logging
+
+import pytest
+from redis import Redis
+from pipeline import Message
+
+from apihub.fairness import FairQueue, FairQueueDispatcher, FairQueueSettings
+from apihub.utils import RedisSettings
+
+
+@pytest.fixture(scope="function")
+def fair_queue():
+    redis = Redis.from_url(RedisSettings().redis)
+    settings = FairQueueSettings(
+        fair_queueing_applications=["test"], fair_queueing_dispatch_depth=3
+    )
+    yield FairQueue(redis=redis, settings=settings)
+    for key in redis.scan_iter("fairq:test*"):
+        redis.delete(key)
+
+
+def test_fair_queue_round_robin(fair_queue):
+    for i in range(4):
+        fair_queue.push("test", "heavy", Message(id=f"heavy{i}"))
+    fair_queue.push("test", "light", Message(id="light0"))
+
+    assert fair_queue.length("test") == 5
+    assert fair_queue.users("test") == 2
+
+    ids = []
+    while True:
+        popped = fair_queue.pop("test")
+        if popped is None:
+            break
+        ids.append(popped[1].id)
+
+    assert ids == ["heavy0", "light0", "heavy1", "heavy2", "heavy3"]
+    assert fair_queue.length("test") == 0
+    assert fair_queue.users("test") == 0
+    assert fair_queue.shares("test") == {"heavy": 4, "light": 1}
+    ttl = fair_queue.redis.ttl(f"{FairQueue.make_prefix('test')}:dispatched")
+    assert 0 < ttl <= fair_queue.settings.fair_queueing_shares_window
+
+
+class DummyState:
+    def __init__(self):
+        self.topics = {}
+
+    def length(self, name):
+        return len(self.topics.get(name, []))
+
+    def write(self, name, message):
+        self.topics.setdefault(name, []).append(message)
+
+
+def test_dispatcher_keeps_worker_topic_short(fair_queue):
+    for i in range(5):
+        fair_queue.push("test", "user", Message(id=f"job{i}"))
+
+    state = DummyState()
+    dispatcher = FairQueueDispatcher(state=state, fair_queue=fair_queue)
+
+    assert dispatcher.dispatch("test") == 3
+    assert dispatcher.dispatch("test") == 0
+
+    state.topics["test"].pop(0)
+    assert dispatcher.dispatch("test") == 1
+    assert fair_queue.length("test") == 1
+
+
+def test_dispatcher_exports_shares(fair_queue):
+    from prometheus_client import REGISTRY
+
+    def share(user):
+        return REGISTRY.get_sample_value(
+            "api_fair_queue_dispatched_window", {"api": "test", "user": user}
+        )
+
+    for i in range(2):
+        fair_queue.push("test", "user", Message(id=f"job{i}"))
+    dispatcher = FairQueueDispatcher(state=DummyState(), fair_queue=fair_queue)
+    dispatcher.dispatch("test")
+    assert share("user") == 2
+
+    # the window of the user ends
+    fair_queue.redis.delete(f"{FairQueue.make_prefix('test')}:dispatched")
+    dispatcher.dispatch("test")
+    assert share("user") is None
+
+
+def test_dispatcher_skips_topics_of_unknown_depth(fair_queue, caplog):
+    class UnknownDepthState(DummyState):
+        def length(self, name):
+            return -1
+
+    for i in range(5):
+        fair_queue.push("test", "user", Message(id=f"job{i}"))
+    state = UnknownDepthState()
+    dispatcher = FairQueueDispatcher(state=state, fair_queue=fair_queue)
+
+    with caplog.at_level(logging.WARNING):
+        assert dispatcher.dispatch("test") == 0
+        assert dispatcher.dispatch("test") == 0
+    assert state.topics == {}
+    assert fair_queue.length("test") == 5
+    assert len([r for r in caplog.records if "unknown" in r.getMessage()]) == 1
@@ -0,0 +1,114 @@
+import time
+
+import pytest
+from redis import Redis
+from pipeline import Message
+
+from apihub.hedging import Hedger, HedgingSettings, StragglerDetector
+from apihub.utils import RedisSettings
+
+
+@pytest.fixture(scope="function")
+def hedger():
+    redis = Redis.from_url(RedisSettings().redis)
+    settings = HedgingSettings(
+        hedging_percentiles={"test": 0.9}, hedging_samples=10, hedging_min_samples=5
+    )
+    yield Hedger(redis=redis, settings=settings)
+    for key in redis.scan_iter("hedge:test*"):
+        redis.delete(key)
+
+
+class DummyState:
+    def __init__(self):
+        self.topics = {}
+
+    def write(self, name, message):
+        self.topics.setdefault(name, []).append(message)
+
+
+def test_threshold(hedger):
+    assert hedger.threshold("test") is None
+
+    for i in range(20):
+        hedger.complete("test", f"key{i}", float(i))
+
+    # only the most recent samples are kept
+    assert hedger.threshold("test") == 18.0
+
+
+def test_stragglers_are_hedged_once(hedger):
+    for _ in range(5):
+        hedger.complete("test", "done", 0.1)
+
+    hedger.track("test", "test:PREMIUM", Message(id="slow", content={"a": 1}))
+    assert hedger.start("test", "slow")
+    hedger.redis.zadd("hedge:test:pending", {"slow": time.time() - 10})
+    hedger.track("test", "test", Message(id="fast"))
+    assert hedger.start("test", "fast")
+    # still queued, it does not straggle
+    hedger.track("test", "test", Message(id="queued"))
+
+    state = DummyState()
+    detector = StragglerDetector(state=state, hedger=hedger)
+    assert detector.hedge("test") == 1
+    assert [msg.id for msg in state.topics["test:PREMIUM"]] == ["slow"]
+    assert state.topics["test:PREMIUM"][0].content == {"a": 1}
+
+    # the second dispatch does not start straggling again
+    assert not hedger.start("test", "slow")
+    assert detector.hedge("test") == 0
+    assert hedger.stragglers("test", 0) == ["fast"]
+
+
+def test_completed_jobs_are_not_hedged(hedger):
+    hedger.track("test", "test", Message(id="cancelled"))
+    hedger.complete("test", "cancelled")
+    assert not hedger.start("test", "cancelled")
+    assert hedger.stragglers("test", 0) == []
+    # only processing times are recorded
+    assert hedger.redis.llen("hedge:test:durations") == 0
+
+
+def test_lost_jobs_are_pruned(hedger):
+    hedger.track("test", "test", Message(id="lost"))
+    assert hedger.start("test", "lost")
+    hedger.track("test", "test", Message(id="recent"))
+    assert 0 < hedger.redis.ttl("hedge:test:jobs") <= hedger.settings.hedging_job_ttl
+    # the result of lost never arrives
+    hedger.redis.zadd(
+        "hedge:test:tracked",
+        {"lost": time.time() - hedger.settings.hedging_job_ttl - 1},
+    )
+
+    detector = StragglerDetector(state=DummyState(), hedger=hedger)
+    assert detector.hedge("test") == 0
+    assert hedger.redis.hkeys("hedge:test:jobs") == [b"recent"]
+    assert hedger.redis.hkeys("hedge:test:topics") == [b"recent"]
+    assert hedger.redis.zrange("hedge:test:tracked", 0, -1) == [b"recent"]
+    assert hedger.stragglers("test", 0) == []
+    assert hedger.prune("test") == 0
+
+
+def test_stragglers_are_hedged_through_the_fair_queue(hedger):
+    from apihub.fairness import FairQueue, FairQueueSettings
+
+    fair_queue = FairQueue(
+        hedger.redis, FairQueueSettings(fair_queueing_applications=["test"])
+    )
+    for _ in range(5):
+        hedger.complete("test", "done", 0.1)
+    hedger.track("test", "test", Message(id="slow", content={"user": "user"}))
+    hedger.start("test", "slow")
+    hedger.redis.zadd("hedge:test:pending", {"slow": time.time() - 10})
+
+    state = DummyState()
+    detector = StragglerDetector(state=state, hedger=hedger, fair_queue=fair_queue)
+    try:
+        assert detector.hedge("test") == 1
+        assert state.topics == {}
+        user, message = fair_queue.pop("test")
+        assert (user, message.id) == ("user", "slow")
+    finally:
+        for key in hedger.redis.scan_iter("fairq:test*"):
+            hedger.redis.delete(key)
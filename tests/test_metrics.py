@@ -0,0 +1,66 @@
+import os
+import shutil
+import subprocess
+import sys
+
+from prometheus_client import CollectorRegistry, generate_latest, multiprocess
+
+from apihub.metrics import MultiProcessCollector, clean_multiprocess_dir
+
+
+WRITE_METRICS = """
+from prometheus_client import Counter, Histogram
+Counter("test_ops", "ops", ["api"]).labels(api="test").inc(2)
+Histogram("test_latency", "latency", ["api"]).labels(api="test").observe(0.3)
+"""
+
+
+def write_metrics(path, processes):
+    env = dict(os.environ, prometheus_multiproc_dir=str(path))
+    for _ in range(processes):
+        subprocess.run([sys.executable, "-c", WRITE_METRICS], env=env, check=True)
+
+
+def scrape(collector_class, path):
+    registry = CollectorRegistry()
+    collector = collector_class(registry, path=str(path))
+    return collector, lines(registry)
+
+
+def lines(registry):
+    # metrics may be merged in another order
+    return sorted(generate_latest(registry).splitlines())
+
+
+def test_exited_processes_are_merged_once(tmp_path):
+    write_metrics(tmp_path, 3)
+    # a file of this process, which is alive
+    dead = sorted(tmp_path.glob("counter_*.db"))[0]
+    shutil.copy(dead, tmp_path / f"counter_{os.getpid()}.db")
+
+    _, expected = scrape(multiprocess.MultiProcessCollector, tmp_path)
+    collector, scraped = scrape(MultiProcessCollector, tmp_path)
+    assert scraped == expected
+    assert b'test_ops_total{api="test"} 8.0' in scraped
+    assert b'test_latency_count{api="test"} 3.0' in scraped
+    assert len(collector.exited) == 6
+
+    exited_metrics = collector.exited_metrics
+    registry = CollectorRegistry()
+    registry.register(collector)
+    assert lines(registry) == expected
+    assert collector.exited_metrics is exited_metrics
+
+    write_metrics(tmp_path, 1)
+    _, expected = scrape(multiprocess.MultiProcessCollector, tmp_path)
+    assert lines(registry) == expected
+    assert len(collector.exited) == 8
+
+
+def test_clean_multiprocess_dir(tmp_path, monkeypatch):
+    assert clean_multiprocess_dir() == 0
+
+    monkeypatch.setenv("prometheus_multiproc_dir", str(tmp_path))
+    write_metrics(tmp_path, 2)
+    assert clean_multiprocess_dir() == 4
+    assert list(tmp_path.iterdir()) == []
@@ -54,3 +54,232 @@ class TestResultWriter:
             writer.start()
         except Exception:
             pytest.fail("worker raised exception")
+
+
+@pytest.fixture(scope="function")
+def writer(db_session, monkeypatch):
+    monkeypatch.setenv("MONITORING", "FALSE")
+    monkeypatch.setenv("RESULT_WRITER_BATCH_SIZE", "1")
+    from apihub.result import ResultWriter
+
+    writer = ResultWriter()
+    writer.parse_args("--in-kind MEM".split())
+    writer.set_db_session(db_session)
+    yield writer
+    writer.shutdown()
+    for key in writer.redis.scan_iter("writer-test-*"):
+        writer.redis.delete(key)
+
+
+def make_result(status, **kwargs):
+    from apihub.utils import Result
+
+    return Result(user="user", api="test", status=status, **kwargs).dict()
+
+
+class TestResultWriterOrdering:
+    def test_accepted_never_overwrites_result(self, writer):
+        from apihub.activity.schemas import ActivityStatus
+        from apihub.utils import Result
+
+        writer.setup()
+        key = "writer-test-1"
+        writer.process(make_result(ActivityStatus.PROCESSED), key)
+        writer.process(make_result(ActivityStatus.ACCEPTED), key)
+        assert Result.parse_raw(writer.redis.get(key)).status == ActivityStatus.PROCESSED
+
+    def test_accepted_never_overwrites_compressed_result(self, writer, monkeypatch):
+        from apihub.activity.schemas import ActivityStatus
+
+        monkeypatch.setenv("RESULT_COMPRESSION", "gzip")
+        monkeypatch.setenv("RESULT_COMPRESSION_THRESHOLD", "0")
+        writer.setup()
+        key = "writer-test-3"
+        writer.process(make_result(ActivityStatus.PROCESSED), key)
+        assert writer.redis.get(key)[:1] == b"g"
+        writer.process(make_result(ActivityStatus.ACCEPTED), key)
+        stored = writer.redis.get(key)
+        assert writer.codec.decode(stored).status == ActivityStatus.PROCESSED
+
+    def test_large_result_is_stored_as_blob(self, writer, monkeypatch, tmp_path):
+        import os
+        from apihub.activity.schemas import ActivityStatus
+
+        monkeypatch.setenv("RESULT_BLOB_STORE", "file")
+        monkeypatch.setenv("RESULT_BLOB_PATH", str(tmp_path))
+        monkeypatch.setenv("RESULT_BLOB_THRESHOLD", "0")
+        monkeypatch.setenv("HEDGING_PERCENTILES", '{"test": 0.9}')
+        writer.setup()
+        key = "writer-test-4"
+        writer.process(make_result(ActivityStatus.PROCESSED), key)
+        stored = writer.redis.get(key)
+        assert stored[:1] == b"B"
+        assert writer.codec.decode(stored).status == ActivityStatus.PROCESSED
+        assert len(os.listdir(tmp_path)) == 1
+
+        # the blob of a result which is not written is deleted
+        writer.process(make_result(ActivityStatus.PROCESSED), key)
+        assert writer.redis.get(key) == stored
+        assert len(os.listdir(tmp_path)) == 1
+
+    def test_latency_is_observed(self, writer):
+        import time
+        from apihub.activity.schemas import ActivityStatus
+
+        def count(histogram):
+            return sum(
+                sample.value
+                for metric in histogram.collect()
+                for sample in metric.samples
+                if sample.name.endswith("_count") and sample.labels["api"] == "test"
+            )
+
+        histograms = [
+            writer.queue_wait,
+            writer.request_duration,
+            writer.write_lag,
+            writer.total_duration,
+        ]
+        before = [count(histogram) for histogram in histograms]
+        writer.setup()
+        now = time.time()
+        timestamps = {
+            "received": now - 4,
+            "enqueued": now - 3,
+            "dequeued": now - 2,
+            "processed": now - 1,
+        }
+        writer.process(
+            make_result(ActivityStatus.PROCESSED, timestamps=timestamps),
+            "writer-test-5",
+        )
+        after = [count(histogram) for histogram in histograms]
+        assert [a - b for a, b in zip(after, before)] == [1, 1, 1, 1]
+
+    def test_usage_is_recorded(self, writer):
+        from apihub.activity.schemas import ActivityStatus
+        from apihub.usage import today
+
+        def usage():
+            writer.usage.flush()
+            return writer.usage.tracker.usage("test", today()).get("user", {})
+
+        writer.setup()
+        before = usage()
+        writer.process(make_result(ActivityStatus.ACCEPTED), "writer-test-6")
+        writer.process(make_result(ActivityStatus.PROCESSED), "writer-test-6")
+        after = usage()
+        assert after.get("processed", 0) - before.get("processed", 0) == 1
+        assert after.get("accepted") == before.get("accepted")
+
+    def test_write_script_is_loaded_again(self, writer):
+        from apihub.activity.schemas import ActivityStatus
+
+        writer.setup()
+        # e.g. redis restarted since the writer started
+        writer.redis.script_flush()
+        writer.process(make_result(ActivityStatus.PROCESSED), "writer-test-8")
+        assert writer.codec.decode(writer.redis.get("writer-test-8")).status == (
+            ActivityStatus.PROCESSED
+        )
+
+    def test_only_processing_time_is_sampled_for_hedging(self, writer, monkeypatch):
+        from apihub.activity.schemas import ActivityStatus
+
+        monkeypatch.setenv("HEDGING_PERCENTILES", '{"test": 0.9}')
+        writer.setup()
+        writer.redis.delete("hedge:test:durations")
+        writer.process(
+            make_result(ActivityStatus.PROCESSED, timestamps={"dequeued": 10.0}),
+            "writer-test-7",
+        )
+        writer.process(make_result(ActivityStatus.EXPIRED), "writer-test-8")
+        durations = writer.redis.lrange("hedge:test:durations", 0, -1)
+        writer.redis.delete("hedge:test:durations")
+        # processed is stamped by the worker, the result has none here
+        assert durations == []
+
+        writer.process(
+            make_result(
+                ActivityStatus.PROCESSED,
+                timestamps={"dequeued": 10.0, "processed": 12.5},
+            ),
+            "writer-test-9",
+        )
+        durations = writer.redis.lrange("hedge:test:durations", 0, -1)
+        writer.redis.delete("hedge:test:durations")
+        assert durations == [b"2.5"]
+
+    def test_cancelled_is_final(self, writer):
+        from apihub.activity.schemas import ActivityStatus
+        from apihub.utils import Result
+
+        writer.setup()
+        key = "writer-test-2"
+        writer.process(make_result(ActivityStatus.CANCELLED), key)
+        writer.process(make_result(ActivityStatus.PROCESSED), key)
+        assert Result.parse_raw(writer.redis.get(key)).status == ActivityStatus.CANCELLED
+
+    def test_coalesced_requests_outlive_cancellations(self, writer, monkeypatch):
+        from apihub.activity.schemas import ActivityStatus
+        from apihub.cancellation import Cancellations
+        from apihub.utils import Result
+
+        monkeypatch.setenv("REQUEST_COALESCING_APPLICATIONS", '["test"]')
+        writer.setup()
+        cancellations = Cancellations(writer.redis)
+        keys = {
+            "writer-test-leader": "a@test.com",
+            "writer-test-alias-1": "b@test.com",
+            "writer-test-alias-2": "c@test.com",
+        }
+        for key, user in keys.items():
+            writer.redis.set(
+                key,
+                Result(user=user, api="test", status=ActivityStatus.ACCEPTED).json(),
+            )
+            writer.coalescer.attach("test", "hash", key, user)
+
+        # the user of an alias cancels it
+        raw = writer.redis.get("writer-test-alias-2")
+        assert cancellations.cancel("test", "writer-test-alias-2", raw)
+        # the user of the job cancels it, which others still wait for
+        assert writer.coalescer.cancel("writer-test-leader")
+        raw = writer.redis.get("writer-test-leader")
+        assert cancellations.cancel("test", "writer-test-leader", raw, keep_job=True)
+
+        writer.process(
+            make_result(ActivityStatus.PROCESSED, result={"a": 1}), "writer-test-leader"
+        )
+        statuses = {
+            key: Result.parse_raw(writer.redis.get(key)) for key in keys
+        }
+        assert statuses["writer-test-leader"].status == ActivityStatus.CANCELLED
+        assert statuses["writer-test-alias-1"].status == ActivityStatus.PROCESSED
+        assert statuses["writer-test-alias-1"].user == "b@test.com"
+        assert statuses["writer-test-alias-1"].result == {"a": 1}
+        assert statuses["writer-test-alias-2"].status == ActivityStatus.CANCELLED
+
+        for key in writer.redis.scan_iter("coalescing:*"):
+            writer.redis.delete(key)
+        writer.redis.delete(cancellations.make_key("test"))
+
+    def test_concurrent_writes_keep_order_per_key(self, writer, monkeypatch):
+        from apihub.activity.schemas import ActivityStatus
+        from apihub.utils import Result
+
+        monkeypatch.setenv("RESULT_WRITER_CONCURRENCY", "4")
+        monkeypatch.setenv("RESULT_WRITER_BATCH_SIZE", "10")
+        writer.setup()
+        assert writer.shards is not None
+
+        keys = [f"writer-test-concurrent-{i}" for i in range(50)]
+        for key in keys:
+            writer.process(make_result(ActivityStatus.ACCEPTED), key)
+            writer.process(make_result(ActivityStatus.PROCESSED, result={"key": key}), key)
+        writer.shutdown()
+
+        for key in keys:
+            result = Result.parse_raw(writer.redis.get(key))
+            assert result.status == ActivityStatus.PROCESSED
+            assert result.result == {"key": key}
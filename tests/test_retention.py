@@ -0,0 +1,74 @@
+import logging
+
+import pytest
+from redis import Redis
+
+from apihub.activity.schemas import ActivityStatus
+from apihub.retention import ResultRetention, RetentionSettings
+from apihub.utils import RedisSettings
+
+
+@pytest.fixture(scope="function")
+def retention():
+    redis = Redis.from_url(RedisSettings().redis)
+    settings = RetentionSettings(
+        result_ttls={"test": 60},
+        result_memory_budgets={"test": 10000},
+        result_memory_check_interval=0,
+    )
+    yield ResultRetention(redis=redis, settings=settings)
+    for key in redis.scan_iter("retention-test-*"):
+        redis.delete(key)
+    redis.delete(ResultRetention.make_key("test"))
+
+
+def test_ttl(retention):
+    assert retention.ttl("test") == 60
+    assert retention.ttl("other") == 86400
+
+
+def test_oldest_results_are_expired_over_budget(retention, caplog):
+    redis = retention.redis
+    keys = [f"retention-test-{i}" for i in range(100)]
+    for key in keys:
+        p = redis.pipeline()
+        p.set(key, "x" * 500, ex=60)
+        retention.track(p, "test", key, ActivityStatus.PROCESSED)
+        p.execute()
+    retention.sample("test", keys[0])
+
+    memory = retention.memory("test")
+    assert memory > 10000
+
+    with caplog.at_level(logging.WARNING):
+        expired = retention.enforce("test")
+    assert expired > 0
+    assert f"expired {expired} oldest" in caplog.text
+    assert retention.memory("test") <= 10000
+    # the oldest results are expired first
+    assert redis.exists(keys[0]) == 0
+    assert redis.exists(keys[-1]) == 1
+
+
+def test_accepted_results_are_not_expired(retention):
+    redis = retention.redis
+    key = "retention-test-accepted"
+    p = redis.pipeline()
+    p.set(key, "x" * 20000, ex=60)
+    retention.track(p, "test", key, ActivityStatus.ACCEPTED)
+    p.execute()
+    retention.sample("test", key)
+
+    # the result is awaited, it is neither counted nor expired
+    assert retention.memory("test") == 0
+    assert retention.enforce("test") == 0
+    assert redis.exists(key) == 1
+
+
+def test_no_warning_when_nothing_is_expired(retention, monkeypatch, caplog):
+    # over budget by the estimate, but the results were trimmed meanwhile
+    retention.sizes["test"] = 500
+    monkeypatch.setattr(retention, "memory", lambda application: 20000)
+    with caplog.at_level(logging.WARNING):
+        assert retention.enforce("test") == 0
+    assert caplog.records == []
@@ -0,0 +1,79 @@
+import logging
+from collections import Counter
+
+import pytest
+from redis import Redis
+from pipeline import Message
+from pipeline.backends.redis import RedisListSourceSettings
+
+from apihub.scheduling import TierRouter, TierScheduler, SchedulingSettings
+from apihub.utils import RedisSettings
+from apihub.worker import TieredListSource
+
+
+def test_tier_router():
+    router = TierRouter(SchedulingSettings(tiered_applications=["test"]))
+
+    assert router.topic("test", "PREMIUM") == "test:PREMIUM"
+    assert router.topic("test") == "test"
+    assert router.topic("other", "PREMIUM") == "other"
+    assert router.topics("test") == [
+        "test",
+        "test:TRIAL",
+        "test:STANDARD",
+        "test:PREMIUM",
+    ]
+    assert router.topics("other") == ["other"]
+
+
+def test_tier_scheduler_shares():
+    scheduler = TierScheduler({"PREMIUM": 6, "STANDARD": 3, "TRIAL": 1})
+
+    served = Counter()
+    for _ in range(100):
+        tier = scheduler.order()[0]
+        scheduler.served(tier)
+        served[tier] += 1
+
+    assert served == {"PREMIUM": 60, "STANDARD": 30, "TRIAL": 10}
+
+
+def test_tier_scheduler_invalid_weights():
+    with pytest.raises(ValueError):
+        TierScheduler({"PREMIUM": 1, "TRIAL": 0})
+
+
+@pytest.fixture(scope="function")
+def redis():
+    redis = Redis.from_url(RedisSettings().redis)
+    yield redis
+    redis.delete("apihub/test", "apihub/test:PREMIUM", "apihub/test:TRIAL")
+
+
+def test_tiered_list_source(redis):
+    settings = RedisListSourceSettings(
+        redis=RedisSettings().redis, topic="test", namespace="apihub", timeout=1
+    )
+    source = TieredListSource(
+        settings,
+        scheduler=TierScheduler({"PREMIUM": 2, "TRIAL": 1}),
+        router=TierRouter(SchedulingSettings(tiered_applications=["test"])),
+        logger=logging,
+    )
+
+    for i in range(3):
+        redis.rpush("apihub/test:TRIAL", Message(id=f"trial{i}").serialize())
+        redis.rpush("apihub/test:PREMIUM", Message(id=f"premium{i}").serialize())
+    redis.rpush("apihub/test", Message(id="untiered").serialize())
+    assert len(source) == 7
+
+    ids = [msg.id for msg in source.read()]
+    assert ids == [
+        "untiered",
+        "premium0",
+        "trial0",
+        "premium1",
+        "premium2",
+        "trial1",
+        "trial2",
+    ]
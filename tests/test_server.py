@@ -1,5 +1,7 @@
+import gzip
 from unittest.mock import patch
 
+import msgpack
 import pytest
 
 from fastapi.testclient import TestClient
@@ -93,6 +95,119 @@ def test_async_service_json(client, db_session, monkeypatch):
     )
 
 
+def test_async_service_server_timing(client, db_session, monkeypatch):
+    monkeypatch.setenv("IN_KIND", "MEM")
+    monkeypatch.setenv("IN_NAMESPACE", "namespace")
+    monkeypatch.setenv("OUT_KIND", "MEM")
+    monkeypatch.setenv("OUT_NAMESPACE", "namespace")
+    import apihub.server
+
+    class DummyDefinition(BaseModel):
+        input_schema: Dict[str, Any]
+
+    class Input(BaseModel):
+        text: str
+        probability: float
+
+    def _get_definition_manager():
+        class DummyDefinitionManager:
+            def get(self, application):
+                return DummyDefinition(input_schema=Input.schema())
+
+        return DummyDefinitionManager()
+
+    monkeypatch.setattr(
+        apihub.server, "get_definition_manager", _get_definition_manager
+    )
+    token = SubscriptionToken(
+        user_id=1, subscription_id=1, application_id=1,
+        email="user@test.com", tier=SubscriptionTier.TRIAL, application="test",
+        role="user", name="user", expires_days=1,
+    )
+
+    response = client.post(
+        "/async/test", params={"text": "this is simple"}, json={"probability": 0.6},
+        headers={"Authorization": f"Bearer {token.access_token}"}
+    )
+    assert response.status_code == 200
+    assert "Server-Timing" not in response.headers
+
+    response = client.post(
+        "/async/test", params={"text": "this is simple"}, json={"probability": 0.6},
+        headers={
+            "Authorization": f"Bearer {token.access_token}",
+            "X-Server-Timing": "1",
+        },
+    )
+    assert response.status_code == 200
+    phases = [
+        entry.split(";")[0] for entry in response.headers["Server-Timing"].split(", ")
+    ]
+    for name in ["auth", "body", "definition", "validate", "enqueue", "total"]:
+        assert name in phases
+
+
+def test_async_service_msgpack(client, db_session, monkeypatch):
+    monkeypatch.setenv("IN_KIND", "MEM")
+    monkeypatch.setenv("IN_NAMESPACE", "namespace")
+    monkeypatch.setenv("OUT_KIND", "MEM")
+    monkeypatch.setenv("OUT_NAMESPACE", "namespace")
+    import apihub.server
+
+    class DummyDefinition(BaseModel):
+        input_schema: Dict[str, Any]
+
+    class Input(BaseModel):
+        text: str
+        probability: float
+
+    def _get_definition_manager():
+        class DummyDefinitionManager:
+            def get(self, application):
+                return DummyDefinition(input_schema=Input.schema())
+
+        return DummyDefinitionManager()
+
+    monkeypatch.setattr(
+        apihub.server, "get_definition_manager", _get_definition_manager
+    )
+    token = SubscriptionToken(
+        user_id=1, subscription_id=1, application_id=1,
+        email="user@test.com", tier=SubscriptionTier.TRIAL, application="test",
+        role="user", name="user", expires_days=1,
+    )
+    response = client.post(
+        "/async/test",
+        data=gzip.compress(
+            msgpack.packb({"text": "this is simple", "probability": 0.6})
+        ),
+        headers={
+            "Authorization": f"Bearer {token.access_token}",
+            "Content-Type": "application/msgpack",
+            "Content-Encoding": "gzip",
+        },
+    )
+    assert response.status_code == 200
+    destination = apihub.server.get_state().pipeline.destination_of(
+        make_topic("test")
+    )
+    accepted = len(destination.results)
+
+    # binary values are rejected before anything is accepted
+    response = client.post(
+        "/async/test",
+        data=msgpack.packb(
+            {"text": "this is simple", "probability": 0.6, "image": b"\x89PNG"}
+        ),
+        headers={
+            "Authorization": f"Bearer {token.access_token}",
+            "Content-Type": "application/msgpack",
+        },
+    )
+    assert response.status_code == 400
+    assert len(destination.results) == accepted
+
+
 def test_define_service(client):
     response = client.get(
         "/define/test",
@@ -194,3 +309,574 @@ def test_openapi(client, monkeypatch):
 
     schema = apihub.server.custom_openapi()
     validate_spec(schema, validator=openapi_v30_spec_validator)
+
+
+def test_async_service_bulk_result(client, monkeypatch):
+    import apihub.server
+    from apihub.security.schemas import SecurityToken
+    from apihub.utils import Result
+    from apihub.activity.schemas import ActivityStatus
+
+    redis = apihub.server.get_redis()
+    redis.set(
+        "bulk-processed",
+        Result(user="user@test.com", api="test", status=ActivityStatus.PROCESSED).json(),
+    )
+    redis.set(
+        "bulk-accepted",
+        Result(user="user@test.com", api="test", status=ActivityStatus.ACCEPTED).json(),
+    )
+    redis.delete("bulk-missing")
+    monkeypatch.setattr(apihub.server.settings, "bulk_result_chunk_size", 2)
+
+    token = SecurityToken(
+        user_id=1, email="user@test.com", role="user", name="user", expires_days=1,
+    )
+    keys = ["bulk-processed", "bulk-accepted", "bulk-missing"]
+
+    response = client.post(
+        "/async/test/results",
+        json={"keys": keys},
+        headers={"Authorization": f"Bearer {token.access_token}"},
+    )
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [item["key"] for item in results] == keys
+    assert [item["status"] for item in results] == ["PROCESSED", "ACCEPTED", "NOT_FOUND"]
+    assert results[0]["result"]["api"] == "test"
+
+    response = client.post(
+        "/async/test/results",
+        json={"keys": keys},
+        headers={
+            "Authorization": f"Bearer {token.access_token}",
+            "Accept": "application/x-ndjson",
+        },
+    )
+    assert response.status_code == 200
+    lines = response.text.strip().split("\n")
+    assert len(lines) == 3
+
+    monkeypatch.setattr(apihub.server.settings, "bulk_result_max_keys", 2)
+    response = client.post(
+        "/async/test/results",
+        json={"keys": keys},
+        headers={"Authorization": f"Bearer {token.access_token}"},
+    )
+    assert response.status_code == 422
+
+
+def test_async_service_idempotency_key(client, monkeypatch):
+    monkeypatch.setenv("OUT_KIND", "MEM")
+    import apihub.server
+    from apihub.idempotency import IdempotencyKeys
+
+    class DummyDefinition(BaseModel):
+        input_schema: Dict[str, Any]
+
+    class Input(BaseModel):
+        text: str
+
+    def _get_definition_manager():
+        class DummyDefinitionManager:
+            def get(self, application):
+                return DummyDefinition(input_schema=Input.schema())
+
+        return DummyDefinitionManager()
+
+    monkeypatch.setattr(
+        apihub.server, "get_definition_manager", _get_definition_manager
+    )
+    token = SubscriptionToken(
+        user_id=1, subscription_id=1, application_id=1,
+        email="user@test.com", tier=SubscriptionTier.TRIAL, application="test",
+        role="user", name="user", expires_days=1,
+    )
+    apihub.server.get_redis().delete(IdempotencyKeys.make_key(1, "retry-1"))
+    pipeline = apihub.server.get_state().pipeline
+    headers = {
+        "Authorization": f"Bearer {token.access_token}",
+        "Idempotency-Key": "retry-1",
+    }
+
+    response = client.post("/async/test", json={"text": "simple"}, headers=headers)
+    assert response.status_code == 200
+    key = response.json()["key"]
+    count = len(pipeline.destination_of(make_topic("test")).results)
+
+    response = client.post("/async/test", json={"text": "simple"}, headers=headers)
+    assert response.status_code == 200
+    assert response.json()["key"] == key
+    assert len(pipeline.destination_of(make_topic("test")).results) == count
+
+
+def test_async_service_idempotency_key_cancelled(client, monkeypatch):
+    import asyncio
+    import apihub.server
+    from apihub.idempotency import IdempotencyKeys
+
+    async def cancelled_request(*args):
+        # the client disconnected while the request was submitted
+        assert redis.ttl(name) <= 30
+        raise asyncio.CancelledError()
+
+    redis = apihub.server.get_redis()
+    name = IdempotencyKeys.make_key(1, "retry-cancelled")
+    redis.delete(name)
+    monkeypatch.setattr(apihub.server, "make_request", cancelled_request)
+    token = SubscriptionToken(
+        user_id=1, subscription_id=1, application_id=1,
+        email="user@test.com", tier=SubscriptionTier.TRIAL, application="test",
+        role="user", name="user", expires_days=1,
+    )
+    headers = {
+        "Authorization": f"Bearer {token.access_token}",
+        "Idempotency-Key": "retry-cancelled",
+    }
+
+    with pytest.raises(asyncio.CancelledError):
+        client.post("/async/test", json={"text": "simple"}, headers=headers)
+    # a retry is not refused as in progress
+    assert redis.get(name) is None
+
+
+def test_async_service_releases_slot_on_failure(client, monkeypatch):
+    import apihub.server
+    from apihub.admission import AdmissionSettings, ConcurrencyLimiter
+
+    class DummyDefinition(BaseModel):
+        input_schema: Dict[str, Any]
+
+    class Input(BaseModel):
+        text: str
+
+    class FailingHedger:
+        def enabled(self, application):
+            raise RuntimeError("enqueue failed")
+
+    def _get_definition_manager():
+        class DummyDefinitionManager:
+            def get(self, application):
+                return DummyDefinition(input_schema=Input.schema())
+
+        return DummyDefinitionManager()
+
+    limiter = ConcurrencyLimiter(
+        apihub.server.get_redis(), AdmissionSettings(concurrency_limits={"TRIAL": 1})
+    )
+    monkeypatch.setattr(
+        apihub.server, "get_definition_manager", _get_definition_manager
+    )
+    monkeypatch.setattr(apihub.server, "get_concurrency_limiter", lambda: limiter)
+    monkeypatch.setattr(apihub.server, "get_hedger", FailingHedger)
+    token = SubscriptionToken(
+        user_id=1, subscription_id=33, application_id=1,
+        email="user@test.com", tier=SubscriptionTier.TRIAL, application="test",
+        role="user", name="user", expires_days=1,
+    )
+    headers = {"Authorization": f"Bearer {token.access_token}"}
+
+    with pytest.raises(RuntimeError):
+        client.post("/async/test", json={"text": "simple"}, headers=headers)
+    assert limiter.in_flight(33) == 0
+
+
+def test_async_service_cancel(client, monkeypatch):
+    import apihub.server
+    from apihub.utils import Result
+    from apihub.activity.schemas import ActivityStatus
+    from apihub.subscription.helpers import make_key
+
+    token = SubscriptionToken(
+        user_id=1, subscription_id=1, application_id=1,
+        email="user@test.com", tier=SubscriptionTier.TRIAL, application="test",
+        role="user", name="user", expires_days=1,
+    )
+    headers = {"Authorization": f"Bearer {token.access_token}"}
+    redis = apihub.server.get_redis()
+    redis.set(
+        "cancel-accepted",
+        Result(user="user@test.com", api="test", status=ActivityStatus.ACCEPTED).json(),
+    )
+    redis.set(
+        "cancel-processed",
+        Result(user="user@test.com", api="test", status=ActivityStatus.PROCESSED).json(),
+    )
+    redis.set(
+        "cancel-other",
+        Result(user="other@test.com", api="test", status=ActivityStatus.ACCEPTED).json(),
+    )
+    redis.set(make_key(token), 5)
+
+    response = client.delete("/async/test", params={"key": "cancel-accepted"}, headers=headers)
+    assert response.status_code == 200
+    assert Result.parse_raw(redis.get("cancel-accepted")).status == ActivityStatus.CANCELLED
+    assert apihub.server.get_cancellations().cancelled("test", "cancel-accepted")
+    # submitting takes no credit, cancelling gives none back
+    assert int(redis.get(make_key(token))) == 5
+
+    response = client.get("/async/test", params={"key": "cancel-accepted"}, headers=headers)
+    assert response.status_code == 410
+
+    response = client.delete("/async/test", params={"key": "cancel-accepted"}, headers=headers)
+    assert response.status_code == 409
+    response = client.delete("/async/test", params={"key": "cancel-processed"}, headers=headers)
+    assert response.status_code == 409
+    response = client.delete("/async/test", params={"key": "cancel-other"}, headers=headers)
+    assert response.status_code == 403
+    assert int(redis.get(make_key(token))) == 5
+
+    redis.delete(make_key(token), "cancelled:test")
+
+
+def test_async_service_cancel_coalesced(client, monkeypatch):
+    import apihub.server
+    from apihub.cancellation import Cancellations
+    from apihub.coalescing import RequestCoalescer, RequestCoalescingSettings
+    from apihub.utils import Result
+    from apihub.activity.schemas import ActivityStatus
+
+    redis = apihub.server.get_redis()
+    coalescer = RequestCoalescer(
+        redis, RequestCoalescingSettings(request_coalescing_applications=["test"])
+    )
+    monkeypatch.setattr(apihub.server, "get_request_coalescer", lambda: coalescer)
+    token = SubscriptionToken(
+        user_id=1, subscription_id=1, application_id=1,
+        email="user@test.com", tier=SubscriptionTier.TRIAL, application="test",
+        role="user", name="user", expires_days=1,
+    )
+    headers = {"Authorization": f"Bearer {token.access_token}"}
+    for key, user in [("cancel-leader", "user@test.com"), ("cancel-alias", "other@test.com")]:
+        redis.set(
+            key, Result(user=user, api="test", status=ActivityStatus.ACCEPTED).json()
+        )
+    assert coalescer.attach("test", "hash", "cancel-leader", "user@test.com") is None
+    assert coalescer.attach("test", "hash", "cancel-alias", "other@test.com")
+
+    response = client.delete("/async/test", params={"key": "cancel-leader"}, headers=headers)
+    assert response.status_code == 200
+    leader = Result.parse_raw(redis.get("cancel-leader"))
+    assert leader.status == ActivityStatus.CANCELLED
+    # the job is still processed for the request of the other user
+    alias = Result.parse_raw(redis.get("cancel-alias"))
+    assert alias.status == ActivityStatus.ACCEPTED
+    assert not Cancellations(redis).cancelled("test", "cancel-leader")
+    assert coalescer.attach("test", "hash", "cancel-new", "user@test.com") == (
+        "cancel-leader"
+    )
+    assert coalescer.complete("cancel-leader") == {
+        "cancel-alias": "other@test.com",
+        "cancel-new": "user@test.com",
+    }
+
+    # a job without requests attached is cancelled
+    redis.set(
+        "cancel-single",
+        Result(user="user@test.com", api="test", status=ActivityStatus.ACCEPTED).json(),
+    )
+    assert coalescer.attach("test", "hash", "cancel-single", "user@test.com") is None
+    response = client.delete("/async/test", params={"key": "cancel-single"}, headers=headers)
+    assert response.status_code == 200
+    assert Cancellations(redis).cancelled("test", "cancel-single")
+    # identical requests start a new job
+    assert coalescer.attach("test", "hash", "cancel-new", "user@test.com") is None
+
+    for key in redis.scan_iter("coalescing:*"):
+        redis.delete(key)
+    redis.delete("cancel-leader", "cancel-alias", "cancel-single", "cancelled:test")
+
+
+def test_reply_from_cache(client, monkeypatch):
+    import apihub.server
+    from apihub.cache import ResultCache, ResultCacheSettings
+    from apihub.utils import Result
+    from apihub.activity.schemas import ActivityStatus
+
+    redis = apihub.server.get_redis()
+    cache = ResultCache(redis, ResultCacheSettings(result_cache_ttl={"test": 60}))
+    monkeypatch.setattr(apihub.server, "get_result_cache", lambda: cache)
+    written = []
+    monkeypatch.setattr(
+        apihub.server.get_state(), "write", lambda topic, message: written.append(message)
+    )
+    cached = Result(
+        user="first@test.com",
+        api="test",
+        status=ActivityStatus.PROCESSED,
+        subscription_id=1,
+        submission_time="2021-01-01T00:00:00",
+        deadline=1.0,
+        timestamps={"received": 1.0, "processed": 2.0},
+        result={"text": "cached"},
+    )
+    redis.set("cache-first", cached.json())
+    cache.add("test", "hash", "cache-first", cached, 60)
+
+    key = apihub.server.reply_from_cache(
+        "second@test.com", "test", "hash", "cache-second", 10.0, 2, 20.0
+    )
+    assert key == "cache-second"
+    (message,) = written
+    result = Result.parse_obj(message.content)
+    assert result.result == {"text": "cached"}
+    assert result.user == "second@test.com"
+    assert result.subscription_id == 2
+    assert result.deadline == 20.0
+    assert result.submission_time != cached.submission_time
+    assert result.timestamps == {"received": 10.0}
+
+    for key in redis.scan_iter("cache:test*"):
+        redis.delete(key)
+    redis.delete("cache-first")
+
+
+def test_async_service_result_compressed(client, monkeypatch):
+    import apihub.server
+    from apihub.security.schemas import SecurityToken
+    from apihub.codec import ResultCodec, CodecSettings
+    from apihub.utils import Result
+    from apihub.activity.schemas import ActivityStatus
+
+    result = Result(
+        user="user@test.com",
+        api="test",
+        status=ActivityStatus.PROCESSED,
+        result={"text": "simple " * 1000},
+    )
+    redis = apihub.server.get_redis()
+    for codec in ["gzip", "zstd"]:
+        stored = ResultCodec(CodecSettings(result_compression=codec)).encode(result)
+        assert len(stored) < len(result.json())
+        redis.set(f"compressed-{codec}", stored)
+
+    token = SecurityToken(
+        user_id=1, email="user@test.com", role="user", name="user", expires_days=1,
+    )
+    for codec in ["gzip", "zstd"]:
+        for encoding in ["gzip", "identity"]:
+            response = client.get(
+                "/async/test",
+                params={"key": f"compressed-{codec}"},
+                headers={
+                    "Authorization": f"Bearer {token.access_token}",
+                    "Accept-Encoding": encoding,
+                },
+            )
+            assert response.status_code == 200
+            assert response.json()["result"]["result"] == result.result
+            assert response.json()["key"] == f"compressed-{codec}"
+            if codec == "gzip" and encoding == "gzip":
+                assert response.headers["Content-Encoding"] == "gzip"
+            else:
+                assert "Content-Encoding" not in response.headers
+
+    redis.delete("compressed-gzip", "compressed-zstd")
+
+
+def test_async_service_result_blob(client, monkeypatch, tmp_path):
+    import os
+    import apihub.server
+    from apihub.security.schemas import SecurityToken
+    from apihub.blobs import BlobSettings
+    from apihub.codec import ResultCodec, CodecSettings
+    from apihub.utils import Result
+    from apihub.activity.schemas import ActivityStatus
+
+    codec = ResultCodec(
+        CodecSettings(result_compression="gzip"),
+        BlobSettings(
+            result_blob_store="file",
+            result_blob_path=str(tmp_path),
+            result_blob_threshold=0,
+        ),
+    )
+    monkeypatch.setattr(apihub.server, "get_result_codec", lambda: codec)
+
+    result = Result(
+        user="user@test.com",
+        api="test",
+        status=ActivityStatus.PROCESSED,
+        result={"text": "simple " * 100000},
+    )
+    redis = apihub.server.get_redis()
+    redis.set("blob", codec.encode(result, "blob"))
+
+    token = SecurityToken(
+        user_id=1, email="user@test.com", role="user", name="user", expires_days=1,
+    )
+    for encoding in ["gzip", "identity"]:
+        response = client.get(
+            "/async/test",
+            params={"key": "blob"},
+            headers={
+                "Authorization": f"Bearer {token.access_token}",
+                "Accept-Encoding": encoding,
+            },
+        )
+        assert response.status_code == 200
+        assert response.json()["result"]["result"] == result.result
+        assert response.json()["key"] == "blob"
+        if encoding == "gzip":
+            assert response.headers["Content-Encoding"] == "gzip"
+        else:
+            assert "Content-Encoding" not in response.headers
+
+    for name in os.listdir(tmp_path):
+        os.remove(tmp_path / name)
+    response = client.get(
+        "/async/test",
+        params={"key": "blob"},
+        headers={"Authorization": f"Bearer {token.access_token}"},
+    )
+    assert response.status_code == 404
+
+    redis.delete("blob")
+
+
+def test_async_service_bulk_result_blob_missing(client, monkeypatch, tmp_path):
+    import os
+    import apihub.server
+    from apihub.security.schemas import SecurityToken
+    from apihub.blobs import BlobSettings
+    from apihub.codec import ResultCodec, CodecSettings
+    from apihub.utils import Result
+    from apihub.activity.schemas import ActivityStatus
+
+    codec = ResultCodec(
+        CodecSettings(),
+        BlobSettings(
+            result_blob_store="file",
+            result_blob_path=str(tmp_path),
+            result_blob_threshold=0,
+        ),
+    )
+    monkeypatch.setattr(apihub.server, "get_result_codec", lambda: codec)
+    result = Result(user="user@test.com", api="test", status=ActivityStatus.PROCESSED)
+    redis = apihub.server.get_redis()
+    redis.set("bulk-blob", codec.encode(result, "bulk-blob"))
+    for name in os.listdir(tmp_path):
+        os.remove(tmp_path / name)
+
+    token = SecurityToken(
+        user_id=1, email="user@test.com", role="user", name="user", expires_days=1,
+    )
+    response = client.post(
+        "/async/test/results",
+        json={"keys": ["bulk-blob"]},
+        headers={"Authorization": f"Bearer {token.access_token}"},
+    )
+    assert response.status_code == 200
+    assert response.json()["results"] == [
+        {"key": "bulk-blob", "status": "NOT_FOUND", "result": None}
+    ]
+
+    redis.delete("bulk-blob")
+
+
+def test_async_service_upload(client, db_session, monkeypatch, tmp_path):
+    monkeypatch.setenv("OUT_KIND", "MEM")
+    import os
+    from fastapi import HTTPException
+    import apihub.server
+    from apihub.uploads import UploadSettings, UploadSpool
+
+    class DummyDefinition(BaseModel):
+        input_schema: Dict[str, Any]
+
+    class Input(BaseModel):
+        text: str
+        document: bytes
+
+    class DummyDefinitionManager:
+        def get(self, application):
+            return DummyDefinition(input_schema=Input.schema())
+
+    spool = UploadSpool(UploadSettings(upload_path=str(tmp_path)))
+    monkeypatch.setattr(
+        apihub.server, "get_definition_manager", lambda: DummyDefinitionManager()
+    )
+    monkeypatch.setattr(apihub.server, "get_upload_spool", lambda: spool)
+    token = SubscriptionToken(
+        user_id=1, subscription_id=1, application_id=1,
+        email="user@test.com", tier=SubscriptionTier.TRIAL, application="upload",
+        role="user", name="user", expires_days=1,
+    )
+    document = b"%PDF" + b"x" * (2 * 1024 * 1024)
+
+    response = client.post(
+        "/async/upload",
+        data={"text": "this is simple"},
+        files={"document": ("doc.pdf", document, "application/pdf")},
+        headers={"Authorization": f"Bearer {token.access_token}"},
+    )
+    assert response.status_code == 200
+    key = response.json()["key"]
+
+    destination = apihub.server.get_state().pipeline.destination_of(
+        make_topic("upload")
+    )
+    job = destination.results[-1]
+    assert job.content["text"] == "this is simple"
+    assert job.content["document"] == f"{key}.document"
+    assert job.content["uploads"]["document"]["size"] == len(document)
+    assert set(job.content["timestamps"]) == {"received", "enqueued"}
+    assert b"".join(spool.open(job.content["document"])) == document
+
+    # only fields of format binary accept files
+    response = client.post(
+        "/async/upload",
+        data={"document": "inline"},
+        files={"text": ("doc.txt", b"text", "text/plain")},
+        headers={"Authorization": f"Bearer {token.access_token}"},
+    )
+    assert response.status_code == 422
+
+    # files of rejected requests are not kept
+    def reject(application):
+        raise HTTPException(503, "Service is overloaded")
+
+    saved = sorted(os.listdir(tmp_path))
+    monkeypatch.setattr(apihub.server, "get_queue_admission", lambda: reject)
+    response = client.post(
+        "/async/upload",
+        data={"text": "this is simple"},
+        files={"document": ("doc.pdf", document, "application/pdf")},
+        headers={"Authorization": f"Bearer {token.access_token}"},
+    )
+    assert response.status_code == 503
+    assert sorted(os.listdir(tmp_path)) == saved
+
+
+def test_usage_by_user(client, monkeypatch):
+    import apihub.server
+    from apihub.security.depends import require_admin
+
+    tracker = apihub.server.get_usage_tracker()
+    tracker.record_many(
+        [("usage-server", "a@test.com", "accepted")] * 2
+        + [("usage-server", "b@test.com", "accepted")]
+    )
+    api = apihub.server.api
+    api.dependency_overrides[require_admin] = lambda: None
+    try:
+        response = client.get("/usage/usage-server")
+        assert response.status_code == 200
+        assert response.json() == {
+            "a@test.com": {"accepted": 2},
+            "b@test.com": {"accepted": 1},
+        }
+
+        response = client.get("/usage/usage-server/top", params={"k": 1})
+        assert response.status_code == 200
+        assert response.json() == [{"user": "a@test.com", "count": 2}]
+    finally:
+        del api.dependency_overrides[require_admin]
+        for key in tracker.redis.scan_iter("usage:usage-server:*"):
+            tracker.redis.delete(key)
+
+
+def test_metrics(client):
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert b"# TYPE APIHub_total counter" in response.content
@@ -0,0 +1,127 @@
+import logging
+from datetime import datetime
+
+import pytest
+from redis import Redis
+from pipeline import Message
+
+from apihub.streams import (
+    MSGPACK_HEADER,
+    StreamSource,
+    StreamSourceSettings,
+    StreamDestination,
+    StreamDestinationSettings,
+)
+from apihub.utils import RedisSettings
+
+
+@pytest.fixture(scope="function")
+def redis():
+    redis = Redis.from_url(RedisSettings().redis)
+    yield redis
+    redis.delete("apihub/test")
+
+
+def make_source(**kwargs):
+    settings = StreamSourceSettings(
+        redis=RedisSettings().redis,
+        topic="test",
+        namespace="apihub",
+        group="workers",
+        timeout=1,
+        block=10,
+        _args=[],
+        **kwargs,
+    )
+    return StreamSource(settings, logger=logging)
+
+
+def test_stream_round_trip(redis):
+    destination = StreamDestination(
+        StreamDestinationSettings(
+            redis=RedisSettings().redis,
+            topic="test",
+            namespace="apihub",
+            maxlen=100,
+            _args=[],
+        ),
+        logger=logging,
+    )
+    for i in range(3):
+        destination.write(Message(id=f"job{i}"))
+    assert len(destination) == 3
+
+    source = make_source()
+    ids = []
+    for msg in source.read():
+        ids.append(msg.id)
+        source.acknowledge()
+    assert ids == ["job0", "job1", "job2"]
+    assert redis.xpending("apihub/test", "workers")["pending"] == 0
+
+
+def test_unacknowledged_messages_are_claimed(redis):
+    redis.xadd("apihub/test", {"data": Message(id="lost").serialize()})
+
+    crashed = make_source()
+    crashed.create_group()
+    assert [msg_id for msg_id, _ in crashed.fetch()]
+    # the consumer crashes before acknowledging the message
+
+    source = make_source(min_idle_time=0)
+    ids = []
+    for msg in source.read():
+        ids.append(msg.id)
+        source.acknowledge()
+    assert ids == ["lost"]
+    assert redis.xpending("apihub/test", "workers")["pending"] == 0
+
+
+def test_deferred_acknowledgement(redis):
+    for i in range(2):
+        redis.xadd("apihub/test", {"data": Message(id=f"job{i}").serialize()})
+
+    source = make_source()
+    deferred = []
+    for msg in source.read():
+        deferred.append(source.defer_acknowledge())
+        source.acknowledge()
+    # the messages stay pending until acknowledged once written
+    assert redis.xpending("apihub/test", "workers")["pending"] == 2
+    source.acknowledge_many(deferred)
+    assert redis.xpending("apihub/test", "workers")["pending"] == 0
+
+
+def test_msgpack_topic(redis):
+    def make_destination(**kwargs):
+        return StreamDestination(
+            StreamDestinationSettings(
+                redis=RedisSettings().redis,
+                topic="test",
+                namespace="apihub",
+                _args=[],
+                **kwargs,
+            ),
+            logger=logging,
+        )
+
+    content = {"text": "simple", "labels": ["a", "b"], "score": 0.5, "raw": None}
+    # readers of a topic see both formats while it is switched to msgpack
+    make_destination().write(Message(id="json", content=content))
+    make_destination(msgpack_topics=["test"]).write(
+        Message(id="msgpack", content=content)
+    )
+    first, second = redis.xrange("apihub/test")
+    assert first[1][b"data"][:1] == b"{"
+    assert second[1][b"data"][:1] == MSGPACK_HEADER
+    assert len(second[1][b"data"]) < len(first[1][b"data"])
+
+    source = make_source()
+    messages = []
+    for msg in source.read():
+        messages.append(msg)
+        source.acknowledge()
+    assert [msg.id for msg in messages] == ["json", "msgpack"]
+    for msg in messages:
+        assert msg.content == content
+        assert isinstance(msg.created, datetime)
@@ -0,0 +1,48 @@
+import time
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from apihub.timing import ServerTiming, TimingSettings, phase
+
+
+def make_client(settings=None):
+    app = FastAPI()
+
+    @app.get("/")
+    def root():
+        with phase("sleep"):
+            time.sleep(0.01)
+        with phase("sleep"):
+            time.sleep(0.01)
+        return {}
+
+    app.add_middleware(ServerTiming, settings=settings)
+    return TestClient(app)
+
+
+def parse(header):
+    return {
+        name: float(duration.split("=")[1])
+        for name, duration in (entry.split(";") for entry in header.split(", "))
+    }
+
+
+def test_server_timing():
+    client = make_client()
+    response = client.get("/")
+    assert "Server-Timing" not in response.headers
+
+    response = client.get("/", headers={"X-Server-Timing": "1"})
+    phases = parse(response.headers["Server-Timing"])
+    assert phases["sleep"] >= 20
+    assert phases["total"] >= phases["sleep"]
+
+    client = make_client(TimingSettings(server_timing=True))
+    response = client.get("/")
+    assert set(parse(response.headers["Server-Timing"])) == {"sleep", "total"}
+
+
+def test_phase_outside_of_request():
+    with phase("nothing"):
+        pass
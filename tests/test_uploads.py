@@ -0,0 +1,45 @@
+import io
+import os
+
+import pytest
+from fastapi import HTTPException
+from starlette.datastructures import UploadFile
+
+from apihub.uploads import UploadSettings, UploadSpool
+
+
+def make_upload(data):
+    upload = UploadFile(filename="doc.pdf", content_type="application/pdf")
+    upload.file.write(data)
+    upload.file.seek(0)
+    return upload
+
+
+def test_upload_spool(tmp_path):
+    spool = UploadSpool(UploadSettings(upload_path=str(tmp_path), upload_max_size=10))
+    data = os.urandom(10)
+    saved = spool.save("key", {"document": make_upload(data)})
+    assert saved == {
+        "document": {
+            "name": "key.document",
+            "filename": "doc.pdf",
+            "content_type": "application/pdf",
+            "size": 10,
+        }
+    }
+    assert b"".join(spool.open("key.document")) == data
+
+    with pytest.raises(HTTPException) as e:
+        spool.check({"document": make_upload(os.urandom(11))})
+    assert e.value.status_code == 413
+
+
+def test_upload_spool_purge(tmp_path):
+    spool = UploadSpool(
+        UploadSettings(
+            upload_path=str(tmp_path), upload_ttl=-1, upload_purge_interval=0
+        )
+    )
+    spool.save("old", {"document": make_upload(b"old")})
+    spool.save("new", {"document": make_upload(b"new")})
+    assert os.listdir(tmp_path) == ["new.document"]
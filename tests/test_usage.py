@@ -0,0 +1,69 @@
+import pytest
+from redis import Redis
+
+from apihub.usage import UsageBuffer, UsageSettings, UsageTracker, today
+from apihub.utils import RedisSettings
+
+
+@pytest.fixture(scope="function")
+def tracker():
+    redis = Redis.from_url(RedisSettings().redis)
+    yield UsageTracker(redis=redis, settings=UsageSettings(usage_retention_days=1))
+    for key in redis.scan_iter("usage:usage-test:*"):
+        redis.delete(key)
+
+
+def test_usage_is_counted_per_user_and_operation(tracker):
+    tracker.record("usage-test", "a@test.com", "received")
+    tracker.record_many(
+        [
+            ("usage-test", "a@test.com", "accepted"),
+            ("usage-test", "a@test.com", "accepted"),
+            ("usage-test", "b c@test.com", "processed"),
+        ]
+    )
+
+    assert tracker.usage("usage-test", today()) == {
+        "a@test.com": {"received": 1, "accepted": 2},
+        "b c@test.com": {"processed": 1},
+    }
+    assert tracker.usage("usage-test", "2000-01-01") == {}
+    ttl = tracker.redis.ttl(tracker.make_key("usage-test", today()))
+    assert 0 < ttl <= 86400
+
+
+def test_top_users(tracker):
+    for user, count in [("a", 3), ("b", 5), ("c", 1)]:
+        tracker.record_many([("usage-test", user, "accepted")] * count)
+    tracker.record("usage-test", "d", "received")
+
+    assert tracker.top("usage-test", today(), 2) == [("b", 5), ("a", 3)]
+    assert tracker.top("usage-test", "2000-01-01", 2) == []
+
+
+def test_nothing_to_record(tracker):
+    tracker.record_many([])
+    assert tracker.usage("usage-test", today()) == {}
+
+
+def test_usage_buffer_rolls_up_counts(tracker):
+    tracker.settings.usage_flush_interval = 3600
+    buffer = UsageBuffer(tracker)
+    for _ in range(3):
+        buffer.add("usage-test", "a@test.com", "accepted")
+    buffer.add("usage-test", "a@test.com", "result_not_found", 5)
+    # nothing is written until the buffer is flushed
+    assert tracker.usage("usage-test", today()) == {}
+
+    buffer.close()
+    assert tracker.usage("usage-test", today()) == {
+        "a@test.com": {"accepted": 3, "result_not_found": 5},
+    }
+    assert tracker.top("usage-test", today(), 1) == [("a@test.com", 3)]
+
+
+def test_usage_buffer_disabled(tracker):
+    tracker.settings.usage_flush_interval = 0
+    buffer = UsageBuffer(tracker)
+    buffer.add("usage-test", "a@test.com", "received")
+    assert tracker.usage("usage-test", today()) == {"a@test.com": {"received": 1}}
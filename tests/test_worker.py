@@ -0,0 +1,96 @@
+import time
+
+import pytest
+from fastapi import HTTPException
+from pydantic import BaseModel
+from pipeline import Message, ProcessorSettings
+
+from apihub.activity.schemas import ActivityStatus
+from apihub.deadlines import DeadlineSettings, make_deadline
+from apihub.worker import Worker
+
+
+class Output(BaseModel):
+    answer: str
+
+
+class EchoWorker(Worker):
+    def __init__(self):
+        settings = ProcessorSettings(
+            name="echo", version="0.1.0", description="echo worker"
+        )
+        super().__init__(settings, input_class=dict, output_class=Output)
+
+    def process(self, message_content, message_id):
+        return Output(answer=message_content["text"])
+
+
+def test_make_deadline():
+    settings = DeadlineSettings(job_timeouts={"test": 60})
+
+    assert make_deadline("other", None, settings) is None
+    assert make_deadline("test", None, settings) == pytest.approx(time.time() + 60, abs=1)
+    assert make_deadline("other", "5", settings) == pytest.approx(time.time() + 5, abs=1)
+
+    with pytest.raises(HTTPException):
+        make_deadline("test", "soon", settings)
+    with pytest.raises(HTTPException):
+        make_deadline("test", "-1", settings)
+
+
+def test_worker_skips_expired_jobs(monkeypatch):
+    monkeypatch.setenv("MONITORING", "FALSE")
+    worker = EchoWorker()
+    worker.parse_args("--in-kind MEM --out-kind MEM".split())
+    worker.source.load_data(
+        [
+            {"text": "late", "status": "PROCESSED", "deadline": time.time() - 1},
+            {"text": "in time", "status": "PROCESSED", "deadline": time.time() + 60},
+            {"text": "no deadline", "status": "PROCESSED"},
+        ]
+    )
+    worker.start()
+
+    results = [msg.content for msg in worker.destination.results]
+    assert [result["status"] for result in results] == [
+        ActivityStatus.EXPIRED,
+        ActivityStatus.PROCESSED,
+        ActivityStatus.PROCESSED,
+    ]
+    assert "answer" not in results[0]
+    assert results[1]["answer"] == "in time"
+
+
+def test_worker_skips_cancelled_jobs(monkeypatch):
+    monkeypatch.setenv("MONITORING", "FALSE")
+    worker = EchoWorker()
+    worker.parse_args("--in-kind MEM --out-kind MEM".split())
+    redis = worker.cancellations.redis
+    redis.zadd(worker.cancellations.make_key("test"), {"cancelled": time.time()})
+    worker.source.storage = [
+        Message(id=key, content={"text": key, "api": "test", "status": "PROCESSED"})
+        .serialize()
+        for key in ["cancelled", "kept"]
+    ]
+    worker.start()
+    redis.delete(worker.cancellations.make_key("test"))
+
+    results = [msg.content for msg in worker.destination.results]
+    assert [result["status"] for result in results] == [
+        ActivityStatus.CANCELLED,
+        ActivityStatus.PROCESSED,
+    ]
+
+
+def test_worker_stamps_jobs(monkeypatch):
+    monkeypatch.setenv("MONITORING", "FALSE")
+    worker = EchoWorker()
+    worker.parse_args("--in-kind MEM --out-kind MEM".split())
+    enqueued = time.time()
+    worker.source.load_data(
+        [{"text": "text", "status": "PROCESSED", "timestamps": {"enqueued": enqueued}}]
+    )
+    worker.start()
+
+    timestamps = worker.destination.results[0].content["timestamps"]
+    assert enqueued <= timestamps["dequeued"] <= timestamps["processed"]